@@ -1,16 +1,27 @@
 from flask import Flask, jsonify, render_template, request, redirect, url_for, session, send_from_directory, flash
-import psycopg2
-import psycopg2.extras
-from psycopg2.extras import RealDictCursor
 import os
 from datetime import datetime, timedelta
 from functools import wraps
-from ip_geolocation import get_ip_geolocation, format_geolocation_data
+from ip_geolocation import get_ip_geolocation, format_geolocation_data, run_geolocation_job, geolocation_cache
 from flask_caching import Cache
 from dotenv import load_dotenv
 from flask_session import Session
 import hashlib
 import secrets
+import sys
+import threading
+import time
+
+# Shared modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import query_db, get_cursor, transaction, connection
+from tallies import calculate_status, create_vote_schema, reconcile_judge_vote_tallies, touch_judge
+from reference_data import bump_reference_version, create_reference_data_schema
+from jobs import JobRunner, create_jobs_table
+from geolocation_prefixes import create_geolocation_prefix_schema
+from vote_rollups import RATIO_SHIFT_WINDOWS, create_vote_rollups, fetch_ratio_shifts
+from vote_anomalies import create_vote_anomalies_table
+from vote_clusters import VoteClusterer, create_vote_clusters_table, fetch_vote_clusters
 
 # Load environment variables from .env
 load_dotenv()
@@ -25,32 +36,14 @@ Session(app)
 # Configure other settings as needed, potentially different from the main app
 
 # Flask-Caching configuration
-# Use SimpleCache for development, switch to Redis/Memcached in production.
-cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})  # TODO: Configure for Redis in production.
-
-
-# Database connection function (adjust as needed if using a different db setup)
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST', 'localhost'),
-        port=os.environ.get('DB_PORT', '5432'),
-        dbname=os.environ.get('DB_NAME', 'jai_db'),
-        user=os.environ.get('DB_USER', 'jai'),
-        password=os.environ.get('DB_PASSWORD', '')
-    )
-    conn.autocommit = True
-    return conn
-
-def query_db(query, args=(), one=False, commit=True):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor if one else None)
-    cur.execute(query, args)
-    if commit:
-        conn.commit()
-    rv = cur.fetchall()
-    cur.close()
-    conn.close()
-    return (dict(rv[0]) if rv else None) if one else rv
+# Entries are shared by all worker processes on this host
+cache = Cache(app, config={
+    'CACHE_TYPE': 'shared_cache.SharedMemoryCache',
+    'CACHE_SHARED_PATH': os.environ.get('CACHE_SHARED_PATH'),
+    'CACHE_SHARED_MAX_BYTES': int(os.environ.get('CACHE_SHARED_MAX_BYTES', 64 * 1024 * 1024)),
+    'CACHE_DEFAULT_TIMEOUT': 300
+})
+
 
 def get_client_ip():
     """Retrieves the client's IP address, accounting for Cloudflare proxy."""
@@ -102,99 +95,65 @@ def suspicious_votes():
     # 2. High vote frequency from a single fingerprint within a short time period.
     # 3. Rapid changes in vote ratio for a judge.
 
-    # Define thresholds for suspicious activity
-    ip_vote_threshold = 5  # Votes per IP per hour
-    fingerprint_vote_threshold = 5  # Votes per fingerprint per hour
-    ratio_change_threshold = 0.15  # 15% change in ratio within an hour
+    ratio_change_threshold = 0.15  # 15% change in ratio within the window
 
-    # Get suspicious votes based on IP frequency
-    suspicious_ips = query_db('''
-        SELECT 
-            v.judge_id, 
-            v.ip_address, 
-            COUNT(*) as vote_count,
-            (SELECT name FROM judges WHERE id = v.judge_id) as judge_name,
-            (SELECT country_name FROM ip_geolocation WHERE ip_address = v.ip_address LIMIT 1) as country_name,
-            MAX(v.created_at) as latest_vote
-        FROM votes v
-        WHERE v.created_at > NOW() - INTERVAL '1 hour'
-        GROUP BY v.judge_id, v.ip_address
-        HAVING COUNT(*) >= %s
-        ORDER BY vote_count DESC, latest_vote DESC
-    ''', (ip_vote_threshold,))
-
-    # Get suspicious votes based on fingerprint frequency
-    suspicious_fingerprints = query_db('''
-        SELECT 
-            v.judge_id, 
-            v.browser_fingerprint, 
-            COUNT(*) as vote_count,
-            (SELECT name FROM judges WHERE id = v.judge_id) as judge_name,
-            MAX(v.created_at) as latest_vote
-        FROM votes v
-        WHERE v.created_at > NOW() - INTERVAL '1 hour'
-        GROUP BY v.judge_id, v.browser_fingerprint
-        HAVING COUNT(*) >= %s
-        ORDER BY vote_count DESC, latest_vote DESC
-    ''', (fingerprint_vote_threshold,))
-
-    # Detect rapid ratio changes
-    # First, get vote counts from an hour ago
-    judges_data = query_db('''
-        SELECT 
-            j.id as judge_id,
-            j.name as judge_name,
-            (SELECT COUNT(*) FROM votes 
-             WHERE judge_id = j.id AND vote_type = 'corrupt' AND created_at <= NOW() - INTERVAL '1 hour') as corrupt_votes_before,
-            (SELECT COUNT(*) FROM votes 
-             WHERE judge_id = j.id AND vote_type = 'not_corrupt' AND created_at <= NOW() - INTERVAL '1 hour') as not_corrupt_votes_before,
-            (SELECT COUNT(*) FROM votes 
-             WHERE judge_id = j.id AND vote_type = 'corrupt') as corrupt_votes_now,
-            (SELECT COUNT(*) FROM votes 
-             WHERE judge_id = j.id AND vote_type = 'not_corrupt') as not_corrupt_votes_now
-        FROM judges j
-        WHERE j.displayed = 1
-    ''')
-    
-    ratio_changes = []
-    for judge in judges_data:
-        judge_id, judge_name, corrupt_before, not_corrupt_before, corrupt_now, not_corrupt_now = judge
-        
-        # Calculate ratios
-        total_before = corrupt_before + not_corrupt_before
-        total_now = corrupt_now + not_corrupt_now
-        
-        # Skip judges with too few votes
-        if total_before < 10 or total_now < 10:
-            continue
-            
-        corrupt_ratio_before = corrupt_before / total_before if total_before > 0 else 0
-        corrupt_ratio_now = corrupt_now / total_now if total_now > 0 else 0
-        
-        ratio_change = abs(corrupt_ratio_now - corrupt_ratio_before)
-        
-        if ratio_change >= ratio_change_threshold:
-            ratio_changes.append({
-                'judge_id': judge_id,
-                'judge_name': judge_name,
-                'corrupt_ratio_before': round(corrupt_ratio_before * 100, 1),
-                'corrupt_ratio_now': round(corrupt_ratio_now * 100, 1),
-                'ratio_change': round(ratio_change * 100, 1),
-                'votes_before': total_before,
-                'votes_now': total_now,
-                'new_votes': total_now - total_before
-            })
-    
-    # Sort by ratio change (descending)
-    ratio_changes.sort(key=lambda x: x['ratio_change'], reverse=True)
+    # Bursts from one IP or one fingerprint are flagged as votes arrive by
+    # the main app's anomaly detector (thresholds live there); only keys
+    # flagged within the detector's window are shown
+    with get_cursor(dict_cursor=True) as cur:
+        cur.execute('''
+            SELECT
+                a.judge_id,
+                a.subject as ip_address,
+                a.vote_count,
+                j.name as judge_name,
+                COALESCE(g.country_name, p.country_name) as country,
+                COALESCE(g.city, p.city) as city,
+                g.isp,
+                a.first_flagged_at,
+                a.last_flagged_at
+            FROM vote_anomalies a
+            LEFT JOIN judges j ON j.id = a.judge_id
+            LEFT JOIN ip_geolocation g ON g.ip_address = a.subject::inet
+            LEFT JOIN ip_geolocation_prefixes p
+                ON p.prefix = ip_geolocation_prefix(a.subject::inet) AND p.verified
+            WHERE a.kind = 'ip' AND a.last_flagged_at > (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)
+            ORDER BY a.vote_count DESC, a.last_flagged_at DESC
+        ''', (ANOMALY_WINDOW,))
+        suspicious_ips = cur.fetchall()
+
+        cur.execute('''
+            SELECT
+                a.judge_id,
+                a.subject as browser_fingerprint,
+                a.vote_count,
+                j.name as judge_name,
+                a.first_flagged_at,
+                a.last_flagged_at
+            FROM vote_anomalies a
+            LEFT JOIN judges j ON j.id = a.judge_id
+            WHERE a.kind = 'fingerprint' AND a.last_flagged_at > (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)
+            ORDER BY a.vote_count DESC, a.last_flagged_at DESC
+        ''', (ANOMALY_WINDOW,))
+        suspicious_fingerprints = cur.fetchall()
+
+        # Votes linked by shared IPs, fingerprints or networks, from the clusterer
+        vote_clusters = fetch_vote_clusters(cur, limit=20)
+
+    # Detect rapid ratio changes over the selected window
+    window = request.args.get('window', '1h')
+    if window not in RATIO_SHIFT_WINDOWS:
+        window = '1h'
+    with get_cursor() as cur:
+        ratio_changes = fetch_ratio_shifts(cur, RATIO_SHIFT_WINDOWS[window], ratio_change_threshold)
 
     # Get recent voting patterns (last 24 hours)
     recent_votes = query_db('''
         SELECT 
-            EXTRACT(HOUR FROM created_at) as hour,
-            COUNT(*) as vote_count
-        FROM votes
-        WHERE created_at > NOW() - INTERVAL '24 hours'
+            EXTRACT(HOUR FROM bucket) as hour,
+            SUM(votes)::bigint as vote_count
+        FROM vote_rollups_hourly
+        WHERE bucket > (NOW() AT TIME ZONE 'UTC') - INTERVAL '24 hours'
         GROUP BY hour
         ORDER BY hour
     ''')
@@ -208,20 +167,54 @@ def suspicious_votes():
                            suspicious_ips=suspicious_ips,
                            suspicious_fingerprints=suspicious_fingerprints,
                            ratio_changes=ratio_changes,
+                           ratio_window=window,
+                           ratio_windows=list(RATIO_SHIFT_WINDOWS),
+                           vote_clusters=vote_clusters,
                            hourly_votes=hourly_votes)
 
+@app.route('/admin/ratio_shifts')
+@admin_required
+def ratio_shifts():
+    # Cheap enough to poll: reads rollups plus at most an hour of votes
+    window = request.args.get('window', '1h')
+    if window not in RATIO_SHIFT_WINDOWS:
+        return jsonify({'error': f"window must be one of {', '.join(RATIO_SHIFT_WINDOWS)}"}), 400
+    threshold = request.args.get('threshold', 0.15, type=float)
+    with get_cursor() as cur:
+        shifts = fetch_ratio_shifts(cur, RATIO_SHIFT_WINDOWS[window], threshold)
+    return jsonify({'window': window, 'threshold': threshold, 'shifts': shifts})
+
+@app.route('/admin/vote_clusters')
+@admin_required
+def vote_clusters():
+    limit = min(request.args.get('limit', 50, type=int), 1000)
+    min_skew = request.args.get('min_skew', 0.0, type=float)
+    with get_cursor(dict_cursor=True) as cur:
+        clusters = fetch_vote_clusters(cur, limit, min_skew)
+    return jsonify({'clusters': clusters})
+
 @app.route('/admin/geo_votes')
 @admin_required
 def geo_votes():
-    # Get vote distribution by country
+    # Get vote distribution by country. Counts come from the hourly rollups,
+    # and only the few resulting rows look up a country name.
     country_distribution = query_db('''
         SELECT
-            COALESCE(geo.country_code2, 'Unknown') as country_code,
-            COALESCE(geo.country_name, 'Unknown') as country_name,
-            COUNT(*) as vote_count
-        FROM votes v
-        LEFT JOIN ip_geolocation geo ON v.ip_address = geo.ip_address
-        GROUP BY country_code, country_name
+            COALESCE(c.country_code, 'Unknown') as country_code,
+            COALESCE(n.country_name, 'Unknown') as country_name,
+            c.vote_count
+        FROM (
+            SELECT NULLIF(country_code, '') as country_code, SUM(votes)::bigint as vote_count
+            FROM vote_rollups_hourly
+            GROUP BY country_code
+            HAVING SUM(votes) > 0
+        ) c
+        LEFT JOIN LATERAL (
+            SELECT country_name FROM ip_geolocation_prefixes WHERE country_code2 = c.country_code
+            UNION ALL
+            SELECT country_name FROM ip_geolocation WHERE country_code2 = c.country_code
+            LIMIT 1
+        ) n ON TRUE
         ORDER BY vote_count DESC
     ''')
     
@@ -233,24 +226,33 @@ def geo_votes():
         placeholders = ','.join(['%s'] * len(top_countries))
         region_distribution = query_db(f'''
             SELECT
-                geo.country_code2 as country_code,
-                geo.country_name as country_name,
-                COALESCE(geo.continent_name, 'Unknown') as region,
-                COUNT(*) as vote_count
-            FROM votes v
-            JOIN ip_geolocation geo ON v.ip_address = geo.ip_address
-            WHERE geo.country_code2 IN ({placeholders})
-            GROUP BY country_code, country_name, continent_name
+                c.country_code,
+                n.country_name,
+                COALESCE(n.continent_name, 'Unknown') as region,
+                c.vote_count
+            FROM (
+                SELECT country_code, SUM(votes)::bigint as vote_count
+                FROM vote_rollups_hourly
+                WHERE country_code IN ({placeholders})
+                GROUP BY country_code
+                HAVING SUM(votes) > 0
+            ) c
+            LEFT JOIN LATERAL (
+                SELECT country_name, continent_name FROM ip_geolocation_prefixes WHERE country_code2 = c.country_code
+                UNION ALL
+                SELECT country_name, continent_name FROM ip_geolocation WHERE country_code2 = c.country_code
+                LIMIT 1
+            ) n ON TRUE
             ORDER BY country_name, vote_count DESC
         ''', top_countries)
     
     # Get vote distribution by time of day (hourly)
     hourly_distribution = query_db('''
         SELECT 
-            EXTRACT(HOUR FROM created_at) as hour,
-            COUNT(*) as vote_count
-        FROM votes
-        WHERE created_at > NOW() - INTERVAL '7 days'
+            EXTRACT(HOUR FROM bucket) as hour,
+            SUM(votes)::bigint as vote_count
+        FROM vote_rollups_hourly
+        WHERE bucket > (NOW() AT TIME ZONE 'UTC') - INTERVAL '7 days'
         GROUP BY hour
         ORDER BY hour
     ''')
@@ -262,10 +264,10 @@ def geo_votes():
     # Get vote distribution by day of week
     daily_distribution = query_db('''
         SELECT 
-            EXTRACT(DOW FROM created_at) as day_of_week,
-            COUNT(*) as vote_count
-        FROM votes
-        WHERE created_at > NOW() - INTERVAL '30 days'
+            EXTRACT(DOW FROM bucket) as day_of_week,
+            SUM(votes)::bigint as vote_count
+        FROM vote_rollups_hourly
+        WHERE bucket > (NOW() AT TIME ZONE 'UTC') - INTERVAL '30 days'
         GROUP BY day_of_week
         ORDER BY day_of_week
     ''')
@@ -300,20 +302,21 @@ def vote_analysis():
     vote_types = query_db('''
         SELECT 
             vote_type, 
-            COUNT(*) as count
-        FROM votes
+            SUM(votes)::bigint as count
+        FROM vote_rollups_hourly
         GROUP BY vote_type
+        HAVING SUM(votes) > 0
         ORDER BY count DESC
     ''')
     
     # Get vote trends over time (last 30 days by day)
     vote_trends = query_db('''
         SELECT 
-            DATE(created_at) as vote_date,
+            DATE(bucket) as vote_date,
             vote_type,
-            COUNT(*) as count
-        FROM votes
-        WHERE created_at > NOW() - INTERVAL '30 days'
+            SUM(votes)::bigint as count
+        FROM vote_rollups_hourly
+        WHERE bucket > (NOW() AT TIME ZONE 'UTC') - INTERVAL '30 days'
         GROUP BY vote_date, vote_type
         ORDER BY vote_date
     ''')
@@ -363,10 +366,14 @@ def vote_analysis():
         SELECT 
             j.id,
             j.name,
-            COUNT(v.id) as vote_count
+            r.vote_count
         FROM judges j
-        JOIN votes v ON j.id = v.judge_id
-        GROUP BY j.id
+        JOIN (
+            SELECT judge_id, SUM(votes)::bigint as vote_count
+            FROM vote_rollups_hourly
+            GROUP BY judge_id
+        ) r ON j.id = r.judge_id
+        WHERE r.vote_count > 0
         ORDER BY vote_count DESC
         LIMIT 10
     ''')
@@ -381,13 +388,13 @@ def vote_analysis():
             SELECT 
                 j.id,
                 j.name,
-                v.vote_type,
-                COUNT(v.id) as vote_count
+                r.vote_type,
+                SUM(r.votes)::bigint as vote_count
             FROM judges j
-            JOIN votes v ON j.id = v.judge_id
+            JOIN vote_rollups_hourly r ON j.id = r.judge_id
             WHERE j.id IN ({placeholders})
-            GROUP BY j.id, j.name, v.vote_type
-            ORDER BY j.name, v.vote_type
+            GROUP BY j.id, j.name, r.vote_type
+            ORDER BY j.name, r.vote_type
         ''', top_judge_ids)
     
     # Process judge vote distribution data
@@ -543,29 +550,18 @@ def submission_analysis():
 @app.route('/admin/recalculate_status', methods=['POST']) # This will be removed later
 @admin_required
 def recalculate_status():
-    # Get all judges with vote counts
+    # Vote counts come from the judge_vote_tallies read model
     judges = query_db('''
-        SELECT j.*,
-            COALESCE(SUM(CASE WHEN v.vote_type = 'corrupt' THEN 1 ELSE 0 END), 0) AS corrupt_votes,
-            COALESCE(SUM(CASE WHEN v.vote_type = 'not_corrupt' THEN 1 ELSE 0 END), 0) AS not_corrupt_votes
+        SELECT j.id,
+            COALESCE(t.corrupt_votes, 0) AS corrupt_votes,
+            COALESCE(t.not_corrupt_votes, 0) AS not_corrupt_votes
         FROM judges j
-        LEFT JOIN votes v ON j.id = v.judge_id
-        GROUP BY j.id
+        LEFT JOIN judge_vote_tallies t ON t.judge_id = j.id AND t.scope = 'global'
     ''')
 
     # Recalculate status and update database
-    for judge in judges:
-        judge_id = judge[0]
-        total_votes = judge[-2] + judge[-1]
-        status = 'undecided'
-        if total_votes >= 5:
-            corrupt_ratio = judge[-2] / total_votes if total_votes > 0 else 0
-            not_corrupt_ratio = judge[-1] / total_votes if total_votes > 0 else 0
-            if corrupt_ratio >= 0.8333:
-                status = 'corrupt'
-            elif not_corrupt_ratio >= 0.8333:
-                status = 'not_corrupt'
-
+    for judge_id, corrupt_votes, not_corrupt_votes in judges:
+        status = calculate_status(corrupt_votes, not_corrupt_votes)
         query_db('UPDATE judges SET status = %s WHERE id = %s', (status, judge_id))
 
     log_admin_action('recalculate_status', 'Recalculated judge statuses based on vote counts')
@@ -601,12 +597,7 @@ def login():
             session['user_role'] = user['role']
             
             # Update last login time
-            conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('UPDATE admin_users SET last_login = CURRENT_TIMESTAMP WHERE id = %s', (user['id'],))
-            conn.commit()
-            cursor.close()
-            conn.close()
+            query_db('UPDATE admin_users SET last_login = CURRENT_TIMESTAMP WHERE id = %s', (user['id'],))
             
             log_admin_action('login')
             return redirect(url_for('admin'))
@@ -724,7 +715,7 @@ def admin_pending():
             s.x_link,
             COUNT(*) as submission_count,
             STRING_AGG(s.id::text, ',') as submission_ids,
-            STRING_AGG(s.ip_address, ',') as ip_addresses,
+            STRING_AGG(host(s.ip_address), ',') as ip_addresses,
             MIN(s.submitted_at) as first_submitted,
             STRING_AGG(
                 COALESCE(
@@ -732,6 +723,9 @@ def admin_pending():
                      FROM ip_geolocation
                      WHERE ip_geolocation.ip_address = s.ip_address
                      LIMIT 1),
+                    (SELECT country_name || '|' || country_code2 || '|' || country_flag
+                     FROM ip_geolocation_prefixes
+                     WHERE prefix = ip_geolocation_prefix(s.ip_address) AND verified),
                     'Unknown|XX|https://flagcdn.com/16x12/xx.png'
                 ),
                 ','
@@ -746,6 +740,12 @@ def admin_pending():
                          submissions=submissions,
                          active_page='pending')
 
+@app.route('/admin/geolocation-cache')
+@admin_required
+def geolocation_cache_stats():
+    # Hit ratio and size of this worker's in-process geolocation cache
+    return jsonify(geolocation_cache.stats())
+
 @app.route('/admin/logs')
 @admin_required
 def admin_logs():
@@ -799,18 +799,23 @@ def handle_submission(submission_id, action):
         # Get submission data
         submission = query_db('SELECT * FROM submissions WHERE id = %s', (submission_id,), one=True)
         if submission:
-            # Add to judges table
-            query_db('''
-                INSERT INTO judges (name, job_position, ruling, link, x_link)
-                VALUES (%s, %s, %s, %s, %s)
-            ''', (submission[1], submission[2], submission[3], submission[4], submission[5]))
-            
-            # Update submission status
-            query_db('UPDATE submissions SET status = "approved" WHERE id = %s', (submission_id,))
+            with transaction() as cur:
+                # Add to judges table
+                cur.execute('''
+                    INSERT INTO judges (name, job_position, ruling, link, x_link)
+                    VALUES (%s, %s, %s, %s, %s)
+                    RETURNING id
+                ''', (submission['name'], submission['position'], submission['ruling'],
+                      submission['link'], submission['x_link']))
+                touch_judge(cur, cur.fetchone()[0])
+                bump_reference_version(cur, 'judges')
+
+                # Update submission status
+                cur.execute("UPDATE submissions SET status = 'approved' WHERE id = %s", (submission_id,))
             log_admin_action('approve_submission', f'Approved submission {submission_id}')
     
     elif action == 'reject':
-        query_db('UPDATE submissions SET status = "rejected" WHERE id = %s', (submission_id,))
+        query_db("UPDATE submissions SET status = 'rejected' WHERE id = %s", (submission_id,))
         log_admin_action('reject_submission', f'Rejected submission {submission_id}')
     
     elif action == 'delete':
@@ -828,10 +833,14 @@ def add_judge():
     link = request.form['ruling_link']
     x_link = request.form['relevant_link']
     
-    query_db('''
-        INSERT INTO judges (name, job_position, ruling, link, x_link)
-        VALUES (%s, %s, %s, %s, %s)
-    ''', (name, job_position, ruling, link, x_link))
+    with transaction() as cur:
+        cur.execute('''
+            INSERT INTO judges (name, job_position, ruling, link, x_link)
+            VALUES (%s, %s, %s, %s, %s)
+            RETURNING id
+        ''', (name, job_position, ruling, link, x_link))
+        touch_judge(cur, cur.fetchone()[0])
+        bump_reference_version(cur, 'judges')
     
     log_admin_action('add_judge', f'Added judge {name}')
     return redirect(url_for('admin'))
@@ -845,11 +854,13 @@ def update_judge(judge_id):
     link = request.form['ruling_link']
     x_link = request.form['relevant_link']
     
-    query_db('''
-        UPDATE judges
-        SET name = %s, job_position = %s, ruling = %s, link = %s, x_link = %s
-        WHERE id = %s
-    ''', (name, job_position, ruling, link, x_link, judge_id))
+    with transaction() as cur:
+        cur.execute('''
+            UPDATE judges
+            SET name = %s, job_position = %s, ruling = %s, link = %s, x_link = %s
+            WHERE id = %s
+        ''', (name, job_position, ruling, link, x_link, judge_id))
+        touch_judge(cur, judge_id)
     
     log_admin_action('update_judge', f'Updated judge {judge_id}')
     return redirect(url_for('admin'))
@@ -858,10 +869,13 @@ def update_judge(judge_id):
 @admin_required
 def disable_judge(judge_id):
     # Get current displayed state
-    current_state = query_db('SELECT displayed FROM judges WHERE id = %s', (judge_id,), one=True)[0]
+    current_state = query_db('SELECT displayed FROM judges WHERE id = %s', (judge_id,), one=True)['displayed']
     # Set to 0 to disable, 1 to enable
     new_state = 0 if current_state == 1 else 1
-    query_db('UPDATE judges SET displayed = %s WHERE id = %s', (new_state, judge_id))
+    with transaction() as cur:
+        cur.execute('UPDATE judges SET displayed = %s WHERE id = %s', (new_state, judge_id))
+        touch_judge(cur, judge_id)
+        bump_reference_version(cur, 'judges')
     action = 'enable' if new_state == 1 else 'disable'
     log_admin_action(f'{action}_judge', f'Judge ID: {judge_id}')
     return redirect(url_for('admin'))
@@ -877,44 +891,39 @@ def logout():
 # Admin users table creation
 def create_admin_users_table():
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # Create admin_users table if it doesn't exist
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS admin_users (
-                id SERIAL PRIMARY KEY,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                email TEXT,
-                role TEXT DEFAULT 'admin',
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                last_login TIMESTAMP
-            )
-        ''')
-        
-        # Check if there's at least one admin user
-        cursor.execute('SELECT COUNT(*) FROM admin_users')
-        count = cursor.fetchone()[0]
-        
-        # Create default admin user if none exists
-        if count == 0:
-            # Generate a secure password
-            default_password = secrets.token_urlsafe(12)
-            password_hash = hashlib.sha256(default_password.encode()).hexdigest()
-            
+        with get_cursor() as cursor:
+            # Create admin_users table if it doesn't exist
             cursor.execute('''
-                INSERT INTO admin_users (username, password_hash, role)
-                VALUES (%s, %s, %s)
-            ''', ('admin', password_hash, 'admin'))
-            
-            print(f"Created default admin user. Username: admin, Password: {default_password}")
-            print("Please change this password immediately after first login!")
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
+                CREATE TABLE IF NOT EXISTS admin_users (
+                    id SERIAL PRIMARY KEY,
+                    username TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    email TEXT,
+                    role TEXT DEFAULT 'admin',
+                    is_active BOOLEAN DEFAULT TRUE,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_login TIMESTAMP
+                )
+            ''')
+
+            # Check if there's at least one admin user
+            cursor.execute('SELECT COUNT(*) FROM admin_users')
+            count = cursor.fetchone()[0]
+
+            # Create default admin user if none exists
+            if count == 0:
+                # Generate a secure password
+                default_password = secrets.token_urlsafe(12)
+                password_hash = hashlib.sha256(default_password.encode()).hexdigest()
+
+                cursor.execute('''
+                    INSERT INTO admin_users (username, password_hash, role)
+                    VALUES (%s, %s, %s)
+                ''', ('admin', password_hash, 'admin'))
+
+                print(f"Created default admin user. Username: admin, Password: {default_password}")
+                print("Please change this password immediately after first login!")
+
         return True
     except Exception as e:
         print(f"Error creating admin_users table: {e}")
@@ -923,6 +932,118 @@ def create_admin_users_table():
 # Create admin_users table on startup
 create_admin_users_table()
 
+def create_reference_data_tables():
+    try:
+        with get_cursor() as cur:
+            create_reference_data_schema(cur)
+        return True
+    except Exception as e:
+        print(f"Error creating reference_data_versions table: {e}")
+        return False
+
+# Judge changes bump a version that the main app's caches watch
+create_reference_data_tables()
+
+def create_vote_rollup_tables():
+    try:
+        with transaction() as cur:
+            if create_vote_rollups(cur):
+                print("Created vote_rollups_hourly; run `python vote_rollups.py --rebuild` to count existing votes")
+        return True
+    except Exception as e:
+        print(f"Error creating vote rollups: {e}")
+        return False
+
+# Hourly vote counts behind the analytics pages, kept current by triggers
+create_vote_rollup_tables()
+
+# Window the main app's anomaly detector counts votes over, in seconds
+ANOMALY_WINDOW = int(os.environ.get('ANOMALY_WINDOW', 3600))
+
+def create_anomaly_tables():
+    try:
+        with get_cursor() as cur:
+            create_vote_anomalies_table(cur)
+        return True
+    except Exception as e:
+        print(f"Error creating vote_anomalies table: {e}")
+        return False
+
+create_anomaly_tables()
+
+# Clusters of votes sharing an IP, fingerprint or network, rebuilt incrementally
+CLUSTER_INTERVAL = int(os.environ.get('CLUSTER_INTERVAL', 60))  # Seconds, 0 disables
+
+def start_vote_clusterer():
+    try:
+        with get_cursor() as cur:
+            create_geolocation_prefix_schema(cur)
+            create_vote_clusters_table(cur)
+    except Exception as e:
+        print(f"Error creating vote_clusters table: {e}")
+    # Every worker starts one; only the worker holding the lock computes
+    clusterer = VoteClusterer(
+        transaction,
+        connection,
+        window=int(os.environ.get('CLUSTER_WINDOW', 3600)),
+        retention=int(os.environ.get('CLUSTER_RETENTION', 86400)),
+        min_votes=int(os.environ.get('CLUSTER_MIN_VOTES', 5)),
+        interval=CLUSTER_INTERVAL
+    )
+    clusterer.start()
+    return clusterer
+
+vote_clusterer = start_vote_clusterer() if CLUSTER_INTERVAL > 0 else None
+
+# Full recount of judge_vote_tallies from votes. It scans every vote, so it
+# runs here rather than in each main app worker, and rarely
+TALLY_RECONCILE_INTERVAL = int(os.environ.get('TALLY_RECONCILE_INTERVAL', 3600))  # Seconds, 0 disables
+
+def reconcile_tallies():
+    """Repair drift between judge_vote_tallies and votes in one transaction."""
+    with transaction() as cur:
+        return reconcile_judge_vote_tallies(cur)
+
+def run_tally_reconciler():
+    # The first pass also fills the table when it was just created
+    while True:
+        try:
+            repaired = reconcile_tallies()
+            if repaired:
+                print(f"Repaired {repaired} drifted judge vote tally rows")
+        except Exception as e:
+            print(f"Error reconciling judge vote tallies: {e}")
+        time.sleep(TALLY_RECONCILE_INTERVAL)
+
+def start_tally_reconciler():
+    try:
+        with get_cursor() as cur:
+            create_vote_schema(cur)
+    except Exception as e:
+        print(f"Error creating vote schema: {e}")
+    threading.Thread(target=run_tally_reconciler, name='tally-reconciler', daemon=True).start()
+
+if TALLY_RECONCILE_INTERVAL > 0:
+    start_tally_reconciler()
+
+# Background jobs queued by the main app, e.g. geolocating new voter IPs
+JOB_WORKER_CONCURRENCY = int(os.environ.get('JOB_WORKER_CONCURRENCY', 2))  # Threads, 0 disables
+JOB_FAILED_RETENTION = int(os.environ.get('JOB_FAILED_RETENTION', 7 * 86400))  # Seconds failed jobs are kept, 0 keeps them forever
+
+def start_job_runner():
+    try:
+        with get_cursor() as cur:
+            create_geolocation_prefix_schema(cur)
+            create_jobs_table(cur)
+    except Exception as e:
+        print(f"Error creating jobs table: {e}")
+    runner = JobRunner({'geolocate': run_geolocation_job}, get_cursor, concurrency=JOB_WORKER_CONCURRENCY,
+                       failed_retention=JOB_FAILED_RETENTION)
+    runner.start()
+    return runner
+
+job_runner = start_job_runner() if JOB_WORKER_CONCURRENCY > 0 else None
+
 # Hash password function
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
@@ -935,17 +1056,13 @@ def verify_password(stored_hash, password):
 @app.route('/admin/users')
 @admin_required
 def admin_users():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
         # Get all admin users
-        cursor.execute('''
+        users = query_db('''
             SELECT id, username, email, role, is_active, last_login
             FROM admin_users
             ORDER BY username
         ''')
-        users = cursor.fetchall()
         
         # Format users for display
         formatted_users = []
@@ -964,9 +1081,6 @@ def admin_users():
         print(f"Error fetching admin users: {e}")
         formatted_users = []
         edit_user = None
-    finally:
-        cursor.close()
-        conn.close()
     
     # Log the action
     log_admin_action('view', f'Viewed admin users list')
@@ -979,35 +1093,21 @@ def admin_users():
 @app.route('/admin/users/get/<int:user_id>')
 @admin_required
 def get_admin_user(user_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    
     try:
         # Get user data
-        cursor.execute('''
+        user = query_db('''
             SELECT id, username, email, role, is_active
             FROM admin_users
             WHERE id = %s
-        ''', (user_id,))
-        user = cursor.fetchone()
+        ''', (user_id,), one=True)
         
         if user:
-            user_data = {
-                'id': user[0],
-                'username': user[1],
-                'email': user[2],
-                'role': user[3],
-                'is_active': user[4]
-            }
-            return jsonify(user_data)
+            return jsonify(user)
         else:
             return jsonify({'error': 'User not found'}), 404
     except Exception as e:
         print(f"Error fetching admin user: {e}")
         return jsonify({'error': str(e)}), 500
-    finally:
-        cursor.close()
-        conn.close()
 
 @app.route('/admin/users/add', methods=['POST'])
 @admin_required
@@ -1028,15 +1128,10 @@ def add_admin_user():
     
     try:
         # Insert new user
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        query_db('''
             INSERT INTO admin_users (username, password_hash, email, role)
             VALUES (%s, %s, %s, %s)
         ''', (username, password_hash, email, role))
-        conn.commit()
-        cursor.close()
-        conn.close()
         
         # Log the action
         log_admin_action('add', f'Added new admin user: {username}')
@@ -1068,30 +1163,23 @@ def update_admin_user(user_id):
         return redirect('/admin/users')
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
         # Update user with or without password
         if password:
             # Hash new password
             password_hash = hash_password(password)
-            cursor.execute('''
+            query_db('''
                 UPDATE admin_users
                 SET username = %s, password_hash = %s, email = %s, role = %s, is_active = %s
                 WHERE id = %s
             ''', (username, password_hash, email, role, is_active, user_id))
         else:
             # Update without changing password
-            cursor.execute('''
+            query_db('''
                 UPDATE admin_users
                 SET username = %s, email = %s, role = %s, is_active = %s
                 WHERE id = %s
             ''', (username, email, role, is_active, user_id))
         
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
         # Log the action
         log_admin_action('update', f'Updated admin user: {username}')
         
@@ -1114,12 +1202,7 @@ def activate_admin_user(user_id):
         username = user[0] if isinstance(user, tuple) else user['username']
         
         # Activate user
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE admin_users SET is_active = TRUE WHERE id = %s', (user_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        query_db('UPDATE admin_users SET is_active = TRUE WHERE id = %s', (user_id,))
         
         # Log the action
         log_admin_action('update', f'Activated admin user: {username}')
@@ -1143,12 +1226,7 @@ def deactivate_admin_user(user_id):
         username = user[0] if isinstance(user, tuple) else user['username']
         
         # Deactivate user
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('UPDATE admin_users SET is_active = FALSE WHERE id = %s', (user_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        query_db('UPDATE admin_users SET is_active = FALSE WHERE id = %s', (user_id,))
         
         # Log the action
         log_admin_action('update', f'Deactivated admin user: {username}')
@@ -1172,12 +1250,7 @@ def delete_admin_user(user_id):
         username = user[0] if isinstance(user, tuple) else user['username']
         
         # Delete user
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('DELETE FROM admin_users WHERE id = %s', (user_id,))
-        conn.commit()
-        cursor.close()
-        conn.close()
+        query_db('DELETE FROM admin_users WHERE id = %s', (user_id,))
         
         # Log the action
         log_admin_action('delete', f'Deleted admin user: {username}')
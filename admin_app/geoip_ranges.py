@@ -0,0 +1,210 @@
+"""
+Offline IP-range geolocation database.
+
+An IP-range CSV is compiled once into a compact binary file: sorted arrays
+of range starts and ends (32-bit for IPv4, 128-bit for IPv6), a location
+index per range, and a table of distinct locations. The file is
+memory-mapped, so every worker process shares one copy in the page cache,
+and a lookup is a binary search over the start array.
+
+Build a database from a CSV with the columns ip_start, ip_end,
+country_code, region, city, latitude, longitude (and optionally
+country_name); addresses may be dotted/colon notation or integers:
+
+    python admin_app/geoip_ranges.py ranges.csv geoip_ranges.bin
+"""
+import csv
+import ipaddress
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from bisect import bisect_right
+
+MAGIC = b'JAIGEO01'
+# magic, byte order, IPv4 ranges, IPv6 ranges, locations, string blob size
+HEADER = struct.Struct('<8sBxxxIIII')
+# country_code, country_name, region and city as string offsets, then lat/long
+LOCATION = struct.Struct('<IIIIff')
+BYTE_ORDER = 1 if sys.byteorder == 'little' else 2
+
+
+def _address(value):
+    value = value.strip()
+    if value.isdigit():
+        number = int(value)
+        return ipaddress.ip_address(number) if number < 2 ** 32 else ipaddress.IPv6Address(number)
+    return ipaddress.ip_address(value)
+
+
+def _padded(size):
+    # Sections start on 8-byte boundaries
+    return size + (-size % 8)
+
+
+def _pad(data):
+    return data + b'\0' * (_padded(len(data)) - len(data))
+
+
+def build_range_database(csv_path, output_path):
+    """Compile an IP-range CSV into the binary format. Returns the range count."""
+    v4, v6 = [], []
+    locations = {}
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        for row in csv.DictReader(f):
+            start, end = _address(row['ip_start']), _address(row['ip_end'])
+            if start.version != end.version or int(start) > int(end):
+                raise ValueError(f"Invalid range {row['ip_start']} - {row['ip_end']}")
+            location = (row.get('country_code') or '', row.get('country_name') or '',
+                        row.get('region') or '', row.get('city') or '',
+                        float(row.get('latitude') or 0), float(row.get('longitude') or 0))
+            index = locations.setdefault(location, len(locations))
+            (v4 if start.version == 4 else v6).append((int(start), int(end), index))
+
+    for ranges in (v4, v6):
+        ranges.sort()
+        for previous, current in zip(ranges, ranges[1:]):
+            if current[0] <= previous[1]:
+                raise ValueError('Overlapping ranges starting at %s and %s' % (
+                    ipaddress.ip_address(previous[0]), ipaddress.ip_address(current[0])))
+
+    strings = bytearray()
+    string_offsets = {}
+
+    def string_offset(value):
+        if value not in string_offsets:
+            data = value.encode('utf-8')
+            string_offsets[value] = len(strings)
+            strings.extend(struct.pack('<H', len(data)) + data)
+        return string_offsets[value]
+
+    location_table = bytearray()
+    for country_code, country_name, region, city, latitude, longitude in locations:
+        location_table += LOCATION.pack(string_offset(country_code), string_offset(country_name),
+                                        string_offset(region), string_offset(city), latitude, longitude)
+
+    v6_words, v6_end_words = [], []
+    for start, end, _ in v6:
+        v6_words += [start >> 64, start & 0xFFFFFFFFFFFFFFFF]
+        v6_end_words += [end >> 64, end & 0xFFFFFFFFFFFFFFFF]
+
+    sections = [
+        array('I', [r[0] for r in v4]), array('I', [r[1] for r in v4]), array('I', [r[2] for r in v4]),
+        array('Q', v6_words), array('Q', v6_end_words), array('I', [r[2] for r in v6]),
+    ]
+    tmp_path = output_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_pad(HEADER.pack(MAGIC, BYTE_ORDER, len(v4), len(v6), len(locations), len(strings))))
+        for section in sections:
+            f.write(_pad(section.tobytes()))
+        f.write(_pad(bytes(location_table)))
+        f.write(bytes(strings))
+    os.replace(tmp_path, output_path)
+    return len(v4) + len(v6)
+
+
+class _Uint128Array:
+    """Read-only sequence of 128-bit integers stored as (high, low) word pairs."""
+
+    def __init__(self, words):
+        self.words = words
+
+    def __len__(self):
+        return len(self.words) // 2
+
+    def __getitem__(self, i):
+        return (self.words[2 * i] << 64) | self.words[2 * i + 1]
+
+
+class RangeDatabase:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._mm) < HEADER.size:
+            raise ValueError(f"{path} is not a range database")
+        magic, byte_order, v4_count, v6_count, location_count, strings_size = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or byte_order != BYTE_ORDER:
+            raise ValueError(f"{path} is not a range database built for this platform")
+        size = (_padded(HEADER.size) + 3 * _padded(v4_count * 4) + 2 * _padded(v6_count * 16)
+                + _padded(v6_count * 4) + _padded(location_count * LOCATION.size) + strings_size)
+        if len(self._mm) < size:
+            raise ValueError(f"{path} is truncated")
+        view = memoryview(self._mm)
+        offset = _padded(HEADER.size)
+
+        def section(count, item_size, fmt):
+            nonlocal offset
+            data = view[offset:offset + count * item_size].cast(fmt)
+            offset += _padded(count * item_size)
+            return data
+
+        self._v4_starts = section(v4_count, 4, 'I')
+        self._v4_ends = section(v4_count, 4, 'I')
+        self._v4_locations = section(v4_count, 4, 'I')
+        self._v6_starts = _Uint128Array(section(v6_count * 2, 8, 'Q'))
+        self._v6_ends = _Uint128Array(section(v6_count * 2, 8, 'Q'))
+        self._v6_locations = section(v6_count, 4, 'I')
+        self._locations_offset = offset
+        self._strings_offset = offset + _padded(location_count * LOCATION.size)
+        self.range_count = v4_count + v6_count
+
+    def lookup(self, ip_address):
+        """Return the location of ip_address as a dict, or None when no range covers it."""
+        try:
+            address = ipaddress.ip_address(ip_address)
+        except ValueError:
+            return None
+        if address.version == 4:
+            starts, ends, locations = self._v4_starts, self._v4_ends, self._v4_locations
+        else:
+            starts, ends, locations = self._v6_starts, self._v6_ends, self._v6_locations
+        number = int(address)
+        i = bisect_right(starts, number) - 1
+        if i < 0 or ends[i] < number:
+            return None
+        country_code, country_name, region, city, latitude, longitude = LOCATION.unpack_from(
+            self._mm, self._locations_offset + locations[i] * LOCATION.size)
+        return {
+            'country_code2': self._string(country_code) or None,
+            'country_name': self._string(country_name) or None,
+            'state_prov': self._string(region) or None,
+            'city': self._string(city) or None,
+            'latitude': '%.4f' % latitude,
+            'longitude': '%.4f' % longitude
+        }
+
+    def _string(self, offset):
+        start = self._strings_offset + offset
+        length = struct.unpack_from('<H', self._mm, start)[0]
+        return self._mm[start + 2:start + 2 + length].decode('utf-8')
+
+
+_database = None
+_database_lock = threading.Lock()
+
+
+def get_range_database():
+    """Return the database at GEOIP_RANGES_PATH, or None when none is configured."""
+    global _database
+    path = os.getenv('GEOIP_RANGES_PATH')
+    if not path:
+        return None
+    if _database is None:
+        with _database_lock:
+            if _database is None:
+                try:
+                    _database = RangeDatabase(path)
+                except (OSError, ValueError) as e:
+                    print(f"Error opening IP range database {path}: {e}")
+                    _database = False  # Do not retry on every lookup
+    return _database or None
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print(f"Usage: {sys.argv[0]} <ranges.csv> <output.bin>")
+        sys.exit(1)
+    count = build_range_database(sys.argv[1], sys.argv[2])
+    print(f"Wrote {count} ranges to {sys.argv[2]}")
@@ -1,36 +1,118 @@
 import os
+import sys
+import threading
+import time
 import requests
-from datetime import datetime
-import psycopg2
-import psycopg2.extras
-from psycopg2.extras import RealDictCursor
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import subprocess
 
+# Shared modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from db import query_db, get_cursor
+from geoip_ranges import get_range_database
+from geolocation_prefixes import PREFIX_COLUMNS, ip_prefix, record_prefix_sample
+from tallies import locate_votes
+
 # Load environment variables from .env.local
 load_dotenv('.env.local')
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST', 'localhost'),
-        port=os.environ.get('DB_PORT', '5432'),
-        dbname=os.environ.get('DB_NAME', 'jai_db'),
-        user=os.environ.get('DB_USER', 'jai'),
-        password=os.environ.get('DB_PASSWORD', '')
-    )
-    conn.autocommit = True
-    return conn
-
-def query_db(query, args=(), one=False, commit=True):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor if one else None)
-    cur.execute(query, args)
-    if commit:
-        conn.commit()
-    rv = cur.fetchall()
-    cur.close()
-    conn.close()
-    return (dict(rv[0]) if rv else None) if one else rv
+# Rows older than this are refreshed from the API on their next lookup
+GEOLOCATION_MAX_AGE = int(os.getenv('GEOLOCATION_MAX_AGE', 30 * 86400))  # Seconds
+GEOLOCATION_CACHE_SIZE = int(os.getenv('GEOLOCATION_CACHE_SIZE', 10000))  # Entries
+GEOLOCATION_CACHE_TTL = int(os.getenv('GEOLOCATION_CACHE_TTL', 3600))  # Seconds
+# How long a failed lookup, or an address we cannot look up, is remembered
+GEOLOCATION_FAILURE_TTL = int(os.getenv('GEOLOCATION_FAILURE_TTL', 600))
+GEOLOCATION_UNSUPPORTED_TTL = 86400
+# 'ip' stores a row per address; 'prefix' resolves addresses by /24 or /48
+# and also covers IPv6. Prefixes are trusted after this many agreeing lookups.
+GEOLOCATION_GRANULARITY = os.getenv('GEOLOCATION_GRANULARITY', 'ip')
+GEOLOCATION_PREFIX_SAMPLES = int(os.getenv('GEOLOCATION_PREFIX_SAMPLES', 3))
+
+# Columns of ip_geolocation that a lookup can fill
+LOCATION_COLUMNS = [
+    'hostname', 'continent_code', 'continent_name', 'country_code2', 'country_code3',
+    'country_name', 'country_capital', 'state_prov', 'state_code', 'city', 'zipcode',
+    'latitude', 'longitude', 'is_eu', 'country_flag', 'country_emoji', 'isp',
+    'organization', 'timezone_name', 'timezone_offset', 'currency_code', 'currency_symbol'
+]
+
+# One pooled HTTP session for API lookups. Bulk callers may set api_throttle
+# to a function that blocks until the next API request is allowed.
+api_session = requests.Session()
+api_throttle = None
+
+class GeolocationCache:
+    """
+    In-process LRU of geolocation rows in front of the ip_geolocation table.
+
+    Rows stay until GEOLOCATION_CACHE_TTL passes or the row reaches
+    GEOLOCATION_MAX_AGE, whichever comes first. Failed and unsupported
+    lookups are cached as None for a shorter time so they are not retried
+    on every call.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # ip -> (row or None, expires at)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, ip_address):
+        """Return (True, row or None) on a hit, (False, None) on a miss."""
+        with self._lock:
+            entry = self._entries.get(ip_address)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(ip_address)
+                if entry[0] is None:
+                    self.negative_hits += 1
+                else:
+                    self.hits += 1
+                return True, entry[0]
+            if entry is not None:
+                del self._entries[ip_address]
+            self.misses += 1
+            return False, None
+
+    def put(self, ip_address, row, ttl):
+        with self._lock:
+            self._entries[ip_address] = (row, time.monotonic() + ttl)
+            self._entries.move_to_end(ip_address)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0
+            }
+
+geolocation_cache = GeolocationCache(GEOLOCATION_CACHE_SIZE)
+
+def row_ttl(row):
+    """Seconds a row may stay cached in-process, based on its last_updated."""
+    last_updated = row.get('last_updated')
+    if last_updated is None:
+        return GEOLOCATION_CACHE_TTL
+    remaining = (last_updated + timedelta(seconds=GEOLOCATION_MAX_AGE) - datetime.now()).total_seconds()
+    # Stale rows are kept briefly so a failing refresh is not retried on every call
+    return max(GEOLOCATION_FAILURE_TTL, min(GEOLOCATION_CACHE_TTL, remaining))
+
+def is_stale(row):
+    last_updated = row.get('last_updated')
+    return last_updated is not None and datetime.now() - last_updated > timedelta(seconds=GEOLOCATION_MAX_AGE)
 
 def get_external_ip():
     """
@@ -55,26 +137,46 @@ def is_ipv4(ip):
     """
     return ':' not in ip
 
-def get_ip_geolocation(ip_address):
+def is_supported(ip):
+    return is_ipv4(ip) or GEOLOCATION_GRANULARITY == 'prefix'
+
+def get_ip_geolocation(ip_address, retry_failed=False):
     """
     Get geolocation data for an IP address, using cached data if available
     or fetching from the API if not.
+
+    Lookups go through the in-process cache, then the ip_geolocation table
+    (and ip_geolocation_prefixes, by prefix), the offline range database
+    and finally the API. With retry_failed a cached failure is ignored, for
+    callers that space out their own retries.
     """
-    # Skip IPv6 addresses
-    if not is_ipv4(ip_address):
+    hit, row = geolocation_cache.get(ip_address)
+    if hit and (row is not None or not retry_failed):
+        return dict(row) if row is not None else None
+
+    # Skip IPv6 addresses unless lookups go by prefix
+    if not is_supported(ip_address):
+        geolocation_cache.put(ip_address, None, GEOLOCATION_UNSUPPORTED_TTL)
+        return None
+
+    if GEOLOCATION_GRANULARITY == 'prefix':
+        row = fetch_prefix_geolocation(ip_address)
+    else:
+        row = fetch_ip_geolocation(ip_address)
+    if row is None:
+        geolocation_cache.put(ip_address, None, GEOLOCATION_FAILURE_TTL)
         return None
+    row = dict(row)
+    geolocation_cache.put(ip_address, row, row_ttl(row))
+    return dict(row)
 
+def fetch_ip_geolocation(ip_address):
+    """Look an IPv4 address up in the table, the range database or the API."""
     # Easter egg: Make localhost/127.0.0.1 show up as Antarctica
     if ip_address in ['127.0.0.1', 'localhost']:
+        ip_address = '127.0.0.1'  # ip_address columns are inet
         # Insert Antarctica data into the database if it doesn't exist
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Check if entry exists
-        cur.execute('SELECT id FROM ip_geolocation WHERE ip_address = %s', (ip_address,))
-        exists = cur.fetchone()
-        
-        if exists is None:
+        with get_cursor() as cur:
             # Insert Antarctica data - let PostgreSQL handle the ID auto-increment
             cur.execute('''
                 INSERT INTO ip_geolocation (
@@ -85,6 +187,7 @@ def get_ip_geolocation(ip_address):
                     isp, organization, timezone_name, timezone_offset,
                     currency_code, currency_symbol
                 ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (ip_address) DO NOTHING
             ''', (
                 ip_address, 'penguin.antarctica.local', 'AN', 'Antarctica',
                 'AQ', 'ATA', 'Antarctica', 'Amundsen-Scott Station',
@@ -93,31 +196,86 @@ def get_ip_geolocation(ip_address):
                 'Antarctic Network Services', 'Penguin Research Institute', 'Antarctica/South_Pole', '0',
                 'USD', '$'
             ))
-            conn.commit()
-        
-        cur.close()
-        conn.close()
-        
+
         # Return the data from the database
-        result = query_db('SELECT * FROM ip_geolocation WHERE ip_address = %s', 
-                       (ip_address,), one=True)
-        
-        # Ensure we return a proper dictionary
-        if result is not None:
-            # Convert to a standard dictionary if it's not already
-            return dict(result) if hasattr(result, 'keys') else result
-        return None
+        return query_db('SELECT * FROM ip_geolocation WHERE ip_address = %s', (ip_address,), one=True)
 
-    # Check cache first
+    # Check the table first; stale rows are refreshed but kept as a fallback
     cached = query_db('''
         SELECT * FROM ip_geolocation 
         WHERE ip_address = %s
     ''', (ip_address,), one=True)
     
-    if cached:
+    if cached and not is_stale(cached):
+        return cached
+
+    try:
+        location = lookup_location(ip_address)
+    except ValueError:
+        if cached:
+            return cached
+        raise
+    if location is None:
         return cached
+    return store_ip_geolocation(ip_address, location)
 
-    # If not in cache, fetch from API
+def fetch_prefix_geolocation(ip_address):
+    """
+    Look an address up by its network prefix. The address gets its own row
+    only when its prefix turned out to be ambiguous.
+    """
+    if ip_prefix(ip_address) is None or ip_address == '127.0.0.1':
+        return fetch_ip_geolocation(ip_address)
+
+    cached = query_db('SELECT * FROM ip_geolocation WHERE ip_address = %s', (ip_address,), one=True)
+    if cached and not is_stale(cached):
+        return cached
+
+    entry = query_db('''
+        SELECT * FROM ip_geolocation_prefixes
+        WHERE prefix = %s
+    ''', (ip_prefix(ip_address),), one=True)
+    if entry and entry['verified'] and not is_stale(entry):
+        return prefix_row(entry, ip_address)
+
+    # Unknown, unverified or stale prefix: this lookup is another sample
+    try:
+        location = lookup_location(ip_address)
+    except ValueError:
+        if cached or entry:
+            location = None
+        else:
+            raise
+    if location is None:
+        if cached:
+            return cached
+        return prefix_row(entry, ip_address) if entry and entry['verified'] else None
+    with get_cursor(dict_cursor=True) as cur:
+        entry = record_prefix_sample(cur, ip_address, location, GEOLOCATION_PREFIX_SAMPLES,
+                                     GEOLOCATION_MAX_AGE)
+    if entry['ambiguous']:
+        return store_ip_geolocation(ip_address, location)
+    return prefix_row(entry, ip_address)
+
+def prefix_row(entry, ip_address):
+    """Shape a prefix entry like an ip_geolocation row for ip_address."""
+    row = {column: entry[column] for column in PREFIX_COLUMNS}
+    row.update(ip_address=ip_address, prefix=entry['prefix'], verified=entry['verified'],
+               last_updated=entry['last_updated'])
+    return row
+
+def lookup_location(ip_address):
+    """
+    Find an address in the offline range database or, failing that, the
+    API. Returns a dict of ip_geolocation columns, or None when the API
+    request failed.
+    """
+    ranges = get_range_database()
+    location = ranges.lookup(ip_address) if ranges is not None else None
+    if location is not None:
+        return location
+
+    # If not in the range database, fetch from API
     api_key = os.getenv('IPGEOLOCATION_API_KEY')
     if not api_key:
         raise ValueError("IPGEOLOCATION_API_KEY not found in environment variables")
@@ -129,60 +287,79 @@ def get_ip_geolocation(ip_address):
     }
 
     try:
-        response = requests.get(url, params=params)
+        if api_throttle is not None:
+            api_throttle()
+        response = api_session.get(url, params=params, timeout=10)
         response.raise_for_status()  # Raise exception for non-200 status codes
         data = response.json()
-
-        # Insert into database
-        query_db('''
-            INSERT INTO ip_geolocation (
-                ip_address, hostname, continent_code, continent_name,
-                country_code2, country_code3, country_name, country_capital,
-                state_prov, state_code, city, zipcode, latitude, longitude,
-                is_eu, country_flag, country_emoji,
-                isp, organization, timezone_name, timezone_offset,
-                currency_code, currency_symbol
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (
-            data.get('ip'),
-            data.get('hostname'),
-            data.get('continent_code'),
-            data.get('continent_name'),
-            data.get('country_code2'),
-            data.get('country_code3'),
-            data.get('country_name'),
-            data.get('country_capital'),
-            data.get('state_prov'),
-            data.get('state_code'),
-            data.get('city'),
-            data.get('zipcode'),
-            data.get('latitude'),
-            data.get('longitude'),
-            data.get('is_eu'),
-            data.get('country_flag'),
-            data.get('country_emoji'),
-            data.get('isp'),
-            data.get('organization'),
-            data.get('time_zone', {}).get('name'),
-            data.get('time_zone', {}).get('offset'),
-            data.get('currency', {}).get('code'),
-            data.get('currency', {}).get('symbol')
-        ))
-
-        # Return the geolocation data
-        result = query_db('SELECT * FROM ip_geolocation WHERE ip_address = %s', 
-                       (ip_address,), one=True)
-        
-        # Ensure we return a proper dictionary
-        if result is not None:
-            # Convert to a standard dictionary if it's not already
-            return dict(result) if hasattr(result, 'keys') else result
-        return None
-    
     except Exception as e:
         print(f"Error fetching geolocation data for IP {ip_address}: {str(e)}")
         return None
 
+    return {
+        'hostname': data.get('hostname'),
+        'continent_code': data.get('continent_code'),
+        'continent_name': data.get('continent_name'),
+        'country_code2': data.get('country_code2'),
+        'country_code3': data.get('country_code3'),
+        'country_name': data.get('country_name'),
+        'country_capital': data.get('country_capital'),
+        'state_prov': data.get('state_prov'),
+        'state_code': data.get('state_code'),
+        'city': data.get('city'),
+        'zipcode': data.get('zipcode'),
+        'latitude': data.get('latitude'),
+        'longitude': data.get('longitude'),
+        'is_eu': data.get('is_eu'),
+        'country_flag': data.get('country_flag'),
+        'country_emoji': data.get('country_emoji'),
+        'isp': data.get('isp'),
+        'organization': data.get('organization'),
+        'timezone_name': data.get('time_zone', {}).get('name'),
+        'timezone_offset': data.get('time_zone', {}).get('offset'),
+        'currency_code': data.get('currency', {}).get('code'),
+        'currency_symbol': data.get('currency', {}).get('symbol')
+    }
+
+def store_ip_geolocation(ip_address, location):
+    """Insert or refresh the row for ip_address and return it."""
+    columns = [column for column in LOCATION_COLUMNS if column in location]
+    return query_db(f'''
+        INSERT INTO ip_geolocation (ip_address, {', '.join(columns)})
+        VALUES (%s, {', '.join(['%s'] * len(columns))})
+        ON CONFLICT (ip_address) DO UPDATE SET
+            {', '.join(f'{column} = EXCLUDED.{column}' for column in columns)},
+            last_updated = CURRENT_TIMESTAMP
+        RETURNING *
+    ''', [ip_address] + [location[column] for column in columns], one=True)
+
+def run_geolocation_job(payload):
+    """
+    Handler for 'geolocate' jobs. Raises when the lookup failed so the job
+    is retried later.
+    """
+    ip_address = payload['ip_address']
+    if not is_supported(ip_address):
+        # Not supported yet; retrying would not help
+        return
+    # JobRunner backs off between attempts, so each one goes back to the API
+    # instead of finding the previous attempt's failure in the cache
+    row = get_ip_geolocation(ip_address, retry_failed=True)
+    if row is None:
+        raise RuntimeError(f"Geolocation lookup failed for {ip_address}")
+    locate_ip_votes(ip_address, row)
+
+def locate_ip_votes(ip_address, row):
+    """
+    Copy a lookup's country onto the votes stored without one. A row that
+    came from a verified prefix covers the votes of every address in it;
+    one sample of an unverified prefix only speaks for its own address.
+    """
+    if row.get('country_code2'):
+        network = row['prefix'] if row.get('verified') else ip_address
+        with get_cursor() as cur:
+            locate_votes(cur, network, row['country_code2'])
+
 def format_geolocation_data(geo_data):
     """
     Format geolocation data into a human-readable string
@@ -1,30 +1,62 @@
-from flask import Flask, jsonify, render_template, request, redirect, url_for, send_from_directory, session
+from flask import Flask, Response, jsonify, render_template, request, redirect, url_for, send_from_directory, session
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-import psycopg2
-import psycopg2.extras
-from psycopg2.extras import RealDictCursor
 from flask_cors import CORS
-import secrets
 import hmac
+import ipaddress
 import hashlib
 import time
+import threading
+import atexit
+import uuid
+import psycopg2
 from dotenv import load_dotenv
 from flask_caching import Cache  # Import Flask-Caching
+from db import query_db, get_cursor, transaction
+from vote_buffer import VoteBuffer
+from judges_snapshot import JudgesSnapshot, SnapshotStore
+from live_updates import TallyBroadcaster
+from reference_data import (ReferenceCache, create_reference_data_schema, reference_version,
+                            load_ip_whitelist, load_displayed_judge_ids)
+from proof_of_work import (ChallengeIssuer, SeenChallenges, DifficultyController, DifficultyPolicy,
+                           default_seen_path)
+from jobs import create_jobs_table, enqueue_geolocation, geolocation_families
+from hmac_keys import HmacKeyRing, create_hmac_keys_table, load_hmac_keys, rotate_hmac_keys
+from rate_limit import RateLimiter, RateLimitPolicy, default_state_path
+from vote_anomalies import (AnomalyDetector, create_vote_anomalies_table, default_sketch_path,
+                            prune_vote_anomalies, record_vote_anomalies)
+from tallies import (fetch_judge_tallies, record_votes, create_vote_schema, current_tally_version,
+                     fetch_judge_changes)
 
 # Load environment variables from .env.local
 load_dotenv('.env.local')
 
 app = Flask(__name__)
 app.config['TEMPLATES_AUTO_RELOAD'] = True
-# !!! IMPORTANT !!!  Move this to an environment variable in production.
-app.config['HMAC_SECRET_KEY'] = secrets.token_hex(32)  # Generate a 64-character hex key
-app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'your_secret_key') # TODO consider removing, not used in main app
+app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET_KEY', 'your_secret_key')
 
 # Flask-Caching configuration
-# Use SimpleCache for development, switch to Redis/Memcached in production
-cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache'})  # TODO: Configure for Redis in production
+# Entries are shared by all worker processes on this host
+cache = Cache(app, config={
+    'CACHE_TYPE': 'shared_cache.SharedMemoryCache',
+    'CACHE_SHARED_PATH': os.environ.get('CACHE_SHARED_PATH'),
+    'CACHE_SHARED_MAX_BYTES': int(os.environ.get('CACHE_SHARED_MAX_BYTES', 64 * 1024 * 1024)),
+    'CACHE_DEFAULT_TIMEOUT': 300
+})
+
+# Rate limits, enforced in shared memory before any database work
+rate_limiter = RateLimiter([
+    RateLimitPolicy('submit_judge', key='ip', limit=1, window=600),  # 1 submission per 10 minutes
+    RateLimitPolicy('vote', key='ip', limit=30, window=60),
+    RateLimitPolicy('vote_fingerprint', key='fingerprint', limit=200, window=3600),
+    # Mirrors the database's once-per-day rule (UTC days) so repeat votes are turned away early
+    RateLimitPolicy('vote_judge', key='ip_judge', limit=1, window=86400, sliding=False),
+    # Failed proofs of work and rate limit hits; each one raises the IP's difficulty
+    RateLimitPolicy('pow_strikes', key='ip', limit=1000, window=3600),
+], path=os.environ.get('RATE_LIMIT_PATH') or default_state_path('jai_' + os.path.basename(app.root_path)),
+   persist_path=os.environ.get('RATE_LIMIT_STATE_PATH', os.path.join(app.root_path, 'rate_limits.state')),
+   persist_interval=float(os.environ.get('RATE_LIMIT_PERSIST_INTERVAL', 60)))
 
 # Removed session config: not needed for the main app
 # app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=24)
@@ -39,71 +71,142 @@ def favicon():
     return send_from_directory(os.path.join(app.root_path, 'static'),
                              'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST', 'localhost'),
-        port=os.environ.get('DB_PORT', '5432'),
-        dbname=os.environ.get('DB_NAME', 'jai_db'),
-        user=os.environ.get('DB_USER', 'jai'),
-        password=os.environ.get('DB_PASSWORD', '')
-    )
-    conn.autocommit = True
-    return conn
-
-def query_db(query, args=(), one=False, commit=True):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor if one else None)
-    cur.execute(query, args)
-    if commit:
-        conn.commit()
-    rv = cur.fetchall()
-    cur.close()
-    conn.close()
-    return (dict(rv[0]) if rv else None) if one else rv
-
 def get_client_ip():
     """Retrieves the client's IP address, accounting for Cloudflare proxy."""
     if 'CF-Connecting-IP' in request.headers:
-        return request.headers.get('CF-Connecting-IP')
-    else:
-        return request.remote_addr
+        # IPs are stored as inet, so a malformed header must not reach the database
+        try:
+            return str(ipaddress.ip_address(request.headers.get('CF-Connecting-IP').strip()))
+        except ValueError:
+            pass
+    return request.remote_addr
+
+# browser_fingerprint is VARCHAR(255)
+FINGERPRINT_MAX_LENGTH = 255
+
+def normalize_fingerprint(fingerprint):
+    """Return the client's fingerprint as a string that fits the column, or None."""
+    if not isinstance(fingerprint, str):
+        return None
+    return fingerprint.strip()[:FINGERPRINT_MAX_LENGTH] or None
+
+# In-memory copies of the whitelist and the displayed judges, reloaded when
+# their version in reference_data_versions moves
+REFERENCE_DATA_CHECK_INTERVAL = float(os.environ.get('REFERENCE_DATA_CHECK_INTERVAL', 5.0))
+
+def load_reference(load, *args):
+    with get_cursor() as cur:
+        return load(cur, *args)
+
+ip_whitelist_cache = ReferenceCache(
+    lambda: load_reference(reference_version, 'ip_whitelist'),
+    lambda: load_reference(load_ip_whitelist),
+    check_interval=REFERENCE_DATA_CHECK_INTERVAL
+)
+displayed_judges_cache = ReferenceCache(
+    lambda: load_reference(reference_version, 'judges'),
+    lambda: load_reference(load_displayed_judge_ids),
+    check_interval=REFERENCE_DATA_CHECK_INTERVAL
+)
 
 def is_ip_whitelisted(ip_address):
-    result = query_db('''
-        SELECT * FROM ip_whitelist 
-        WHERE ip_address = %s AND expiry > %s
-    ''', (ip_address, datetime.now().isoformat()), one=True)
-    return bool(result)
+    # Entries expire on their own, without a version bump
+    expiry = ip_whitelist_cache.get().get(ip_address)
+    return expiry is not None and expiry > datetime.now()
+
+def is_judge_displayed(judge_id):
+    return judge_id in displayed_judges_cache.get()
 
 def check_rate_limit(ip_address):
-    # Always allow localhost for testing and whitelisted IPs
-    if ip_address == '127.0.0.1' or is_ip_whitelisted(ip_address):
+    # Always allow localhost for testing and whitelisted IPs; the whitelist
+    # is only looked up for IPs that are over the limit
+    if ip_address == '127.0.0.1':
         return True
+    return rate_limiter.allowed('submit_judge', ip=ip_address) or is_ip_whitelisted(ip_address)
+
+def check_vote_rate_limit(ip_address, judge_id, fingerprint):
+    """Return an error message when the vote is over a rate limit, else None."""
+    if not rate_limiter.hit('vote', ip=ip_address) or not rate_limiter.hit('vote_fingerprint', fingerprint=fingerprint):
+        error = 'Too many votes, please slow down'
+    elif not rate_limiter.allowed('vote_judge', ip=ip_address, judge_id=judge_id):
+        error = 'You can only vote once per judge per day'
+    else:
+        return None
+    return None if is_ip_whitelisted(ip_address) else error
+
+# Proof-of-work challenges, bound to the action, the time and the client IP.
+# The secret must be the same on every worker and node, and must not be
+# guessable: anyone holding it can sign challenges that need no work.
+POW_SECRET_KEY = os.environ.get('POW_SECRET_KEY')
+if not POW_SECRET_KEY:
+    raise RuntimeError('POW_SECRET_KEY must be set')
+POW_DIFFICULTY_BITS = int(os.environ.get('POW_DIFFICULTY_BITS', 16))  # Leading zero bits
+POW_MAX_DIFFICULTY_BITS = int(os.environ.get('POW_MAX_DIFFICULTY_BITS', 24))
+POW_MAX_STRIKE_BITS = 6
+# Bits a solution may fall short of the current difficulty, for challenges
+# fetched just before it went up
+POW_DIFFICULTY_SLACK = int(os.environ.get('POW_DIFFICULTY_SLACK', 2))
+
+def pow_strikes(ip_address):
+    return min(POW_MAX_STRIKE_BITS, rate_limiter.count('pow_strikes', ip=ip_address))
+
+def add_pow_strike(ip_address):
+    rate_limiter.hit('pow_strikes', ip=ip_address)
+
+# Difficulty rises with load (per worker) and with the client's strikes
+pow_difficulty = DifficultyController({
+    'vote': DifficultyPolicy(POW_DIFFICULTY_BITS, POW_MAX_DIFFICULTY_BITS,
+                             target_rate=float(os.environ.get('POW_TARGET_VOTE_RATE', 20))),
+    'submit-judge': DifficultyPolicy(POW_DIFFICULTY_BITS, POW_MAX_DIFFICULTY_BITS,
+                                     target_rate=float(os.environ.get('POW_TARGET_SUBMIT_RATE', 1)))
+}, strikes=pow_strikes)
+
+pow_challenges = ChallengeIssuer(
+    POW_SECRET_KEY,
+    SeenChallenges(os.environ.get('POW_SEEN_PATH') or default_seen_path('jai_' + os.path.basename(app.root_path))),
+    ttl=int(os.environ.get('POW_CHALLENGE_TTL', 300))
+)
+
+def verify_proof_of_work(proof_of_work, endpoint, scope, ip_address):
+    """Return None when the solution is valid, else the error to send back."""
+    if not proof_of_work:
+        return 'Missing proof of work'
+    # The difficulty is read from the challenge, so never accept much less
+    # than what the endpoint would ask of this client now
+    return pow_challenges.verify(proof_of_work.get('challenge'), proof_of_work.get('nonce'), scope, ip_address,
+                                 min_difficulty=pow_difficulty.floor(endpoint, ip_address, POW_DIFFICULTY_SLACK))
 
-    # Check submissions in last 10 minutes
-    ten_mins_ago = (datetime.now() - timedelta(minutes=10)).isoformat()
-    recent_submissions = query_db('''
-        SELECT COUNT(*) FROM submissions 
-        WHERE ip_address = %s AND submitted_at > %s
-    ''', (ip_address, ten_mins_ago), one=True)[0]
-    
-    return recent_submissions == 0
-
-def verify_proof_of_work(nonce, hash, difficulty):
-    target_prefix = '0' * difficulty
-    data = f'nonce:{nonce}'
-    message_data = data.encode('utf-8')
-    calculated_hash = hashlib.sha256(message_data).hexdigest()
-    return calculated_hash == hash and calculated_hash.startswith(target_prefix)
+def send_challenge(endpoint, scope):
+    ip_address = get_client_ip()
+    difficulty = pow_difficulty.difficulty(endpoint, ip_address)
+    response = jsonify({
+        'challenge': pow_challenges.issue(scope, ip_address, difficulty),
+        'difficulty': difficulty
+    })
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+# Request signing keys are shared through the database, so any worker on
+# any node can verify a request signed with a key fetched from another
+HMAC_KEY_LIFETIME = int(os.environ.get('HMAC_KEY_LIFETIME', 86400))  # Seconds
+HMAC_KEY_OVERLAP = int(os.environ.get('HMAC_KEY_OVERLAP', 3600))  # Seconds both old and new key are valid
+
+def load_signing_keys():
+    with get_cursor() as cur:
+        return load_hmac_keys(cur)
+
+hmac_keys = HmacKeyRing(load_signing_keys,
+                        refresh_interval=float(os.environ.get('HMAC_KEY_REFRESH_INTERVAL', 60)))
 
 def hmac_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        # Get timestamp and signature from headers
+        # Get key id, timestamp and signature from headers
+        key_id = request.headers.get('X-HMAC-Key-Id')
         timestamp = request.headers.get('X-HMAC-Timestamp')
         received_signature = request.headers.get('X-HMAC-Signature')
 
-        if not timestamp or not received_signature:
+        if not key_id or not timestamp or not received_signature:
             return jsonify({'success': False, 'error': 'Missing HMAC headers'}), 401
 
         # Check timestamp validity (within 5 minutes)
@@ -114,16 +217,15 @@ def hmac_required(f):
         except ValueError:
             return jsonify({'success': False, 'error': 'Invalid timestamp format'}), 401
 
-        # Reconstruct the message for signature verification
-        message = request.method + request.path
-        if request.get_data():
-            message += request.get_data().decode('utf-8')  # Important: Decode for consistent hashing
-        message += str(timestamp)
+        key = hmac_keys.verification_key(key_id)
+        if key is None:
+            return jsonify({'success': False, 'error': 'Unknown or expired HMAC key'}), 401
 
-        # Calculate the expected signature
-        secret_key_bytes = app.config['HMAC_SECRET_KEY'].encode('utf-8')
-        message_bytes = message.encode('utf-8')
-        expected_signature = hmac.new(secret_key_bytes, message_bytes, hashlib.sha256).hexdigest()
+        # Sign the raw body bytes as received; the client signs the same bytes
+        signature = hmac.new(key.secret, (request.method + request.path).encode('utf-8'), hashlib.sha256)
+        signature.update(request.get_data(cache=True))
+        signature.update(str(timestamp).encode('utf-8'))
+        expected_signature = signature.hexdigest()
 
         # Compare signatures
         if not hmac.compare_digest(expected_signature, received_signature):
@@ -133,102 +235,136 @@ def hmac_required(f):
 
     return decorated_function
 
+@app.route('/hmac/key')
+def get_hmac_key():
+    key = hmac_keys.signing_key()
+    if key is None:
+        return jsonify({'success': False, 'error': 'No signing key available'}), 503
+    response = jsonify({'kid': key.kid, 'key': key.secret.decode('utf-8'), 'expires_at': int(key.not_after)})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def load_tally_version():
+    with get_cursor() as cur:
+        return current_tally_version(cur)
+
+def build_judges_snapshot():
+    # Read the version first so a snapshot is never labelled newer than its data
+    version = load_tally_version()
+
+    def build():
+        with get_cursor() as cur:
+            return JudgesSnapshot(version, fetch_judge_tallies(cur))
+
+    # Only one worker per host runs the aggregation for a given version
+    return cache.cache.get_or_compute('judges-snapshot:%d' % version, build, timeout=300)
+
+judges_snapshots = SnapshotStore(
+    load_tally_version,
+    build_judges_snapshot,
+    check_interval=float(os.environ.get('JUDGES_SNAPSHOT_CHECK_INTERVAL', 1.0))
+)
+
+# Cursors further behind than this get a full snapshot instead of a delta
+JUDGES_DELTA_MAX_LAG = int(os.environ.get('JUDGES_DELTA_MAX_LAG', 5000))
+
+def send_judges_snapshot(snapshot):
+    # Clients that already have this version only need a 304
+    if request.if_none_match.contains_weak(snapshot.etag):
+        response = app.response_class(status=304)
+    else:
+        encoding = snapshot.choose_encoding(request.accept_encodings)
+        response = app.response_class(snapshot.bodies[encoding], mimetype='application/json')
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+
+    response.set_etag(snapshot.etag, weak=True)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
 @app.route('/judges')
-@cache.cached(timeout=60, query_string=True)  # Cache this view for 60 seconds and vary by query string
 def get_judges():
-    # Get all judges with displayed=1
-    judges_query = '''
-        SELECT j.*
-        FROM judges j
-        WHERE j.displayed = 1
-    '''
-    
-    judges_data = query_db(judges_query)
-    
-    # Process each judge to get their vote counts
-    judges_with_status = []
-    for judge in judges_data:
-        judge_id = judge[0]
-        
-        # Get all votes count
-        votes_query = '''
-            SELECT 
-                COALESCE(SUM(CASE WHEN v.vote_type = 'corrupt' THEN 1 ELSE 0 END), 0) AS corrupt_votes,
-                COALESCE(SUM(CASE WHEN v.vote_type = 'not_corrupt' THEN 1 ELSE 0 END), 0) AS not_corrupt_votes
-            FROM votes v
-            WHERE v.judge_id = %s
-        '''
-        
-        vote_counts = query_db(votes_query, (judge_id,), one=True)
-        corrupt_votes = vote_counts['corrupt_votes'] if vote_counts else 0
-        not_corrupt_votes = vote_counts['not_corrupt_votes'] if vote_counts else 0
-        
-        # Get US-specific vote counts
-        us_votes_query = '''
-            SELECT 
-                COALESCE(SUM(CASE WHEN v.vote_type = 'corrupt' THEN 1 ELSE 0 END), 0) AS corrupt_votes,
-                COALESCE(SUM(CASE WHEN v.vote_type = 'not_corrupt' THEN 1 ELSE 0 END), 0) AS not_corrupt_votes
-            FROM votes v
-            JOIN ip_geolocation g ON v.ip_address = g.ip_address
-            WHERE v.judge_id = %s AND g.country_code2 = 'US'
-        '''
-        
-        us_vote_counts = query_db(us_votes_query, (judge_id,), one=True)
-        us_corrupt_votes = us_vote_counts['corrupt_votes'] if us_vote_counts else 0
-        us_not_corrupt_votes = us_vote_counts['not_corrupt_votes'] if us_vote_counts else 0
-        
-        # Determine status based on vote ratios
-        total_votes = corrupt_votes + not_corrupt_votes
-        status = 'undecided'
-        if total_votes >= 5:
-            corrupt_ratio = corrupt_votes / total_votes if total_votes > 0 else 0
-            not_corrupt_ratio = not_corrupt_votes / total_votes if total_votes > 0 else 0
-            if corrupt_ratio >= 0.8333:
-                status = 'corrupt'
-            elif not_corrupt_ratio >= 0.8333:
-                status = 'not_corrupt'
-        
-        # Create judge object with all vote data
-        judges_with_status.append({
-            **dict(zip(['id', 'name', 'job_position', 'ruling', 'link', 'x_link', 'displayed'], judge)),
-            'corrupt_votes': corrupt_votes,
-            'not_corrupt_votes': not_corrupt_votes,
-            'us_corrupt_votes': us_corrupt_votes,
-            'us_not_corrupt_votes': us_not_corrupt_votes,
-            'status': status
-        })
-
-    return jsonify({'judges': judges_with_status})
+    return send_judges_snapshot(judges_snapshots.current())
+
+@app.route('/judges/changes')
+def get_judge_changes():
+    since = request.args.get('since', type=int)
+    with get_cursor() as cur:
+        # The new cursor is read before the changes, so it never covers a
+        # change the response leaves out
+        version = current_tally_version(cur)
+        # Missing, unknown or too old cursors fall back to the full snapshot
+        full = since is None or since <= 0 or since > version or version - since > JUDGES_DELTA_MAX_LAG
+        changed, removed = [], []
+        if not full and since < version:
+            changed, removed = fetch_judge_changes(cur, since)
+
+    if full:
+        return send_judges_snapshot(judges_snapshots.current())
+
+    response = jsonify({'version': version, 'full': False, 'judges': changed, 'removed': removed})
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def load_judge_changes(since):
+    with get_cursor() as cur:
+        # Read before the changes, like the delta endpoint
+        version = current_tally_version(cur)
+        if version <= since:
+            return version, [], []
+        changed, removed = fetch_judge_changes(cur, since)
+    return version, changed, removed
+
+tally_broadcaster = TallyBroadcaster(
+    load_tally_version,
+    load_judge_changes,
+    interval=float(os.environ.get('LIVE_UPDATES_INTERVAL', 1.0))
+)
+
+@app.route('/judges/stream')
+def stream_judges():
+    # EventSource sends Last-Event-ID when it reconnects
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', type=int)
+    return Response(tally_broadcaster.stream(since), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'  # Keep reverse proxies from buffering the stream
+    })
+
+@app.route('/challenge/vote/<int:judge_id>')
+def vote_challenge(judge_id):
+    return send_challenge('vote', f'vote:{judge_id}')
+
+@app.route('/challenge/submit-judge')
+def submit_judge_challenge():
+    return send_challenge('submit-judge', 'submit-judge')
+
+# Must match the admin app's setting: IPv6 voters are only queued for
+# geolocation when lookups go by prefix
+GEOLOCATION_FAMILIES = geolocation_families(os.environ.get('GEOLOCATION_GRANULARITY', 'ip'))
 
 @app.route('/vote/<int:judge_id>', methods=['POST'])
 @hmac_required
 def submit_vote(judge_id):
     ip_address = get_client_ip()
     data = request.json
+    fingerprint = normalize_fingerprint(data.get('fingerprint'))
+    pow_difficulty.record_request('vote')
 
-    #Check if judge exists
-    judge = query_db('SELECT * FROM judges WHERE id = %s AND displayed = 1', (judge_id,), one=True)
-    if not judge:
+    # Unknown and hidden judges are turned away without a database round trip
+    if not is_judge_displayed(judge_id):
         return jsonify({'success': False, 'error': 'Judge not found'}), 404
-    
-    # Check rate limit (1 vote per judge per day)
-    if not is_ip_whitelisted(ip_address):
-        last_vote = query_db('''
-            SELECT created_at FROM votes
-            WHERE ip_address = %s AND judge_id = %s
-            ORDER BY created_at DESC
-            LIMIT 1
-        ''', (ip_address, judge_id), one=True)
-        
-        if last_vote and (datetime.now() - datetime.fromisoformat(last_vote[0])) < timedelta(days=1):
-            return jsonify({
-                'success': False,
-                'error': 'You can only vote once per judge every 24 hours'
-            }), 429
+
+    rate_limit_error = check_vote_rate_limit(ip_address, judge_id, fingerprint)
+    if rate_limit_error:
+        add_pow_strike(ip_address)
+        return jsonify({'success': False, 'error': rate_limit_error}), 429
 
     # Validate vote type
     vote_type = data.get('vote_type')
@@ -236,29 +372,60 @@ def submit_vote(judge_id):
         return jsonify({'success': False, 'error': 'Invalid vote type'}), 400
 
     # Verify proof of work
-    proof_of_work = data.get('proofOfWork')
-    if not proof_of_work:
-        return jsonify({'success': False, 'error': 'Missing proof of work'}), 400
-    if not verify_proof_of_work(proof_of_work.get('nonce'), proof_of_work.get('hash'), 4):  # Use difficulty 4
-        return jsonify({'success': False, 'error': 'Invalid proof of work'}), 400
+    pow_error = verify_proof_of_work(data.get('proofOfWork'), 'vote', f'vote:{judge_id}', ip_address)
+    if pow_error:
+        add_pow_strike(ip_address)
+        return jsonify({'success': False, 'error': pow_error}), 400
+
+    # In buffered mode the vote is acknowledged once it is journaled; judges
+    # hidden since the check above and repeat votes are dropped when the
+    # batch is written
+    if vote_buffer is not None:
+        # Stamped in UTC like votes written directly; the key makes a replayed
+        # journal segment insert its votes only once
+        created_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        if not vote_buffer.submit((judge_id, ip_address, vote_type, fingerprint, created_at, str(uuid.uuid4()))):
+            # A full buffer means the database is falling behind
+            pow_difficulty.record_operation('vote', 0, failed=True)
+            response = jsonify({'success': False, 'error': 'Too many votes right now, please try again shortly'})
+            response.headers['Retry-After'] = '5'
+            return response, 503
+        rate_limiter.hit('vote_judge', ip=ip_address, judge_id=judge_id)
+        anomaly_detector.observe(judge_id, ip_address, fingerprint)
+        return jsonify({'success': True})
 
     # Insert vote
+    started = time.monotonic()
     try:
-        query_db('''
-            INSERT INTO votes (judge_id, ip_address, vote_type, browser_fingerprint)
-            VALUES (%s, %s, %s, %s)
-        ''', (judge_id, ip_address, vote_type, data.get('fingerprint')))
-
+        # The judge check, the once-per-day rule (1 vote per judge per day
+        # unless whitelisted), the insert and the tally update are one statement
+        with get_cursor() as cur:
+            accepted, inserted = record_votes(cur, [(judge_id, ip_address, vote_type, fingerprint, None)],
+                                              geolocate_families=GEOLOCATION_FAMILIES)
+        pow_difficulty.record_operation('vote', time.monotonic() - started)
+
+        if not accepted:
+            return jsonify({'success': False, 'error': 'Judge not found'}), 404
+        rate_limiter.hit('vote_judge', ip=ip_address, judge_id=judge_id)
+        if not inserted:
+            return jsonify({
+                'success': False,
+                'error': 'You can only vote once per judge per day'
+            }), 429
+        anomaly_detector.observe(judge_id, ip_address, fingerprint)
         return jsonify({'success': True})
     except Exception as e:
+        pow_difficulty.record_operation('vote', time.monotonic() - started, failed=True)
         return jsonify({'success': False, 'error': str(e)}), 500
 
 @app.route('/submit-judge', methods=['POST'])
 @hmac_required
 def submit_judge():
     ip_address = get_client_ip()
+    pow_difficulty.record_request('submit-judge')
 
     if not check_rate_limit(ip_address):
+        add_pow_strike(ip_address)
         return jsonify({
             'success': False, 
             'error': 'Rate limit exceeded. Please wait 10 minutes between submissions.'
@@ -266,31 +433,149 @@ def submit_judge():
 
     data = request.json
     try:
-        # Cache IP geolocation data immediately
-        get_ip_geolocation_task.delay(ip_address)
-
         # Honeypot check
         if data.get('honeypot'):
             # log_admin_action('honeypot_triggered', f'IP: {ip_address}')  # Removed: log_admin_action is in admin app
+            add_pow_strike(ip_address)
             return jsonify({'success': False, 'error': 'Submission rejected'}), 400  # Reject submission
         
         # Verify proof of work
-        proof_of_work = data.get('proofOfWork')
-        if not proof_of_work:
-            return jsonify({'success': False, 'error': 'Missing proof of work'}), 400
-        if not verify_proof_of_work(proof_of_work.get('nonce'), proof_of_work.get('hash'), 4):  # Use difficulty 4
-            return jsonify({'success': False, 'error': 'Invalid proof of work'}), 400
-
-
-        query_db('''
-            INSERT INTO submissions (name, position, ruling, link, x_link, ip_address)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        ''', (data['name'], data['position'],
-              data['ruling'], data['link'], data['x_link'], ip_address))
+        pow_error = verify_proof_of_work(data.get('proofOfWork'), 'submit-judge', 'submit-judge', ip_address)
+        if pow_error:
+            add_pow_strike(ip_address)
+            return jsonify({'success': False, 'error': pow_error}), 400
+
+        started = time.monotonic()
+        try:
+            with transaction() as cur:
+                cur.execute('''
+                    INSERT INTO submissions (name, position, ruling, link, x_link, ip_address)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                ''', (data['name'], data['position'],
+                      data['ruling'], data['link'], data['x_link'], ip_address))
+                # Geolocate the submitter in the background
+                enqueue_geolocation(cur, ip_address, GEOLOCATION_FAMILIES)
+        except Exception:
+            pow_difficulty.record_operation('submit-judge', time.monotonic() - started, failed=True)
+            raise
+        pow_difficulty.record_operation('submit-judge', time.monotonic() - started)
+        rate_limiter.hit('submit_judge', ip=ip_address)
         return jsonify({'success': True})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+# Judge vote tallies read model; the admin app reconciles it with votes
+def create_tallies_table():
+    try:
+        with get_cursor() as cur:
+            create_vote_schema(cur)
+        return True
+    except Exception as e:
+        print(f"Error creating vote schema: {e}")
+        return False
+
+def create_reference_data_tables():
+    try:
+        with get_cursor() as cur:
+            create_reference_data_schema(cur)
+        return True
+    except Exception as e:
+        print(f"Error creating reference_data_versions table: {e}")
+        return False
+
+def create_job_tables():
+    try:
+        with get_cursor() as cur:
+            create_jobs_table(cur)
+        return True
+    except Exception as e:
+        print(f"Error creating jobs table: {e}")
+        return False
+
+def create_anomaly_tables():
+    try:
+        with get_cursor() as cur:
+            create_vote_anomalies_table(cur)
+        return True
+    except Exception as e:
+        print(f"Error creating vote_anomalies table: {e}")
+        return False
+
+# Streaming vote burst detection; flags are written for the admin app
+ANOMALY_WINDOW = int(os.environ.get('ANOMALY_WINDOW', 3600))  # Seconds
+ANOMALY_RETENTION = int(os.environ.get('ANOMALY_RETENTION', 7 * 86400))  # Seconds flags are kept
+
+def write_vote_anomalies(events):
+    with transaction() as cur:
+        record_vote_anomalies(cur, events, ANOMALY_WINDOW)
+        prune_vote_anomalies(cur, ANOMALY_RETENTION)
+
+anomaly_detector = AnomalyDetector(
+    write_vote_anomalies,
+    path=os.environ.get('ANOMALY_SKETCH_PATH') or default_sketch_path('jai_' + os.path.basename(app.root_path)),
+    window=ANOMALY_WINDOW,
+    thresholds={
+        'ip': int(os.environ.get('ANOMALY_IP_THRESHOLD', 5)),  # Votes per IP per judge per window
+        'fingerprint': int(os.environ.get('ANOMALY_FINGERPRINT_THRESHOLD', 5))
+    }
+)
+
+# Request signing key rotation
+HMAC_KEY_ROTATE_INTERVAL = int(os.environ.get('HMAC_KEY_ROTATE_INTERVAL', 300))  # Seconds
+
+def rotate_signing_keys():
+    with transaction() as cur:
+        return rotate_hmac_keys(cur, HMAC_KEY_LIFETIME, HMAC_KEY_OVERLAP)
+
+def run_hmac_key_rotation():
+    while True:
+        time.sleep(HMAC_KEY_ROTATE_INTERVAL)
+        try:
+            kid = rotate_signing_keys()
+            if kid:
+                print(f"Created HMAC signing key {kid}")
+        except Exception as e:
+            print(f"Error rotating HMAC signing keys: {e}")
+
+# Create the tallies, reference data, jobs and anomalies tables on startup
+create_tallies_table()
+create_reference_data_tables()
+create_job_tables()
+create_anomaly_tables()
+anomaly_detector.start()
+
+# Make sure a signing key exists before serving, then keep rotating
+try:
+    with get_cursor() as cur:
+        create_hmac_keys_table(cur)
+    rotate_signing_keys()
+except Exception as e:
+    print(f"Error creating HMAC signing keys: {e}")
+threading.Thread(target=run_hmac_key_rotation, name='hmac-key-rotation', daemon=True).start()
+
+# Optional write-behind vote ingestion ('sync' or 'buffered')
+VOTE_INGEST_MODE = os.environ.get('VOTE_INGEST_MODE', 'sync')
+VOTE_BUFFER_BATCH_SIZE = int(os.environ.get('VOTE_BUFFER_BATCH_SIZE', 500))
+
+def write_buffered_votes(votes):
+    with transaction() as cur:
+        record_votes(cur, votes, page_size=VOTE_BUFFER_BATCH_SIZE, geolocate_families=GEOLOCATION_FAMILIES)
+
+vote_buffer = None
+if VOTE_INGEST_MODE == 'buffered':
+    vote_buffer = VoteBuffer(
+        write_buffered_votes,
+        journal_dir=os.environ.get('VOTE_JOURNAL_DIR', os.path.join(app.root_path, 'vote_journal')),
+        max_size=int(os.environ.get('VOTE_BUFFER_MAX_SIZE', 10000)),
+        batch_size=VOTE_BUFFER_BATCH_SIZE,
+        flush_interval=float(os.environ.get('VOTE_BUFFER_FLUSH_INTERVAL', 1.0)),
+        fsync=os.environ.get('VOTE_JOURNAL_FSYNC', '1') == '1',
+        # Errors caused by the vote itself; anything else is retried
+        dead_letter_errors=(psycopg2.DataError, psycopg2.IntegrityError)
+    )
+    vote_buffer.start()
+    atexit.register(vote_buffer.stop)
+
 if __name__ == '__main__':
     port = int(os.environ.get('FLASK_RUN_PORT', 5000))
     app.run(debug=True, port=port)
\ No newline at end of file
@@ -0,0 +1,220 @@
+"""
+Shared PostgreSQL data-access layer for the main app, the admin app and the
+maintenance scripts.
+
+Connections come from a process-wide, thread-safe pool instead of being
+opened per query. Pool settings are read from the environment:
+
+    DB_POOL_MIN                   connections opened up front (default 1)
+    DB_POOL_MAX                   hard cap on open connections (default 10)
+    DB_POOL_TIMEOUT               seconds to wait for a free connection (default 5)
+    DB_POOL_HEALTHCHECK_INTERVAL  idle seconds after which a connection is
+                                  pinged before reuse (default 30, 0 = always)
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import RealDictCursor
+
+
+class PoolTimeoutError(Exception):
+    """Raised when no connection frees up before the checkout timeout."""
+
+
+class ConnectionPool:
+    """
+    Bounded pool of autocommit connections.
+
+    Checkout blocks until a connection is free or the timeout expires, and
+    connections idle for longer than the health-check interval are pinged
+    before being handed out.
+    """
+
+    def __init__(self, minconn, maxconn, timeout, healthcheck_interval, **connect_kwargs):
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError('Invalid pool size: min=%s max=%s' % (minconn, maxconn))
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.connect_kwargs = connect_kwargs
+        self._cond = threading.Condition()
+        self._idle = []  # (connection, time it was returned)
+        self._size = 0
+        self._closed = False
+
+        for _ in range(minconn):
+            self._idle.append((self._connect(), time.monotonic()))
+            self._size += 1
+
+    def _connect(self):
+        conn = psycopg2.connect(**self.connect_kwargs)
+        conn.autocommit = True
+        return conn
+
+    def _is_healthy(self, conn, returned_at):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned_at < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._cond.notify()
+
+    def getconn(self):
+        deadline = time.monotonic() + self.timeout
+        while True:
+            conn = None
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise PoolTimeoutError('Connection pool is closed')
+                    if self._idle:
+                        conn, returned_at = self._idle.pop()
+                        break
+                    if self._size < self.maxconn:
+                        self._size += 1
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeoutError(
+                            'No database connection available after %s seconds' % self.timeout)
+                    self._cond.wait(remaining)
+
+            if conn is None:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+
+            if self._is_healthy(conn, returned_at):
+                return conn
+            self._discard(conn)
+
+    def putconn(self, conn, discard=False):
+        if not discard and not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            # Never hand out a connection with a transaction left open
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed or self._closed:
+            self._discard(conn)
+            return
+        conn.autocommit = True
+        with self._cond:
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for conn, _ in idle:
+            self._discard(conn)
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """Return this process's pool, creating it on first use and after a fork."""
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is not None and _pool_pid == pid:
+        return _pool
+    with _pool_lock:
+        if _pool is None or _pool_pid != pid:
+            _pool = ConnectionPool(
+                minconn=int(os.environ.get('DB_POOL_MIN', 1)),
+                maxconn=int(os.environ.get('DB_POOL_MAX', 10)),
+                timeout=float(os.environ.get('DB_POOL_TIMEOUT', 5)),
+                healthcheck_interval=float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', 30)),
+                host=os.environ.get('DB_HOST', 'localhost'),
+                port=os.environ.get('DB_PORT', '5432'),
+                dbname=os.environ.get('DB_NAME', 'jai_db'),
+                user=os.environ.get('DB_USER', 'jai'),
+                password=os.environ.get('DB_PASSWORD', '')
+            )
+            _pool_pid = pid
+    return _pool
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.closeall()
+        _pool = None
+
+
+@contextmanager
+def connection():
+    """Check out an autocommit connection for the duration of the block."""
+    pool = get_pool()
+    conn = pool.getconn()
+    broken = False
+    try:
+        yield conn
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        broken = True
+        raise
+    finally:
+        pool.putconn(conn, discard=broken)
+
+
+@contextmanager
+def get_cursor(dict_cursor=False):
+    """Yield a cursor on an autocommit connection; every statement commits."""
+    with connection() as conn:
+        with conn.cursor(cursor_factory=RealDictCursor if dict_cursor else None) as cur:
+            yield cur
+
+
+@contextmanager
+def transaction(dict_cursor=False):
+    """Yield a cursor whose statements commit together, or roll back on error."""
+    with connection() as conn:
+        conn.autocommit = False
+        try:
+            with conn.cursor(cursor_factory=RealDictCursor if dict_cursor else None) as cur:
+                yield cur
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+
+def query_db(query, args=(), one=False, commit=True):
+    """
+    Run a single statement and return its rows.
+
+    With one=True the first row is returned as a dict (or None). Statements
+    that produce no rows return an empty list. Pooled connections run in
+    autocommit mode, so commit is kept only for call-site compatibility.
+    """
+    with get_cursor(dict_cursor=one) as cur:
+        cur.execute(query, args)
+        rv = cur.fetchall() if cur.description is not None else []
+    return (dict(rv[0]) if rv else None) if one else rv
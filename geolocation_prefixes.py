@@ -0,0 +1,114 @@
+"""
+Geolocation by network prefix.
+
+Addresses in the same /24 (IPv4) or /48 (IPv6) usually share a location, so
+one row in ip_geolocation_prefixes can stand in for every address in the
+prefix. A prefix row is filled from the first lookup in it and checked
+against lookups of a few more distinct addresses; it is verified once they
+all agree, and marked ambiguous as soon as one does not. Addresses in
+ambiguous prefixes get their own rows in ip_geolocation as before.
+
+Queries resolve an address through its exact row first and its prefix
+second, joining on ip_geolocation_prefix(ip_address).
+"""
+import ipaddress
+
+PREFIX_LENGTH_V4 = 24
+PREFIX_LENGTH_V6 = 48
+
+# Location columns kept per prefix; the rest of an API response is per address
+PREFIX_COLUMNS = [
+    'continent_code', 'continent_name', 'country_code2', 'country_code3', 'country_name',
+    'country_flag', 'country_emoji', 'state_prov', 'city', 'latitude', 'longitude',
+    'timezone_name', 'timezone_offset'
+]
+
+CREATE_GEOLOCATION_PREFIXES_SQL = '''
+    CREATE TABLE IF NOT EXISTS ip_geolocation_prefixes (
+        prefix CIDR PRIMARY KEY,
+        continent_code VARCHAR(2),
+        continent_name VARCHAR(50),
+        country_code2 VARCHAR(2),
+        country_code3 VARCHAR(3),
+        country_name VARCHAR(100),
+        country_flag VARCHAR(255),
+        country_emoji VARCHAR(16),
+        state_prov VARCHAR(100),
+        city VARCHAR(100),
+        latitude VARCHAR(20),
+        longitude VARCHAR(20),
+        timezone_name VARCHAR(100),
+        timezone_offset VARCHAR(10),
+        sample_ips TEXT[] NOT NULL DEFAULT '{}',
+        ambiguous BOOLEAN NOT NULL DEFAULT FALSE,
+        verified BOOLEAN NOT NULL DEFAULT FALSE,
+        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE OR REPLACE FUNCTION ip_geolocation_prefix(ip INET) RETURNS CIDR AS $$
+        SELECT network(set_masklen(ip, CASE family(ip) WHEN 4 THEN ''' + str(PREFIX_LENGTH_V4) + '''
+                                                      ELSE ''' + str(PREFIX_LENGTH_V6) + ''' END))
+    $$ LANGUAGE sql IMMUTABLE;
+'''
+
+# Adds one lookup result to its prefix. A sample from a new address that
+# disagrees on country or region makes the prefix ambiguous for good; a
+# prefix past its max age starts over from this sample.
+RECORD_PREFIX_SAMPLE_SQL = '''
+    INSERT INTO ip_geolocation_prefixes AS p (prefix, ''' + ', '.join(PREFIX_COLUMNS) + ''', sample_ips, verified)
+    VALUES (%(prefix)s, ''' + ', '.join('%%(%s)s' % column for column in PREFIX_COLUMNS) + ''',
+            ARRAY[%(ip)s], %(samples)s <= 1)
+    ON CONFLICT (prefix) DO UPDATE SET
+        ''' + ',\n        '.join(
+            '%s = CASE WHEN p.last_updated < CURRENT_TIMESTAMP - make_interval(secs => %%(max_age)s) '
+            'THEN EXCLUDED.%s ELSE p.%s END' % (column, column, column) for column in PREFIX_COLUMNS) + ''',
+        sample_ips = CASE
+            WHEN p.last_updated < CURRENT_TIMESTAMP - make_interval(secs => %(max_age)s) THEN EXCLUDED.sample_ips
+            WHEN %(ip)s = ANY(p.sample_ips) THEN p.sample_ips
+            ELSE (p.sample_ips || EXCLUDED.sample_ips)[1:%(samples)s]
+        END,
+        ambiguous = CASE
+            WHEN p.last_updated < CURRENT_TIMESTAMP - make_interval(secs => %(max_age)s) THEN FALSE
+            ELSE p.ambiguous
+                OR p.country_code2 IS DISTINCT FROM EXCLUDED.country_code2
+                OR p.state_prov IS DISTINCT FROM EXCLUDED.state_prov
+        END,
+        last_updated = CASE
+            WHEN p.last_updated < CURRENT_TIMESTAMP - make_interval(secs => %(max_age)s) THEN CURRENT_TIMESTAMP
+            ELSE p.last_updated
+        END
+'''
+
+# verified depends on the columns set above, so it is settled in a second step
+SETTLE_PREFIX_SQL = '''
+    UPDATE ip_geolocation_prefixes
+    SET verified = NOT ambiguous AND cardinality(sample_ips) >= %s
+    WHERE prefix = %s
+    RETURNING *
+'''
+
+
+def create_geolocation_prefix_schema(cur):
+    cur.execute(CREATE_GEOLOCATION_PREFIXES_SQL)
+
+
+def ip_prefix(ip_address):
+    """Return the prefix an address belongs to, matching ip_geolocation_prefix()."""
+    try:
+        address = ipaddress.ip_address(ip_address)
+    except ValueError:
+        return None
+    length = PREFIX_LENGTH_V4 if address.version == 4 else PREFIX_LENGTH_V6
+    return str(ipaddress.ip_network(f'{address}/{length}', strict=False))
+
+
+def record_prefix_sample(cur, ip_address, location, samples, max_age):
+    """
+    Add the location found for ip_address to its prefix and return the
+    prefix row. Needs a dict cursor; location maps columns to values.
+    """
+    prefix = ip_prefix(ip_address)
+    params = {column: location.get(column) for column in PREFIX_COLUMNS}
+    params.update(prefix=prefix, ip=str(ip_address), samples=samples, max_age=max_age)
+    cur.execute(RECORD_PREFIX_SAMPLE_SQL, params)
+    cur.execute(SETTLE_PREFIX_SQL, (samples, prefix))
+    return cur.fetchone()
@@ -0,0 +1,115 @@
+"""
+Shared, rotating keys for request signing.
+
+Keys live in the hmac_keys table so every worker and node signs and
+verifies with the same set. Each key has a validity window; a new key is
+created once the newest one has less than the overlap left, so clients
+holding the previous key keep working until they fetch the new one.
+Requests name their key in the X-HMAC-Key-Id header.
+"""
+import secrets
+import threading
+import time
+
+# Arbitrary key for the advisory lock that keeps rotation single-flight
+ROTATE_LOCK_ID = 4242002
+
+CREATE_HMAC_KEYS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS hmac_keys (
+        kid VARCHAR(32) PRIMARY KEY,
+        secret TEXT NOT NULL,
+        not_before TIMESTAMPTZ NOT NULL,
+        not_after TIMESTAMPTZ NOT NULL,
+        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+class HmacKey:
+    def __init__(self, kid, secret, not_before, not_after):
+        self.kid = kid
+        self.secret = secret.encode('utf-8')
+        self.not_before = not_before  # Unix timestamps
+        self.not_after = not_after
+
+    def is_valid(self, now):
+        return self.not_before <= now < self.not_after
+
+
+def create_hmac_keys_table(cur):
+    cur.execute(CREATE_HMAC_KEYS_TABLE_SQL)
+
+
+def rotate_hmac_keys(cur, lifetime, overlap):
+    """
+    Create a key when the newest one has less than overlap seconds left and
+    drop keys that expired a day ago. Must run inside a transaction.
+    Returns the id of the new key, or None.
+    """
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (ROTATE_LOCK_ID,))
+    cur.execute('''
+        SELECT EXTRACT(EPOCH FROM MAX(not_after) - CURRENT_TIMESTAMP)
+        FROM hmac_keys WHERE not_before <= CURRENT_TIMESTAMP
+    ''')
+    remaining = cur.fetchone()[0]
+    kid = None
+    if remaining is None or remaining < overlap:
+        kid = secrets.token_hex(8)
+        cur.execute('''
+            INSERT INTO hmac_keys (kid, secret, not_before, not_after)
+            VALUES (%s, %s, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP + make_interval(secs => %s))
+        ''', (kid, secrets.token_hex(32), lifetime))
+    cur.execute("DELETE FROM hmac_keys WHERE not_after < CURRENT_TIMESTAMP - INTERVAL '1 day'")
+    return kid
+
+
+def load_hmac_keys(cur):
+    cur.execute('''
+        SELECT kid, secret, EXTRACT(EPOCH FROM not_before), EXTRACT(EPOCH FROM not_after)
+        FROM hmac_keys
+        WHERE not_after > CURRENT_TIMESTAMP
+    ''')
+    return [HmacKey(kid, secret, float(not_before), float(not_after))
+            for kid, secret, not_before, not_after in cur.fetchall()]
+
+
+class HmacKeyRing:
+    """
+    This worker's copy of the current keys.
+
+    Keys are reloaded every refresh_interval seconds, and early when a
+    request names a key we do not have yet (rotated on another node), but
+    no more than once per miss_refresh_interval seconds.
+    """
+
+    def __init__(self, load_keys, refresh_interval=60.0, miss_refresh_interval=5.0):
+        self.load_keys = load_keys
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self._lock = threading.Lock()
+        self._keys = None
+        self._loaded_at = 0.0
+
+    def signing_key(self):
+        """Return the newest valid key, which clients should sign with."""
+        now = time.time()
+        valid = [key for key in self._current().values() if key.is_valid(now)]
+        return max(valid, key=lambda key: key.not_before) if valid else None
+
+    def verification_key(self, kid):
+        """Return the valid key named kid, or None."""
+        key = self._current().get(kid)
+        if key is None:
+            key = self._current(self.miss_refresh_interval).get(kid)
+        return key if key is not None and key.is_valid(time.time()) else None
+
+    def _current(self, max_age=None):
+        max_age = self.refresh_interval if max_age is None else max_age
+        keys = self._keys
+        if keys is not None and time.monotonic() - self._loaded_at < max_age:
+            return keys
+        with self._lock:
+            if self._keys is None or time.monotonic() - self._loaded_at >= max_age:
+                self._keys = {key.kid: key for key in self.load_keys()}
+                self._loaded_at = time.monotonic()
+            return self._keys
@@ -76,7 +76,7 @@ def initialize_database():
             title VARCHAR(255) NOT NULL,
             court VARCHAR(255) NOT NULL,
             state VARCHAR(50) NOT NULL,
-            ip_address VARCHAR(50) NOT NULL,
+            ip_address INET NOT NULL,
             browser_fingerprint VARCHAR(255),
             status VARCHAR(50) DEFAULT 'pending',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -91,7 +91,7 @@ def initialize_database():
         CREATE TABLE IF NOT EXISTS votes (
             id SERIAL PRIMARY KEY,
             judge_id INTEGER REFERENCES judges(id),
-            ip_address VARCHAR(50) NOT NULL,
+            ip_address INET NOT NULL,
             browser_fingerprint VARCHAR(255),
             vote_type VARCHAR(20) NOT NULL,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
@@ -103,7 +103,7 @@ def initialize_database():
         );
         
         CREATE TABLE IF NOT EXISTS ip_geolocation (
-            ip_address VARCHAR(50) PRIMARY KEY,
+            ip_address INET PRIMARY KEY,
             country VARCHAR(50),
             city VARCHAR(100),
             region VARCHAR(100),
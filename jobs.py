@@ -0,0 +1,223 @@
+"""
+Background jobs queued in PostgreSQL.
+
+Jobs are rows in the jobs table. Workers claim them with
+FOR UPDATE SKIP LOCKED, so any number of worker threads and processes can
+share the queue without handing out a job twice. A claimed job is leased
+for a while; if its worker dies the lease runs out and another worker picks
+it up. Failed jobs are retried with exponential backoff until they run out
+of attempts, and deleted once they are past their retention. A job may
+carry a dedupe key, and only one pending or running job per kind and key
+can exist at a time.
+"""
+import json
+import random
+import threading
+import time
+
+CREATE_JOBS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id BIGSERIAL PRIMARY KEY,
+        kind VARCHAR(32) NOT NULL,
+        dedupe_key TEXT,
+        payload JSONB NOT NULL DEFAULT '{}',
+        status VARCHAR(16) NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        max_attempts INTEGER NOT NULL DEFAULT 5,
+        run_after TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        locked_until TIMESTAMPTZ,
+        last_error TEXT,
+        created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_active_dedupe ON jobs (kind, dedupe_key)
+        WHERE status IN ('pending', 'running');
+    CREATE INDEX IF NOT EXISTS idx_jobs_pending ON jobs (run_after) WHERE status = 'pending';
+    CREATE INDEX IF NOT EXISTS idx_jobs_running ON jobs (locked_until) WHERE status = 'running';
+    CREATE INDEX IF NOT EXISTS idx_jobs_failed ON jobs (updated_at) WHERE status = 'failed';
+'''
+
+# Conflict target matching idx_jobs_active_dedupe, for INSERT ... ON CONFLICT
+ACTIVE_JOB_CONFLICT = "(kind, dedupe_key) WHERE status IN ('pending', 'running')"
+
+ENQUEUE_SQL = '''
+    INSERT INTO jobs (kind, dedupe_key, payload, max_attempts)
+    VALUES (%s, %s, %s, %s)
+    ON CONFLICT ''' + ACTIVE_JOB_CONFLICT + ''' DO NOTHING
+'''
+
+# Geolocation jobs are keyed by IP and skipped for IPs that are already known,
+# directly or through a verified prefix, and for address families the
+# lookup cannot handle
+ENQUEUE_GEOLOCATION_SQL = '''
+    INSERT INTO jobs (kind, dedupe_key, payload)
+    SELECT 'geolocate', %(ip)s, jsonb_build_object('ip_address', %(ip)s::text)
+    WHERE family(%(ip)s::inet) = ANY(%(families)s)
+      AND NOT EXISTS (SELECT 1 FROM ip_geolocation WHERE ip_address = %(ip)s)
+      AND NOT EXISTS (
+          SELECT 1 FROM ip_geolocation_prefixes
+          WHERE prefix = ip_geolocation_prefix(%(ip)s) AND verified
+      )
+    ON CONFLICT ''' + ACTIVE_JOB_CONFLICT + ''' DO NOTHING
+'''
+
+CLAIM_JOBS_SQL = '''
+    UPDATE jobs SET
+        status = 'running',
+        attempts = attempts + 1,
+        locked_until = CURRENT_TIMESTAMP + make_interval(secs => %(lease)s),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id IN (
+        SELECT id FROM jobs
+        WHERE (status = 'pending' AND run_after <= CURRENT_TIMESTAMP)
+           OR (status = 'running' AND locked_until < CURRENT_TIMESTAMP)
+        ORDER BY run_after
+        LIMIT %(limit)s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, kind, payload, attempts, max_attempts
+'''
+
+RETRY_JOB_SQL = '''
+    UPDATE jobs SET
+        status = CASE WHEN attempts >= max_attempts THEN 'failed' ELSE 'pending' END,
+        run_after = CURRENT_TIMESTAMP + make_interval(secs => %s),
+        locked_until = NULL,
+        last_error = %s,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = %s
+'''
+
+# Failed jobs are kept for a while to be looked at, then dropped
+PRUNE_FAILED_JOBS_SQL = '''
+    DELETE FROM jobs WHERE status = 'failed' AND updated_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+'''
+
+
+def create_jobs_table(cur):
+    cur.execute(CREATE_JOBS_TABLE_SQL)
+
+
+def enqueue_job(cur, kind, payload, dedupe_key=None, max_attempts=5):
+    """Queue a job. Returns False when an active job with the same key exists."""
+    cur.execute(ENQUEUE_SQL, (kind, dedupe_key, json.dumps(payload), max_attempts))
+    return cur.rowcount == 1
+
+
+def geolocation_families(granularity):
+    """
+    Return the IP families geolocation jobs can look up with the given
+    GEOLOCATION_GRANULARITY: IPv4, and IPv6 too when lookups go by prefix.
+    """
+    return (4, 6) if granularity == 'prefix' else (4,)
+
+
+def enqueue_geolocation(cur, ip_address, families=(4,)):
+    """Queue a geolocation lookup for an IP that is not geolocated yet."""
+    cur.execute(ENQUEUE_GEOLOCATION_SQL, {'ip': ip_address, 'families': list(families)})
+    return cur.rowcount == 1
+
+
+def claim_jobs(cur, limit, lease):
+    cur.execute(CLAIM_JOBS_SQL, {'limit': limit, 'lease': lease})
+    return cur.fetchall()
+
+
+def complete_job(cur, job_id):
+    cur.execute('DELETE FROM jobs WHERE id = %s', (job_id,))
+
+
+def retry_job(cur, job_id, delay, error):
+    """Schedule another attempt, or mark the job failed when it has none left."""
+    cur.execute(RETRY_JOB_SQL, (delay, error, job_id))
+
+
+def prune_failed_jobs(cur, retention):
+    cur.execute(PRUNE_FAILED_JOBS_SQL, (retention,))
+    return cur.rowcount
+
+
+class JobRunner:
+    """
+    A pool of worker threads running queued jobs.
+
+    handlers maps a job kind to a function taking the job's payload; a job
+    succeeds when its handler returns and is retried when it raises.
+    get_cursor is a context manager factory yielding an autocommit cursor.
+    """
+
+    def __init__(self, handlers, get_cursor, concurrency=2, poll_interval=1.0, lease=300,
+                 backoff_base=30.0, backoff_max=3600.0, failed_retention=7 * 86400, prune_interval=3600):
+        """
+        Failed jobs are deleted failed_retention seconds after their last
+        attempt; 0 keeps them.
+        """
+        self.handlers = handlers
+        self.get_cursor = get_cursor
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.failed_retention = failed_retention
+        self.prune_interval = prune_interval
+        self._pruned_at = 0.0
+        self._prune_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self._run, name='job-worker-%d' % i, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=None):
+        self._stopped.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_one(self):
+        """Claim and run a single job. Returns False when none was ready."""
+        with self.get_cursor() as cur:
+            jobs = claim_jobs(cur, 1, self.lease)
+        if not jobs:
+            return False
+        job_id, kind, payload, attempts, max_attempts = jobs[0]
+        try:
+            handler = self.handlers.get(kind)
+            if handler is None:
+                raise LookupError('No handler for job kind %r' % kind)
+            handler(payload)
+        except Exception as e:
+            delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+            delay *= random.uniform(0.8, 1.2)  # Spread retries of jobs that failed together
+            if attempts >= max_attempts:
+                print(f"Job {job_id} ({kind}) failed after {attempts} attempts: {e}")
+            with self.get_cursor() as cur:
+                retry_job(cur, job_id, delay, str(e))
+        else:
+            with self.get_cursor() as cur:
+                complete_job(cur, job_id)
+        return True
+
+    def prune(self):
+        """Delete old failed jobs, at most once per prune_interval across the pool."""
+        if not self.failed_retention:
+            return 0
+        with self._prune_lock:
+            if time.monotonic() - self._pruned_at < self.prune_interval:
+                return 0
+            self._pruned_at = time.monotonic()
+        with self.get_cursor() as cur:
+            return prune_failed_jobs(cur, self.failed_retention)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                if self.run_one():
+                    continue
+                self.prune()
+            except Exception as e:
+                print(f"Error running jobs: {e}")
+            self._stopped.wait(self.poll_interval)
@@ -0,0 +1,72 @@
+"""
+Precomputed /judges payloads.
+
+The payload is serialized and compressed once per tally version and then
+served as-is, so polls that find nothing new cost a version check at most
+and can be answered with 304 Not Modified.
+"""
+import gzip
+import json
+import threading
+import time
+
+try:
+    import brotli
+except ImportError:  # Brotli is optional; gzip is always available
+    brotli = None
+
+
+class JudgesSnapshot:
+    """The /judges payload for one tally version in every supported encoding."""
+
+    def __init__(self, version, judges):
+        self.version = version
+        self.etag = 'judges-%d' % version
+        body = json.dumps({'judges': judges, 'version': version, 'full': True},
+                          separators=(',', ':')).encode('utf-8')
+        self.bodies = {'identity': body, 'gzip': gzip.compress(body, compresslevel=9)}
+        if brotli is not None:
+            self.bodies['br'] = brotli.compress(body, quality=11)
+
+    def choose_encoding(self, accept_encodings):
+        """Pick the smallest encoding the client accepts."""
+        for encoding in ('br', 'gzip'):
+            if encoding in self.bodies and accept_encodings[encoding]:
+                return encoding
+        return 'identity'
+
+
+class SnapshotStore:
+    """
+    Keeps the latest snapshot for this worker.
+
+    The tally version is checked at most once per check_interval seconds and
+    the snapshot is rebuilt only when that version moved.
+    """
+
+    def __init__(self, load_version, build_snapshot, check_interval=1.0):
+        """
+        load_version returns the current tally version, which must move in
+        commit order so that no write is left out of a snapshot labelled
+        with a later version, and build_snapshot returns a JudgesSnapshot
+        for data read after that version.
+        """
+        self.load_version = load_version
+        self.build_snapshot = build_snapshot
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._checked_at = 0.0
+
+    def current(self):
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return snapshot
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self._snapshot is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._snapshot
+            if self._snapshot is None or self.load_version() != self._snapshot.version:
+                self._snapshot = self.build_snapshot()
+            self._checked_at = time.monotonic()
+            return self._snapshot
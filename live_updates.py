@@ -0,0 +1,114 @@
+"""
+Server-Sent Events fan-out of judge tally changes.
+
+One broadcaster per worker polls for tally changes once per interval and
+publishes a single coalesced event holding the latest state of every judge
+that changed. Events are serialized once and kept in a short history that
+all connected clients read from, so an idle connection costs a generator
+waiting on a shared condition and nothing else. Serving many connections
+needs a threaded or async worker class, since each open stream holds one.
+"""
+import json
+import threading
+import time
+from collections import deque
+
+
+class TallyBroadcaster:
+    def __init__(self, load_version, load_changes, interval=1.0, history=256, heartbeat=15.0,
+                 idle_timeout=60.0):
+        """
+        load_version() returns the current tally version and
+        load_changes(since_version) returns (version, changed, removed) in the
+        shape produced by tallies.fetch_judge_changes. Versions must become
+        visible in commit order, and the returned version must be read
+        before the changes, or events can miss a change that commits late.
+        """
+        self.load_version = load_version
+        self.load_changes = load_changes
+        self.interval = interval
+        self.heartbeat = heartbeat
+        self.idle_timeout = idle_timeout
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=history)  # (version, frame)
+        self._version = None
+        self._covered_from = None  # Oldest version the history can continue from
+        self._subscribers = 0
+        self._thread = None
+
+    def stream(self, last_version=None):
+        """Yield SSE frames for changes after last_version until the client leaves."""
+        self._subscribe()
+        try:
+            with self._cond:
+                if last_version is None or last_version > self._version:
+                    last_version = self._version
+            yield 'retry: 5000\n\n'
+            while True:
+                with self._cond:
+                    if last_version < self._covered_from:
+                        # The history no longer reaches back far enough
+                        frames = ['event: resync\ndata: {"version": %d}\n\n' % self._version]
+                        last_version = self._version
+                    else:
+                        if self._version <= last_version:
+                            self._cond.wait(self.heartbeat)
+                        frames = [frame for version, frame in self._events if version > last_version]
+                        last_version = max(last_version, self._version)
+                yield ''.join(frames) if frames else ': keepalive\n\n'
+        finally:
+            self._unsubscribe()
+
+    def stats(self):
+        with self._cond:
+            return {'subscribers': self._subscribers, 'version': self._version, 'events': len(self._events)}
+
+    def _subscribe(self):
+        with self._cond:
+            self._subscribers += 1
+            if self._thread is None:
+                # Start polling with the first client; the first load sets the baseline
+                try:
+                    self._version = self.load_version()
+                except Exception:
+                    self._subscribers -= 1
+                    raise
+                self._covered_from = self._version
+                self._thread = threading.Thread(target=self._run, name='tally-broadcaster', daemon=True)
+                self._thread.start()
+
+    def _unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def _run(self):
+        idle_since = None
+        while True:
+            time.sleep(self.interval)
+            with self._cond:
+                if self._subscribers == 0:
+                    idle_since = idle_since or time.monotonic()
+                    if time.monotonic() - idle_since >= self.idle_timeout:
+                        # Stop polling; the next subscriber starts a fresh poller
+                        self._thread = None
+                        self._events.clear()
+                        return
+                    continue
+                idle_since = None
+                since = self._version
+            try:
+                version, changed, removed = self.load_changes(since)
+            except Exception as e:
+                print(f"Error polling tally changes: {e}")
+                continue
+            if version <= since:
+                continue
+            with self._cond:
+                if changed or removed:
+                    if len(self._events) == self._events.maxlen:
+                        self._covered_from = self._events[0][0]
+                    data = json.dumps({'version': version, 'full': False, 'judges': changed, 'removed': removed},
+                                      separators=(',', ':'))
+                    self._events.append((version, 'id: %d\nevent: tallies\ndata: %s\n\n' % (version, data)))
+                self._version = version
+                self._cond.notify_all()
@@ -0,0 +1,109 @@
+"""
+Migrate stored IP addresses from VARCHAR to PostgreSQL's inet type.
+
+Converts the ip_address columns of votes, submissions, ip_geolocation and
+ip_whitelist, and ip_geolocation_prefixes.prefix to cidr, in one
+transaction. B-tree indexes on the converted columns are rebuilt as part of
+the type change; the script adds B-tree indexes for the join and equality
+paths that lacked one and GiST indexes for containment (<<=, >>=) queries
+by network. Running it again after it finished does nothing.
+
+The apps expect the inet columns, so run this before deploying them:
+
+    python migrate_ip_inet.py
+"""
+import sys
+from dotenv import load_dotenv
+
+load_dotenv('.env.local')
+
+from db import transaction
+from geolocation_prefixes import create_geolocation_prefix_schema
+
+IP_COLUMNS = [
+    ('votes', 'ip_address'),
+    ('submissions', 'ip_address'),
+    ('ip_geolocation', 'ip_address'),
+    ('ip_whitelist', 'ip_address'),
+]
+
+# Same checks the old text version of ip_geolocation_prefix() made, so bad
+# values are reported instead of failing the conversion
+VALID_IP_SQL = '''
+    CREATE OR REPLACE FUNCTION pg_temp.is_valid_ip(ip TEXT) RETURNS BOOLEAN AS $$
+        SELECT ip ~ '^((25[0-5]|2[0-4][0-9]|1?[0-9]?[0-9])\\.){3}(25[0-5]|2[0-4][0-9]|1?[0-9]?[0-9])$'
+            OR (ip ~ '^[0-9A-Fa-f]{0,4}(:[0-9A-Fa-f]{0,4}){2,7}$' AND ip !~ ':::' AND ip !~ '::.*::'
+                AND ip !~ '^:[^:]' AND ip !~ '[^:]:$')
+    $$ LANGUAGE sql IMMUTABLE
+'''
+
+INDEXES_SQL = '''
+    CREATE INDEX IF NOT EXISTS idx_submissions_ip ON submissions (ip_address);
+    CREATE INDEX IF NOT EXISTS idx_ip_whitelist_ip ON ip_whitelist (ip_address);
+    CREATE INDEX IF NOT EXISTS idx_votes_ip_gist ON votes USING gist (ip_address inet_ops);
+    CREATE INDEX IF NOT EXISTS idx_submissions_ip_gist ON submissions USING gist (ip_address inet_ops);
+    CREATE INDEX IF NOT EXISTS idx_ip_geolocation_ip_gist ON ip_geolocation USING gist (ip_address inet_ops);
+    CREATE INDEX IF NOT EXISTS idx_ip_geolocation_prefixes_gist
+        ON ip_geolocation_prefixes USING gist (prefix inet_ops);
+'''
+
+
+def column_type(cur, table, column):
+    cur.execute('''
+        SELECT data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s AND column_name = %s
+    ''', (table, column))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def migrate_ip_columns(cur):
+    cur.execute(VALID_IP_SQL)
+    # 'localhost' was stored by the geolocation easter egg; it becomes
+    # 127.0.0.1, whose row wins when both exist
+    if column_type(cur, 'ip_geolocation', 'ip_address') not in (None, 'inet'):
+        cur.execute('''
+            DELETE FROM ip_geolocation
+            WHERE ip_address = 'localhost'
+              AND EXISTS (SELECT 1 FROM ip_geolocation WHERE ip_address = '127.0.0.1')
+        ''')
+
+    for table, column in IP_COLUMNS:
+        data_type = column_type(cur, table, column)
+        if data_type is None or data_type == 'inet':
+            continue
+        cur.execute(f'''
+            SELECT {column}, COUNT(*) FROM {table}
+            WHERE {column} <> 'localhost' AND NOT pg_temp.is_valid_ip({column})
+            GROUP BY {column}
+            LIMIT 10
+        ''')
+        invalid = cur.fetchall()
+        if invalid:
+            raise ValueError(f"{table}.{column} holds values that are not IP addresses, e.g. {invalid}")
+        print(f"Converting {table}.{column} from {data_type} to inet...")
+        cur.execute(f'''
+            ALTER TABLE {table} ALTER COLUMN {column} TYPE inet
+            USING CASE WHEN {column} = 'localhost' THEN '127.0.0.1'::inet ELSE {column}::inet END
+        ''')
+
+    cur.execute('DROP FUNCTION IF EXISTS ip_geolocation_prefix(TEXT)')
+    if column_type(cur, 'ip_geolocation_prefixes', 'prefix') not in (None, 'cidr'):
+        print("Converting ip_geolocation_prefixes.prefix to cidr...")
+        cur.execute('ALTER TABLE ip_geolocation_prefixes ALTER COLUMN prefix TYPE cidr USING prefix::cidr')
+    # Creates the table if it is missing and the inet version of the function
+    create_geolocation_prefix_schema(cur)
+
+    print("Creating indexes...")
+    cur.execute(INDEXES_SQL)
+    cur.execute('ANALYZE votes; ANALYZE submissions; ANALYZE ip_geolocation; ANALYZE ip_whitelist')
+
+
+if __name__ == '__main__':
+    try:
+        with transaction() as cur:
+            migrate_ip_columns(cur)
+    except Exception as e:
+        print(f"Error migrating IP columns: {e}")
+        sys.exit(1)
+    print("IP columns migrated to inet.")
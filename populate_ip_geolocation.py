@@ -1,10 +1,23 @@
-import psycopg2
-import psycopg2.extras
-from psycopg2.extras import RealDictCursor
+"""
+Backfill geolocation data for voter and submitter IPs.
+
+The IPs to look up are collected once into a temporary table, then read
+from it in order in batches and looked up by a pool of threads that
+share one token bucket, so the whole run stays under the API's rate limit.
+After each batch the last IP is written to a checkpoint file; a restarted
+run resumes after it. IPs that failed are retried by running again with
+--restart.
+
+    python populate_ip_geolocation.py --workers 8 --rate 10
+"""
+import argparse
 import os
-from ip_geolocation import get_ip_geolocation
-from time import sleep
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 
 # Load environment variables
 def load_env_vars():
@@ -20,59 +33,183 @@ def load_env_vars():
 # Load environment variables
 load_env_vars()
 
-def get_db_connection():
-    conn = psycopg2.connect(
-        host=os.environ.get('DB_HOST', 'localhost'),
-        port=os.environ.get('DB_PORT', '5432'),
-        dbname=os.environ.get('DB_NAME', 'jai_db'),
-        user=os.environ.get('DB_USER', 'jai'),
-        password=os.environ.get('DB_PASSWORD', '')
+# The geolocation module lives with the admin app; both use the shared db module
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'admin_app'))
+from db import connection, transaction
+import ip_geolocation
+from ip_geolocation import get_ip_geolocation, is_supported, locate_ip_votes
+from tallies import backfill_vote_countries
+
+DEFAULT_CHECKPOINT_PATH = 'populate_ip_geolocation.checkpoint'
+
+# Neither an own geolocation row nor a verified prefix
+UNLOCATED_SQL = '''
+    NOT EXISTS (SELECT 1 FROM ip_geolocation g WHERE g.ip_address = ips.ip_address)
+    AND NOT EXISTS (
+        SELECT 1 FROM ip_geolocation_prefixes p
+        WHERE p.prefix = ip_geolocation_prefix(ips.ip_address) AND p.verified
     )
-    conn.autocommit = True
-    return conn
-
-def query_db(query, args=(), one=False, commit=True):
-    conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=RealDictCursor if one else None)
-    cur.execute(query, args)
-    if commit:
-        conn.commit()
-    rv = cur.fetchall()
-    cur.close()
-    conn.close()
-    return (dict(rv[0]) if rv else None) if one else rv
-
-def populate_missing_geolocation_data():
-    print("Fetching unique IP addresses from submissions...")
-    # Get all unique IP addresses from submissions
-    submissions_ips = query_db('''
-        SELECT DISTINCT ip_address 
-        FROM submissions 
-        WHERE ip_address NOT IN (
-            SELECT ip_address 
-            FROM ip_geolocation
-        )
-    ''')
-
-    total_ips = len(submissions_ips)
-    print(f"Found {total_ips} IP addresses without geolocation data")
-
-    # Process each IP address
-    for i, row in enumerate(submissions_ips, 1):
-        ip_address = row['ip_address'] if isinstance(row, dict) else row[0]
-        print(f"Processing IP {i}/{total_ips}: {ip_address}")
+'''
+
+# Distinct IPs seen in votes or submissions that are not located yet,
+# collected once per run into a temporary table keyed by address
+CREATE_MISSING_IPS_SQL = '''
+    CREATE TEMP TABLE missing_ips AS
+    SELECT ips.ip_address
+    FROM (
+        SELECT ip_address FROM votes
+        UNION
+        SELECT ip_address FROM submissions
+    ) ips
+    WHERE (%(after)s::inet IS NULL OR ips.ip_address > %(after)s::inet)
+      AND ''' + UNLOCATED_SQL + ''';
+    ALTER TABLE missing_ips ADD PRIMARY KEY (ip_address);
+'''
+
+# The next batch after the checkpoint, by key. IPs located since the table
+# was filled, e.g. through a prefix verified by an earlier batch, are skipped.
+MISSING_IPS_SQL = '''
+    SELECT host(ips.ip_address) AS ip_address
+    FROM missing_ips ips
+    WHERE (%(after)s::inet IS NULL OR ips.ip_address > %(after)s::inet)
+      AND ''' + UNLOCATED_SQL + '''
+    ORDER BY ips.ip_address
+    LIMIT %(limit)s
+'''
+
+class TokenBucket:
+    """Allows rate acquisitions per second on average, in bursts of up to burst."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+class Progress:
+    def __init__(self, total, interval):
+        self.total = total
+        self.interval = interval
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self._started_at = time.monotonic()
+        self._reported_at = self._started_at
+        self._lock = threading.Lock()
+
+    def record(self, outcome):
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            if time.monotonic() - self._reported_at >= self.interval:
+                self._report()
+
+    def report(self):
+        with self._lock:
+            self._report()
+
+    def _report(self):
+        self._reported_at = time.monotonic()
+        done = self.succeeded + self.failed + self.skipped
+        elapsed = self._reported_at - self._started_at
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = f"{(self.total - done) / rate:.0f}s" if rate > 0 and self.total > done else '-'
+        print(f"{done}/{self.total} IPs ({self.succeeded} ok, {self.failed} failed, "
+              f"{self.skipped} skipped), {rate:.1f} IPs/s, ETA {eta}")
+
+def read_checkpoint(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return ''
+
+def write_checkpoint(path, ip_address):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(ip_address)
+    os.replace(tmp_path, path)
+
+def geolocate(ip_address):
+    if not is_supported(ip_address):
+        return 'skipped'
+    try:
+        row = get_ip_geolocation(ip_address)
+        if row:
+            locate_ip_votes(ip_address, row)
+            return 'succeeded'
+        print(f"✗ Failed to get geolocation data for {ip_address}")
+    except Exception as e:
+        print(f"✗ Error processing {ip_address}: {str(e)}")
+    return 'failed'
+
+def populate_missing_geolocation_data(workers=8, rate=10.0, batch_size=1000,
+                                      checkpoint_path=DEFAULT_CHECKPOINT_PATH, restart=False,
+                                      report_interval=10.0):
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    last_ip = read_checkpoint(checkpoint_path) or None
+    if last_ip:
+        print(f"Resuming after {last_ip}")
+
+    # Votes from IPs that were located after the votes were stored
+    with transaction() as cur:
+        backfill_vote_countries(cur)
+    print("Copied known countries onto votes stored without one")
+
+    # Every worker shares the bucket and keeps a connection open to the API
+    bucket = TokenBucket(rate, burst=max(1, workers))
+    ip_geolocation.api_throttle = bucket.acquire
+    ip_geolocation.api_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+
+    # The temporary table lives in this connection's session, so batches
+    # are read through the same connection
+    with connection() as conn, conn.cursor() as cur:
+        cur.execute(CREATE_MISSING_IPS_SQL, {'after': last_ip})
+        cur.execute('SELECT COUNT(*) FROM missing_ips')
+        total = cur.fetchone()[0]
+        print(f"Found {total} IP addresses without geolocation data")
+
+        progress = Progress(total, report_interval)
         try:
-            geo_data = get_ip_geolocation(ip_address)
-            if geo_data:
-                print(f"✓ Successfully cached geolocation data for {ip_address}")
-            else:
-                print(f"✗ Failed to get geolocation data for {ip_address}")
-            # Add a small delay to avoid hitting API rate limits
-            sleep(1)
-        except Exception as e:
-            print(f"✗ Error processing {ip_address}: {str(e)}")
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                while True:
+                    cur.execute(MISSING_IPS_SQL, {'after': last_ip, 'limit': batch_size})
+                    ips = [row[0] for row in cur.fetchall()]
+                    if not ips:
+                        break
+                    for outcome in pool.map(geolocate, ips):
+                        progress.record(outcome)
+                    # The whole batch is done, so a restart can skip it
+                    last_ip = ips[-1]
+                    write_checkpoint(checkpoint_path, last_ip)
+        finally:
+            # The connection goes back to the pool
+            cur.execute('DROP TABLE IF EXISTS missing_ips')
 
+    progress.report()
     print("\nGeolocation data population complete!")
+    if progress.failed:
+        print(f"{progress.failed} IPs failed; run again with --restart to retry them")
 
 if __name__ == '__main__':
-    populate_missing_geolocation_data()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Backfill geolocation data for voter and submitter IPs')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent lookups')
+    parser.add_argument('--rate', type=float, default=10.0, help='API requests per second across all workers')
+    parser.add_argument('--batch-size', type=int, default=1000, help='IPs read and checkpointed at a time')
+    parser.add_argument('--checkpoint', default=DEFAULT_CHECKPOINT_PATH, help='checkpoint file')
+    parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start over')
+    args = parser.parse_args()
+    populate_missing_geolocation_data(args.workers, args.rate, args.batch_size, args.checkpoint, args.restart)
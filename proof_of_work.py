@@ -0,0 +1,255 @@
+"""
+Server-issued proof-of-work challenges.
+
+A challenge names what it is for (a vote on one judge, or a judge
+submission), when it was issued and how much work it needs, and carries an
+HMAC over those fields and the client IP. Verification needs nothing but the
+secret: the client must find a nonce for which sha256("<challenge>:<nonce>")
+starts with the required number of zero bits.
+
+The required work is set per endpoint by DifficultyController, which adds
+bits while the endpoint is overloaded and for clients with a bad record.
+Since a challenge states its own difficulty, solutions are checked against
+the controller's current floor as well, so a client cannot keep using
+challenges fetched before the difficulty went up.
+
+Each challenge can be redeemed once. Redeemed challenges go into a pair of
+Bloom filters in a memory-mapped file shared by the workers on a host, one
+filter per challenge-lifetime window. A filter is wiped when its slot is
+reused for a new window, which is safe because challenges from two windows
+ago have expired, so memory use is fixed no matter how much is redeemed.
+"""
+import fcntl
+import hashlib
+import hmac
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+CHALLENGE_VERSION = 'v1'
+FILTER_HEADER = struct.Struct('<q')  # window the filter holds
+
+
+def leading_zero_bits(digest):
+    value = int.from_bytes(digest, 'big')
+    return len(digest) * 8 - value.bit_length()
+
+
+def default_seen_path(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'{name}.pow')
+
+
+class SeenChallenges:
+    """Two rotating Bloom filters of redeemed challenges, shared across processes."""
+
+    def __init__(self, path, bits=1 << 23, hashes=7):
+        self.path = path
+        self.bits = bits
+        self.hashes = hashes
+        self._filter_size = FILTER_HEADER.size + bits // 8
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._file = None
+        self._mm = None
+
+    def add(self, key, window):
+        """
+        Record key as redeemed in window. Returns False when it was already
+        there (or may have been, at the filter's false-positive rate).
+        """
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        h1, h2 = struct.unpack_from('<QQ', digest)
+        positions = [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+        with self._locked() as mm:
+            base = (window % 2) * self._filter_size
+            stored_window = FILTER_HEADER.unpack_from(mm, base)[0]
+            if stored_window > window:
+                return False
+            if stored_window < window:
+                # The slot still holds expired challenges from two windows ago
+                mm[base:base + self._filter_size] = bytes(self._filter_size)
+                FILTER_HEADER.pack_into(mm, base, window)
+            base += FILTER_HEADER.size
+            seen = True
+            for position in positions:
+                byte = base + position // 8
+                mask = 1 << (position % 8)
+                if not mm[byte] & mask:
+                    seen = False
+                    mm[byte] |= mask
+            return not seen
+
+    @contextmanager
+    def _locked(self):
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                # Reopen after a fork so each worker holds its own flock
+                if self._file is not None:
+                    self._file.close()
+                self._file = open(self.path, 'a+b')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+                try:
+                    if os.fstat(self._file.fileno()).st_size != 2 * self._filter_size:
+                        self._file.truncate(0)
+                        self._file.truncate(2 * self._filter_size)
+                    self._mm = mmap.mmap(self._file.fileno(), 2 * self._filter_size)
+                finally:
+                    fcntl.flock(self._file, fcntl.LOCK_UN)
+                self._pid = os.getpid()
+            fcntl.flock(self._file, fcntl.LOCK_EX)
+            try:
+                yield self._mm
+            finally:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+
+
+class DifficultyPolicy:
+    def __init__(self, base_bits, max_bits, target_rate, target_latency=0.25, max_failure_rate=0.05):
+        """
+        target_rate is in requests per second per worker and target_latency
+        in seconds of database time per request.
+        """
+        self.base_bits = base_bits
+        self.max_bits = max_bits
+        self.target_rate = target_rate
+        self.target_latency = target_latency
+        self.max_failure_rate = max_failure_rate
+
+
+class _DecayingSum:
+    """A sum whose past contributions fade with time constant tau."""
+
+    def __init__(self, tau):
+        self.tau = tau
+        self.value = 0.0
+        self.updated_at = time.monotonic()
+
+    def get(self, now):
+        return self.value * math.exp((self.updated_at - now) / self.tau)
+
+    def add(self, amount, now):
+        self.value = self.get(now) + amount
+        self.updated_at = now
+
+
+class _EndpointLoad:
+    def __init__(self, tau):
+        self.requests = _DecayingSum(tau)
+        self.operations = _DecayingSum(tau)
+        self.latency = _DecayingSum(tau)
+        self.failures = _DecayingSum(tau)
+
+
+class DifficultyController:
+    """
+    Picks the proof-of-work difficulty for an endpoint.
+
+    Each worker tracks its own request rate, database latency and failure
+    rate per endpoint over the last tau seconds or so. The endpoint's
+    pressure is the worst of the three as a multiple of its target, and
+    every doubling of pressure adds a bit, which doubles the expected work
+    per request. Clients get further bits for each recent strike against
+    their IP, as reported by strikes(ip_address).
+    """
+
+    def __init__(self, policies, strikes=None, tau=30.0):
+        self.policies = policies
+        self.strikes = strikes
+        self._lock = threading.Lock()
+        self._load = {endpoint: _EndpointLoad(tau) for endpoint in policies}
+
+    def record_request(self, endpoint):
+        with self._lock:
+            self._load[endpoint].requests.add(1, time.monotonic())
+
+    def record_operation(self, endpoint, latency, failed=False):
+        """Record one database operation made on behalf of the endpoint."""
+        now = time.monotonic()
+        with self._lock:
+            load = self._load[endpoint]
+            load.operations.add(1, now)
+            load.latency.add(latency, now)
+            load.failures.add(1 if failed else 0, now)
+
+    def pressure(self, endpoint):
+        policy = self.policies[endpoint]
+        now = time.monotonic()
+        with self._lock:
+            load = self._load[endpoint]
+            rate = load.requests.get(now) / load.requests.tau
+            operations = load.operations.get(now)
+            latency = load.latency.get(now) / operations if operations >= 1 else 0.0
+            failure_rate = load.failures.get(now) / operations if operations >= 1 else 0.0
+        return max(rate / policy.target_rate, latency / policy.target_latency,
+                   failure_rate / policy.max_failure_rate)
+
+    def difficulty(self, endpoint, ip_address=None):
+        policy = self.policies[endpoint]
+        bits = policy.base_bits
+        pressure = self.pressure(endpoint)
+        if pressure > 1:
+            bits += math.ceil(math.log2(pressure))
+        if self.strikes is not None and ip_address:
+            bits += int(self.strikes(ip_address))
+        return min(bits, policy.max_bits)
+
+    def floor(self, endpoint, ip_address=None, slack=2):
+        """
+        Return the fewest bits a solution may carry: what would be issued
+        now, less slack bits so challenges fetched just before the load or
+        the client's strikes went up still pass, but never below the base.
+        """
+        return max(self.policies[endpoint].base_bits, self.difficulty(endpoint, ip_address) - slack)
+
+
+class ChallengeIssuer:
+    def __init__(self, secret, seen, ttl=300):
+        """secret must be the same on every worker and node that verifies."""
+        self.secret = secret.encode('utf-8') if isinstance(secret, str) else secret
+        self.seen = seen
+        self.ttl = ttl
+
+    def issue(self, scope, ip_address, difficulty):
+        """Return a challenge for scope (e.g. 'vote:12') bound to the client IP."""
+        fields = [CHALLENGE_VERSION, scope, str(int(time.time())), str(difficulty), os.urandom(8).hex()]
+        return '.'.join(fields + [self._sign(fields, ip_address)])
+
+    def verify(self, challenge, nonce, scope, ip_address, min_difficulty=0):
+        """
+        Return None when the solution is valid and unused, else an error
+        message. Challenges asking for fewer than min_difficulty bits are
+        rejected even when properly signed.
+        """
+        try:
+            version, challenge_scope, issued_at, difficulty, salt, signature = str(challenge).split('.')
+            issued_at = int(issued_at)
+            difficulty = int(difficulty)
+        except ValueError:
+            return 'Invalid proof of work'
+        fields = [version, challenge_scope, str(issued_at), str(difficulty), salt]
+        if version != CHALLENGE_VERSION or challenge_scope != scope:
+            return 'Invalid proof of work'
+        if not hmac.compare_digest(signature, self._sign(fields, ip_address)):
+            return 'Invalid proof of work'
+        if difficulty < min_difficulty:
+            return 'Invalid proof of work'
+        age = time.time() - issued_at
+        if age > self.ttl or age < -5:
+            return 'Proof of work expired'
+        digest = hashlib.sha256(f'{challenge}:{nonce}'.encode('utf-8')).digest()
+        if leading_zero_bits(digest) < difficulty:
+            return 'Invalid proof of work'
+        # Only work that checks out is recorded, so junk cannot fill the filters
+        if not self.seen.add(challenge, issued_at // self.ttl):
+            return 'Proof of work already used'
+        return None
+
+    def _sign(self, fields, ip_address):
+        message = '|'.join(fields + [ip_address or '']).encode('utf-8')
+        return hmac.new(self.secret, message, hashlib.sha256).hexdigest()[:32]
@@ -0,0 +1,193 @@
+"""
+Sliding-window rate limiting shared by every worker process on a host.
+
+Policies are declared up front and name the request attribute they are
+keyed on: the client IP, the IP and judge together, or the browser
+fingerprint. Counters live in a fixed-size hash table in a memory-mapped
+file on /dev/shm, so all workers enforce one limit and a rejected request
+never touches the database. Each slot keeps the hit counts of the current
+and the previous window; a sliding policy weighs the previous window by how
+much of it still overlaps the last `window` seconds, a fixed policy resets
+at each window boundary. Windows are aligned to the Unix epoch, so daily
+windows start at midnight UTC, the day votes' vote_day is counted in.
+
+The table is copied to a state file every persist_interval seconds and
+loaded from it when the shared-memory file is created, so counters survive
+a reboot. When the table is full the slot closest to expiry is reused,
+which can only make the limiter more lenient, never stricter.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+MAGIC = b'JAIRL001'
+HEADER = struct.Struct('<8sIId')  # magic, slot count, unused, last persisted at
+SLOT = struct.Struct('<QIIII')  # key hash, window index, current, previous, expires at
+# Slots checked per key before the entry closest to expiry is evicted
+PROBES = 8
+
+KEY_FIELDS = {
+    'ip': ('ip',),
+    'ip_judge': ('ip', 'judge_id'),
+    'fingerprint': ('fingerprint',),
+}
+
+
+class RateLimitPolicy:
+    def __init__(self, name, key, limit, window, sliding=True):
+        if key not in KEY_FIELDS:
+            raise ValueError('Unknown rate limit key: %s' % key)
+        self.name = name
+        self.key = key
+        self.limit = limit
+        self.window = window
+        self.sliding = sliding
+
+
+def default_state_path(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'{name}.ratelimit')
+
+
+class RateLimiter:
+    def __init__(self, policies, path, persist_path=None, persist_interval=60.0, slots=65536):
+        self.policies = {policy.name: policy for policy in policies}
+        self.path = path
+        self.persist_path = persist_path
+        self.persist_interval = persist_interval
+        self.slots = slots
+        self._size = HEADER.size + SLOT.size * slots
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+        self._mm = None
+
+    def allowed(self, name, **values):
+        """Return whether one more hit would be within the policy, without counting it."""
+        return self._hit(name, values, 0)
+
+    def hit(self, name, **values):
+        """Count a hit and return True, or return False without counting when over the limit."""
+        return self._hit(name, values, 1)
+
+    def count(self, name, **values):
+        """Return the number of hits the policy currently sees for the key."""
+        return self._hit(name, values, None)
+
+    def _hit(self, name, values, cost):
+        policy = self.policies[name]
+        parts = [values.get(field) for field in KEY_FIELDS[policy.key]]
+        if any(part is None or part == '' for part in parts):
+            # Nothing to key on, e.g. a client without a fingerprint
+            return True if cost is not None else 0
+        key = _key_hash(name, parts)
+        now = time.time()
+        window = int(now // policy.window)
+        weight = 1.0 - (now % policy.window) / policy.window if policy.sliding else 0.0
+        expires = int((window + 2) * policy.window)
+
+        snapshot = None
+        with self._locked() as mm:
+            offset, found = self._find(mm, key, now)
+            if found:
+                _, stored_window, current, previous, _ = SLOT.unpack_from(mm, offset)
+                if stored_window == window - 1:
+                    current, previous = 0, current
+                elif stored_window != window:
+                    current, previous = 0, 0
+            else:
+                current, previous = 0, 0
+            if cost is None:
+                return current + previous * weight
+            # A check without a hit asks whether one more hit would fit
+            ok = current + previous * weight + (cost or 1) <= policy.limit
+            if ok and cost:
+                SLOT.pack_into(mm, offset, key, window, current + cost, previous, expires)
+            if self.persist_path and now - HEADER.unpack_from(mm, 0)[3] >= self.persist_interval:
+                HEADER.pack_into(mm, 0, MAGIC, self.slots, 0, now)
+                snapshot = mm[:]
+        if snapshot is not None:
+            self._persist(snapshot)
+        return ok
+
+    def _find(self, mm, key, now):
+        """Return (slot offset, True) for key, or (offset of a reusable slot, False)."""
+        start = key % self.slots
+        candidate = None
+        candidate_expires = None
+        for probe in range(PROBES):
+            offset = HEADER.size + SLOT.size * ((start + probe) % self.slots)
+            slot_key, _, _, _, slot_expires = SLOT.unpack_from(mm, offset)
+            if slot_key == key:
+                return offset, True
+            if slot_key == 0 or slot_expires <= now:
+                slot_expires = 0
+            if candidate is None or slot_expires < candidate_expires:
+                candidate, candidate_expires = offset, slot_expires
+        return candidate, False
+
+    @contextmanager
+    def _locked(self):
+        """Hold the thread and file locks and yield the mapped table."""
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield self._mm
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        # Reopen after a fork: flock locks belong to the open file, which a
+        # forked worker would otherwise share with its parent
+        if self._lock_file is not None:
+            self._lock_file.close()
+        self._lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                if os.fstat(fd).st_size != self._size:
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self._size)
+                    self._restore(fd)
+                self._mm = mmap.mmap(fd, self._size)
+            finally:
+                os.close(fd)
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._pid = os.getpid()
+
+    def _restore(self, fd):
+        data = None
+        if self.persist_path and os.path.exists(self.persist_path):
+            with open(self.persist_path, 'rb') as f:
+                data = f.read()
+            if len(data) != self._size or HEADER.unpack_from(data, 0)[:2] != (MAGIC, self.slots):
+                print(f"Ignoring rate limit state {self.persist_path}: it does not match this table")
+                data = None
+        if data is None:
+            data = HEADER.pack(MAGIC, self.slots, 0, time.time())
+        os.pwrite(fd, data, 0)
+
+    def _persist(self, data):
+        tmp_path = '%s.%d.tmp' % (self.persist_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self.persist_path)
+        except OSError as e:
+            print(f"Error persisting rate limit state: {e}")
+
+
+def _key_hash(name, parts):
+    data = '\0'.join([name] + [str(part) for part in parts]).encode('utf-8')
+    # Zero marks an empty slot
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little') or 1
@@ -0,0 +1,99 @@
+"""
+Versioned reference data shared by the main app and the admin app.
+
+Rarely changing tables (the IP whitelist, the set of displayed judges) are
+kept in memory by each worker. Writers bump the data set's row in
+reference_data_versions in the same transaction as their change, and
+readers reload their copy only when that version moved. Whitelist changes
+are versioned by a trigger, since entries are added outside the apps.
+"""
+import threading
+import time
+
+CREATE_REFERENCE_DATA_SQL = '''
+    CREATE TABLE IF NOT EXISTS reference_data_versions (
+        name VARCHAR(32) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE OR REPLACE FUNCTION bump_ip_whitelist_version() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO reference_data_versions (name, version) VALUES ('ip_whitelist', 1)
+        ON CONFLICT (name) DO UPDATE SET
+            version = reference_data_versions.version + 1,
+            updated_at = CURRENT_TIMESTAMP;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    CREATE OR REPLACE TRIGGER ip_whitelist_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON ip_whitelist
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_ip_whitelist_version();
+'''
+
+BUMP_VERSION_SQL = '''
+    INSERT INTO reference_data_versions (name, version) VALUES (%s, 1)
+    ON CONFLICT (name) DO UPDATE SET
+        version = reference_data_versions.version + 1,
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+
+def create_reference_data_schema(cur):
+    cur.execute(CREATE_REFERENCE_DATA_SQL)
+
+
+def bump_reference_version(cur, name):
+    """Mark a reference data set as changed; call in the writing transaction."""
+    cur.execute(BUMP_VERSION_SQL, (name,))
+
+
+def reference_version(cur, name):
+    cur.execute('SELECT version FROM reference_data_versions WHERE name = %s', (name,))
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def load_ip_whitelist(cur):
+    """Return {ip_address: expiry} for whitelist entries that have not expired."""
+    cur.execute('SELECT ip_address, expiry FROM ip_whitelist WHERE expiry > CURRENT_TIMESTAMP')
+    return dict(cur.fetchall())
+
+
+def load_displayed_judge_ids(cur):
+    cur.execute('SELECT id FROM judges WHERE displayed = 1')
+    return frozenset(row[0] for row in cur.fetchall())
+
+
+class ReferenceCache:
+    """
+    This worker's copy of one reference data set.
+
+    The version is checked at most once per check_interval seconds and the
+    data is reloaded only when the version moved.
+    """
+
+    def __init__(self, load_version, load_data, check_interval=5.0):
+        self.load_version = load_version
+        self.load_data = load_data
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._data = None
+        self._version = None
+        self._checked_at = 0.0
+
+    def get(self):
+        data = self._data
+        if data is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return data
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self._data is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return self._data
+            # Read the version first so a change made during the load is
+            # picked up by the next check
+            version = self.load_version()
+            if self._data is None or version != self._version:
+                self._data = self.load_data()
+                self._version = version
+            self._checked_at = time.monotonic()
+            return self._data
@@ -0,0 +1,183 @@
+"""
+Flask-Caching backend shared by every worker process on a host.
+
+Entries live in a memory-mapped SQLite file on /dev/shm (or the temp
+directory when /dev/shm is missing), so all workers see one copy of each
+entry without an external cache service. Entries expire by TTL, and the
+least recently used ones are evicted once the entry count or total size
+goes over its limit. get_or_compute() adds single-flight recomputation:
+when an entry is missing, one process rebuilds it while the others wait
+for the result.
+
+Configuration (Flask config keys):
+
+    CACHE_SHARED_PATH       cache file path
+    CACHE_SHARED_MAX_BYTES  total size limit of stored values (default 64 MiB)
+    CACHE_THRESHOLD         maximum number of entries (default 500)
+    CACHE_DEFAULT_TIMEOUT   default TTL in seconds (default 300, 0 = no expiry)
+"""
+import fcntl
+import hashlib
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask_caching.backends.base import BaseCache
+
+# Refresh an entry's LRU timestamp at most this often, so reads rarely write
+ACCESS_RESOLUTION = 1.0
+# Number of lock files keys are spread over for single-flight recomputation
+LOCK_STRIPES = 64
+
+
+def default_cache_path(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'{name}.cache')
+
+
+class SharedMemoryCache(BaseCache):
+    def __init__(self, path, max_bytes=64 * 1024 * 1024, threshold=500, default_timeout=300):
+        super().__init__(default_timeout=default_timeout)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.threshold = threshold
+        self._local = threading.local()
+        self._lock_dir = path + '.locks'
+        os.makedirs(self._lock_dir, exist_ok=True)
+        with self._connection() as db:
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL,
+                    size INTEGER NOT NULL
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_entries_accessed ON entries (accessed)')
+
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs.update(
+            path=config.get('CACHE_SHARED_PATH') or default_cache_path('jai_' + os.path.basename(app.root_path)),
+            max_bytes=config.get('CACHE_SHARED_MAX_BYTES', 64 * 1024 * 1024),
+            threshold=config.get('CACHE_THRESHOLD', 500),
+            default_timeout=config.get('CACHE_DEFAULT_TIMEOUT', 300)
+        )
+        return cls(*args, **kwargs)
+
+    def _connection(self):
+        # One connection per thread and process; SQLite handles cross-process locking
+        db = getattr(self._local, 'db', None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=OFF')
+            db.execute('PRAGMA mmap_size=%d' % (self.max_bytes * 2))
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _expiry(self, timeout):
+        timeout = self._normalize_timeout(timeout)
+        return time.time() + timeout if timeout > 0 else float('inf')
+
+    def get(self, key):
+        db = self._connection()
+        row = db.execute('SELECT value, expires, accessed FROM entries WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires, accessed = row
+        now = time.time()
+        if expires <= now:
+            db.execute('DELETE FROM entries WHERE key = ? AND expires <= ?', (key, now))
+            return None
+        if now - accessed >= ACCESS_RESOLUTION:
+            db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        try:
+            return pickle.loads(value)
+        except Exception:
+            return None
+
+    def set(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return False
+        now = time.time()
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT OR REPLACE INTO entries (key, value, expires, accessed, size) VALUES (?, ?, ?, ?, ?)',
+                       (key, data, self._expiry(timeout), now, len(data)))
+            self._evict(db, now)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return True
+
+    def add(self, key, value, timeout=None):
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM entries WHERE key = ? AND expires <= ?', (key, now))
+            cursor = db.execute('INSERT OR IGNORE INTO entries (key, value, expires, accessed, size) '
+                                'VALUES (?, ?, ?, ?, ?)', (key, data, self._expiry(timeout), now, len(data)))
+            self._evict(db, now)
+            db.execute('COMMIT')
+        except Exception:
+            db.execute('ROLLBACK')
+            raise
+        return cursor.rowcount == 1
+
+    def delete(self, key):
+        return self._connection().execute('DELETE FROM entries WHERE key = ?', (key,)).rowcount == 1
+
+    def has(self, key):
+        row = self._connection().execute('SELECT 1 FROM entries WHERE key = ? AND expires > ?',
+                                         (key, time.time())).fetchone()
+        return row is not None
+
+    def clear(self):
+        self._connection().execute('DELETE FROM entries')
+        return True
+
+    def _evict(self, db, now):
+        db.execute('DELETE FROM entries WHERE expires <= ?', (now,))
+        count, total = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        if count <= self.threshold and total <= self.max_bytes:
+            return
+        # Drop least recently used entries until both limits hold again
+        for key, size in db.execute('SELECT key, size FROM entries ORDER BY accessed').fetchall():
+            if count <= self.threshold and total <= self.max_bytes:
+                break
+            db.execute('DELETE FROM entries WHERE key = ?', (key,))
+            count -= 1
+            total -= size
+
+    def get_or_compute(self, key, compute, timeout=None):
+        """
+        Return the cached value for key, computing it at most once per host.
+
+        Concurrent callers for the same missing key block until the first one
+        has stored its result, then read it instead of computing again.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        stripe = int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % LOCK_STRIPES
+        with open(os.path.join(self._lock_dir, '%d.lock' % stripe), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                value = self.get(key)
+                if value is None:
+                    value = compute()
+                    self.set(key, value, timeout)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -1,4 +1,4 @@
-import { showNotification, calculateHMAC, calculateProofOfWork, fpPromise, hmacSecretKey } from './utils.js';
+import { showNotification, calculateHMAC, calculateProofOfWork, fpPromise, getHmacKey } from './utils.js';
 
 // Handle form submission
 export function initializeForm(modal, form) {
@@ -19,25 +19,38 @@ export function initializeForm(modal, form) {
         const fingerprint = result.visitorId;
 
         // Calculate proof of work
-        const difficulty = 4; // Example difficulty
-        const { nonce, hash } = await calculateProofOfWork(difficulty);
-        formData.proofOfWork = { nonce, hash }; // Add proof of work to form data
+        try {
+            formData.proofOfWork = await calculateProofOfWork('/challenge/submit-judge');
+        } catch (error) {
+            console.error('Error:', error);
+            alert('Error submitting judge. Please try again.');
+            return;
+        }
 
 
         const timestamp = Math.floor(Date.now() / 1000);
         const path = '/submit-judge';
         const body = JSON.stringify(formData);
-        const signature = await calculateHMAC(hmacSecretKey, 'POST', path, body, timestamp);
-
+        let signature;
+        let hmacKey;
+        try {
+            hmacKey = await getHmacKey();
+            signature = await calculateHMAC(hmacKey.key, 'POST', path, body, timestamp);
+        } catch (error) {
+            console.error('Error:', error);
+            alert('Error submitting judge. Please try again.');
+            return;
+        }
 
         fetch('/submit-judge', {
             method: 'POST',
             headers: {
                 'Content-Type': 'application/json',
+                'X-HMAC-Key-Id': hmacKey.kid,
                 'X-HMAC-Timestamp': timestamp,
                 'X-HMAC-Signature': signature
             },
-            body: JSON.stringify(formData)
+            body: body  // Send exactly the bytes that were signed
         })
         .then(response => response.json())
         .then(data => {
@@ -1,11 +1,145 @@
-import { showNotification, calculateHMAC, calculateProofOfWork, fpPromise, hmacSecretKey } from './utils.js';
+import { showNotification, calculateHMAC, calculateProofOfWork, fpPromise, getHmacKey } from './utils.js';
 
 // Global map to store judge cards
 const judgeIdToCardMap = {};
 
+// Latest judge data by id and the tally version it reflects
+const judgesById = {};
+let currentVersion = 0;
+let currentUsaOnly = false;
+
+// Server-Sent Events connection for live tally updates
+let liveUpdates = null;
+
+// Add filtered vote counts and status for the selected view
+function prepareJudge(judge, usaOnly) {
+    // Create a copy of the judge object to avoid modifying the original
+    const judgeWithFiltered = { ...judge };
+    
+    // Ensure all vote counts are numbers, not undefined
+    judgeWithFiltered.corrupt_votes = Number(judge.corrupt_votes || 0);
+    judgeWithFiltered.not_corrupt_votes = Number(judge.not_corrupt_votes || 0);
+    judgeWithFiltered.us_corrupt_votes = Number(judge.us_corrupt_votes || 0);
+    judgeWithFiltered.us_not_corrupt_votes = Number(judge.us_not_corrupt_votes || 0);
+    
+    if (usaOnly) {
+        // Use US-specific vote counts
+        judgeWithFiltered.corrupt_votes_filtered = judgeWithFiltered.us_corrupt_votes;
+        judgeWithFiltered.not_corrupt_votes_filtered = judgeWithFiltered.us_not_corrupt_votes;
+        
+        // Recalculate status based on filtered votes
+        const totalVotes = judgeWithFiltered.corrupt_votes_filtered + judgeWithFiltered.not_corrupt_votes_filtered;
+        judgeWithFiltered.status_filtered = 'undecided';
+        
+        if (totalVotes >= 5) {
+            const corruptRatio = judgeWithFiltered.corrupt_votes_filtered / totalVotes;
+            const notCorruptRatio = judgeWithFiltered.not_corrupt_votes_filtered / totalVotes;
+            
+            if (corruptRatio >= 0.8333) {
+                judgeWithFiltered.status_filtered = 'corrupt';
+            } else if (notCorruptRatio >= 0.8333) {
+                judgeWithFiltered.status_filtered = 'not_corrupt';
+            }
+        }
+    } else {
+        // Use regular vote counts
+        judgeWithFiltered.corrupt_votes_filtered = judgeWithFiltered.corrupt_votes;
+        judgeWithFiltered.not_corrupt_votes_filtered = judgeWithFiltered.not_corrupt_votes;
+        judgeWithFiltered.status_filtered = judge.status;
+    }
+    
+    return judgeWithFiltered;
+}
+
+// Clear the lists and draw every known judge again
+function renderAllJudges() {
+    document.getElementById('confirmed-list').innerHTML = '';
+    document.getElementById('undecided-list').innerHTML = '';
+    document.getElementById('not-corrupt-list').innerHTML = '';
+
+    const judges = Object.values(judgesById)
+        .sort((a, b) => a.id - b.id)
+        .map(judge => prepareJudge(judge, currentUsaOnly));
+    displayJudges(judges, currentUsaOnly);
+}
+
+// Merge a /judges snapshot or a /judges/changes delta into the page.
+// Cards are updated in place unless a judge appeared, disappeared or changed status.
+export function applyJudgeChanges(data) {
+    if (!data || !Array.isArray(data.judges)) {
+        console.error('Invalid judge changes received:', data);
+        return;
+    }
+
+    // Ignore deltas we have already moved past
+    if (!data.full && data.version <= currentVersion) {
+        return;
+    }
+
+    let needsRender = false;
+    if (data.full) {
+        Object.keys(judgesById).forEach(key => delete judgesById[key]);
+        needsRender = true;
+    }
+
+    (data.removed || []).forEach(id => {
+        if (judgesById[id]) {
+            delete judgesById[id];
+            needsRender = true;
+        }
+    });
+
+    data.judges.forEach(judge => {
+        judgesById[judge.id] = judge;
+        const card = judgeIdToCardMap[judge.id];
+        const prepared = prepareJudge(judge, currentUsaOnly);
+        if (!needsRender && card && card.dataset.status === prepared.status_filtered) {
+            fillJudgeCard(card, prepared);
+        } else {
+            needsRender = true;
+        }
+    });
+
+    currentVersion = data.version || currentVersion;
+    if (needsRender) {
+        renderAllJudges();
+    }
+}
+
+// Fetch only the judges that changed since the version we have
+export function fetchJudgeChanges() {
+    return fetch(`/judges/changes?since=${currentVersion}`)
+        .then(response => {
+            if (!response.ok) {
+                throw new Error(`HTTP error! status: ${response.status}`);
+            }
+            return response.json();
+        })
+        .then(applyJudgeChanges)
+        .catch(error => {
+            console.error('Error fetching judge changes:', error);
+        });
+}
+
+// Subscribe to tally changes pushed by the server
+export function startLiveUpdates() {
+    if (liveUpdates || typeof EventSource === 'undefined') {
+        return;
+    }
+    liveUpdates = new EventSource(`/judges/stream?since=${currentVersion}`);
+    liveUpdates.addEventListener('tallies', event => {
+        applyJudgeChanges(JSON.parse(event.data));
+    });
+    // The server could not replay everything we missed; catch up with a delta
+    liveUpdates.addEventListener('resync', () => {
+        fetchJudgeChanges();
+    });
+}
+
 // Fetch and display judges
 export function fetchAndDisplayJudges(usaOnly = false) {
     console.log('Fetching judges, USA only:', usaOnly);
+    currentUsaOnly = usaOnly;
     
     // Clear existing lists first
     document.getElementById('confirmed-list').innerHTML = '';
@@ -31,45 +165,15 @@ export function fetchAndDisplayJudges(usaOnly = false) {
                 return;
             }
             
-            // Apply USA filter in the frontend if needed
-            const judges = data.judges.map(judge => {
-                // Create a copy of the judge object to avoid modifying the original
-                const judgeWithFiltered = { ...judge };
-                
-                // Ensure all vote counts are numbers, not undefined
-                judgeWithFiltered.corrupt_votes = Number(judge.corrupt_votes || 0);
-                judgeWithFiltered.not_corrupt_votes = Number(judge.not_corrupt_votes || 0);
-                judgeWithFiltered.us_corrupt_votes = Number(judge.us_corrupt_votes || 0);
-                judgeWithFiltered.us_not_corrupt_votes = Number(judge.us_not_corrupt_votes || 0);
-                
-                if (usaOnly) {
-                    // Use US-specific vote counts
-                    judgeWithFiltered.corrupt_votes_filtered = judgeWithFiltered.us_corrupt_votes;
-                    judgeWithFiltered.not_corrupt_votes_filtered = judgeWithFiltered.us_not_corrupt_votes;
-                    
-                    // Recalculate status based on filtered votes
-                    const totalVotes = judgeWithFiltered.corrupt_votes_filtered + judgeWithFiltered.not_corrupt_votes_filtered;
-                    judgeWithFiltered.status_filtered = 'undecided';
-                    
-                    if (totalVotes >= 5) {
-                        const corruptRatio = judgeWithFiltered.corrupt_votes_filtered / totalVotes;
-                        const notCorruptRatio = judgeWithFiltered.not_corrupt_votes_filtered / totalVotes;
-                        
-                        if (corruptRatio >= 0.8333) {
-                            judgeWithFiltered.status_filtered = 'corrupt';
-                        } else if (notCorruptRatio >= 0.8333) {
-                            judgeWithFiltered.status_filtered = 'not_corrupt';
-                        }
-                    }
-                } else {
-                    // Use regular vote counts
-                    judgeWithFiltered.corrupt_votes_filtered = judgeWithFiltered.corrupt_votes;
-                    judgeWithFiltered.not_corrupt_votes_filtered = judgeWithFiltered.not_corrupt_votes;
-                    judgeWithFiltered.status_filtered = judge.status;
-                }
-                
-                return judgeWithFiltered;
+            // Remember the raw data so later deltas can be merged into it
+            Object.keys(judgesById).forEach(key => delete judgesById[key]);
+            data.judges.forEach(judge => {
+                judgesById[judge.id] = judge;
             });
+            currentVersion = data.version || 0;
+
+            // Apply USA filter in the frontend if needed
+            const judges = data.judges.map(judge => prepareJudge(judge, usaOnly));
             
             // Log vote counts for debugging
             const totalVotesAll = judges.reduce((sum, judge) => sum + judge.corrupt_votes + judge.not_corrupt_votes, 0);
@@ -81,12 +185,75 @@ export function fetchAndDisplayJudges(usaOnly = false) {
             
             // Display judges in appropriate sections
             displayJudges(judges, usaOnly);
+
+            startLiveUpdates();
         })
         .catch(error => {
             console.error('Error fetching data:', error);
         });
 }
 
+// Write a judge's details and counts into its card
+function fillJudgeCard(card, judge) {
+    card.dataset.status = judge.status_filtered;
+
+    const totalVotes = judge.corrupt_votes_filtered + judge.not_corrupt_votes_filtered;
+    const ratio = totalVotes > 0 ? Math.round((judge.corrupt_votes_filtered / totalVotes) * 100) : 0;
+
+    const ribbon = card.querySelector('.ribbon');
+    if (ribbon) {
+        if (judge.status_filtered === 'not_corrupt') {
+            const notCorruptRatio = totalVotes > 0 ? Math.round((judge.not_corrupt_votes_filtered / totalVotes) * 100) : 0;
+            ribbon.textContent = `${notCorruptRatio}% not corrupt votes`;
+            ribbon.style.backgroundColor = '#27ae60'; // Green
+        } else if (judge.status_filtered === 'undecided') {
+            ribbon.textContent = 'Undecided';
+            ribbon.style.backgroundColor = '#1e3799'; // Blue
+        } else {
+            ribbon.textContent = `${ratio}% corrupt votes`;
+            ribbon.style.backgroundColor = '#c0392b'; // Red
+        }
+    }
+
+    const nameElement = card.querySelector('.judge-name');
+    if (nameElement) nameElement.textContent = judge.name;
+    
+    const infoElement = card.querySelector('.info strong');
+    if (infoElement && infoElement.nextSibling) infoElement.nextSibling.textContent = ` ${judge.job_position}`;
+    
+    const rulingTextElement = card.querySelector('.ruling-text');
+    if (rulingTextElement) {
+        rulingTextElement.setAttribute('title', judge.ruling);
+        const rulingStrong = rulingTextElement.querySelector('strong');
+        if (rulingStrong && rulingStrong.nextSibling) rulingStrong.nextSibling.textContent = ` ${judge.ruling}`;
+    }
+    
+    const linkElements = card.querySelectorAll('.btn-row a');
+    if (linkElements && linkElements.length > 0) {
+        if (linkElements[0]) linkElements[0].href = judge.link;
+        if (linkElements[1]) {
+            linkElements[1].href = judge.x_link || '#'; // Use '#' if x_link is null
+            linkElements[1].style.display = judge.x_link ? '' : 'none'; // Hide if no x_link
+        }
+    }
+    
+    const corruptBtn = card.querySelector('.corrupt-vote-btn');
+    if (corruptBtn) {
+        // Ensure vote count is a number and not undefined
+        const voteCount = typeof judge.corrupt_votes_filtered === 'number' ? judge.corrupt_votes_filtered : 0;
+        corruptBtn.textContent = `Corrupt (${voteCount})`;
+        corruptBtn.dataset.judgeId = judge.id;
+    }
+    
+    const notCorruptBtn = card.querySelector('.not-corrupt-vote-btn');
+    if (notCorruptBtn) {
+        // Ensure vote count is a number and not undefined
+        const voteCount = typeof judge.not_corrupt_votes_filtered === 'number' ? judge.not_corrupt_votes_filtered : 0;
+        notCorruptBtn.textContent = `Not Corrupt (${voteCount})`;
+        notCorruptBtn.dataset.judgeId = judge.id;
+    }
+}
+
 export function displayJudges(judges, usaOnly = false) {
     console.log('Starting to display judges, count:', judges ? judges.length : 0, 'USA only:', usaOnly);
     // Create a new map each time instead of reusing the old one
@@ -147,62 +314,7 @@ export function displayJudges(judges, usaOnly = false) {
             currentJudgeIdToCardMap[judge.id] = card;
             container.appendChild(card);
             
-            // Update card content
-            const totalVotes = judge.corrupt_votes_filtered + judge.not_corrupt_votes_filtered;
-            const ratio = totalVotes > 0 ? Math.round((judge.corrupt_votes_filtered / totalVotes) * 100) : 0;
-
-            const ribbon = card.querySelector('.ribbon');
-            if (ribbon) {
-                if (judge.status_filtered === 'not_corrupt') {
-                    const notCorruptRatio = totalVotes > 0 ? Math.round((judge.not_corrupt_votes_filtered / totalVotes) * 100) : 0;
-                    ribbon.textContent = `${notCorruptRatio}% not corrupt votes`;
-                    ribbon.style.backgroundColor = '#27ae60'; // Green
-                } else if (judge.status_filtered === 'undecided') {
-                    ribbon.textContent = 'Undecided';
-                    ribbon.style.backgroundColor = '#1e3799'; // Blue
-                } else {
-                    ribbon.textContent = `${ratio}% corrupt votes`;
-                    ribbon.style.backgroundColor = '#c0392b'; // Red
-                }
-            }
-
-            const nameElement = card.querySelector('.judge-name');
-            if (nameElement) nameElement.textContent = judge.name;
-            
-            const infoElement = card.querySelector('.info strong');
-            if (infoElement && infoElement.nextSibling) infoElement.nextSibling.textContent = ` ${judge.job_position}`;
-            
-            const rulingTextElement = card.querySelector('.ruling-text');
-            if (rulingTextElement) {
-                rulingTextElement.setAttribute('title', judge.ruling);
-                const rulingStrong = rulingTextElement.querySelector('strong');
-                if (rulingStrong && rulingStrong.nextSibling) rulingStrong.nextSibling.textContent = ` ${judge.ruling}`;
-            }
-            
-            const linkElements = card.querySelectorAll('.btn-row a');
-            if (linkElements && linkElements.length > 0) {
-                if (linkElements[0]) linkElements[0].href = judge.link;
-                if (linkElements[1]) {
-                    linkElements[1].href = judge.x_link || '#'; // Use '#' if x_link is null
-                    linkElements[1].style.display = judge.x_link ? '' : 'none'; // Hide if no x_link
-                }
-            }
-            
-            const corruptBtn = card.querySelector('.corrupt-vote-btn');
-            if (corruptBtn) {
-                // Ensure vote count is a number and not undefined
-                const voteCount = typeof judge.corrupt_votes_filtered === 'number' ? judge.corrupt_votes_filtered : 0;
-                corruptBtn.textContent = `Corrupt (${voteCount})`;
-                corruptBtn.dataset.judgeId = judge.id;
-            }
-            
-            const notCorruptBtn = card.querySelector('.not-corrupt-vote-btn');
-            if (notCorruptBtn) {
-                // Ensure vote count is a number and not undefined
-                const voteCount = typeof judge.not_corrupt_votes_filtered === 'number' ? judge.not_corrupt_votes_filtered : 0;
-                notCorruptBtn.textContent = `Not Corrupt (${voteCount})`;
-                notCorruptBtn.dataset.judgeId = judge.id;
-            }
+            fillJudgeCard(card, judge);
         } else {
             console.error('Template not found for judge:', judge);
         }
@@ -232,26 +344,38 @@ export async function handleVote(event) {
     const fingerprint = result.visitorId;
 
     // Calculate proof of work
-    const difficulty = 4; // Example difficulty.  Could be adjusted.
-    const { nonce, hash } = await calculateProofOfWork(difficulty);
+    let proofOfWork;
+    try {
+        proofOfWork = await calculateProofOfWork(`/challenge/vote/${judgeId}`);
+    } catch (error) {
+        console.error('Error:', error);
+        alert('Error submitting vote. Please try again.');
+        return;
+    }
 
     const timestamp = Math.floor(Date.now() / 1000);
     const path = `/vote/${judgeId}`;
-    const body = JSON.stringify({ vote_type: voteType, fingerprint: fingerprint, proofOfWork: { nonce, hash } });
-    const signature = await calculateHMAC(hmacSecretKey, 'POST', path, body, timestamp);
+    const body = JSON.stringify({ vote_type: voteType, fingerprint: fingerprint, proofOfWork });
+    let signature;
+    let hmacKey;
+    try {
+        hmacKey = await getHmacKey();
+        signature = await calculateHMAC(hmacKey.key, 'POST', path, body, timestamp);
+    } catch (error) {
+        console.error('Error:', error);
+        alert('Error submitting vote. Please try again.');
+        return;
+    }
 
     fetch(`/vote/${judgeId}`, {
         method: 'POST',
         headers: {
             'Content-Type': 'application/json',
+            'X-HMAC-Key-Id': hmacKey.kid,
             'X-HMAC-Timestamp': timestamp,
             'X-HMAC-Signature': signature
         },
-        body: JSON.stringify({
-            vote_type: voteType,
-            fingerprint: fingerprint,
-            proofOfWork: { nonce, hash }
-        })
+        body: body  // Send exactly the bytes that were signed
     })
     .then(response => {
       if (!response.ok) {
@@ -262,36 +386,11 @@ export async function handleVote(event) {
     })
     .then(data => {
         if (data.success) {
-            // Find the judge in the judgeIdToCardMap and update its vote counts
-            const card = judgeIdToCardMap[judgeId];
-            if (card) {
-               fetch('/judges')
-                 .then(response => {
-                  if (!response.ok) {
-                      throw new Error(`HTTP error! status: ${response.status}`);
-                  } else {
-                      return response.json();
-                  }
-                 })
-                 .then(updatedData => {
-                     const updatedJudge = updatedData.judges.find(j => j.id === parseInt(judgeId));
-                     if (updatedJudge) {
-              const corruptCountSpan = card.querySelector('.corrupt-vote-btn');
-              const notCorruptCountSpan = card.querySelector('.not-corrupt-vote-btn');
-              const ratioSpan = card.querySelector('.ribbon');
-
-              corruptCountSpan.textContent = `Corrupt (${updatedJudge.corrupt_votes})`;
-              notCorruptCountSpan.textContent = `Not Corrupt (${updatedJudge.not_corrupt_votes})`;
-
-              const totalVotes = updatedJudge.corrupt_votes + updatedJudge.not_corrupt_votes;
-              const newRatio = totalVotes > 0 ? Math.round((updatedJudge.corrupt_votes / totalVotes) * 100) : 0;
-              ratioSpan.textContent = `${newRatio}% corrupt votes`;
-            }
-          });
-      }
-    } else {
-      alert(data.error || 'Error submitting vote');
-    }
+            // Pull only the judges that changed instead of the whole list
+            fetchJudgeChanges();
+        } else {
+            alert(data.error || 'Error submitting vote');
+        }
   })
   .catch(error => {
     console.error('Error:', error);
@@ -20,8 +20,31 @@ export function showNotification(message, duration = 3000) {
     }, duration);
 }
 
-// TODO: Fetch this key from the server securely.  DO NOT leave it hardcoded in production.
-export const hmacSecretKey = "d174ab988d3b9b65597e98957e02b355d174ab988d3b9b65597e98957e02b355";  // Replace with your actual secret key
+// The signing key rotates; fetch the current one and reuse it until shortly
+// before it expires
+let hmacKeyPromise = null;
+let hmacKeyExpiresAt = 0;
+
+export async function getHmacKey() {
+  if (!hmacKeyPromise || Date.now() / 1000 > hmacKeyExpiresAt - 60) {
+      hmacKeyPromise = fetch('/hmac/key', { cache: 'no-store' })
+          .then(response => {
+              if (!response.ok) {
+                  throw new Error(`HTTP error! status: ${response.status}`);
+              }
+              return response.json();
+          })
+          .then(data => {
+              hmacKeyExpiresAt = data.expires_at;
+              return data;
+          })
+          .catch(error => {
+              hmacKeyPromise = null;
+              throw error;
+          });
+  }
+  return hmacKeyPromise;
+}
 
 export async function calculateHMAC(secretKey, method, path, body, timestamp) {
   const encoder = new TextEncoder();
@@ -48,20 +71,34 @@ export async function calculateHMAC(secretKey, method, path, body, timestamp) {
   return hexSignature;
 }
 
-export async function calculateProofOfWork(difficulty) {
+function leadingZeroBits(bytes) {
+  let bits = 0;
+  for (const byte of bytes) {
+      if (byte === 0) {
+          bits += 8;
+          continue;
+      }
+      return bits + Math.clz32(byte) - 24;
+  }
+  return bits;
+}
+
+// Fetch a one-time challenge from the server and solve it. The server binds
+// the challenge to the action and this client, and sets the difficulty.
+export async function calculateProofOfWork(challengePath) {
+  const response = await fetch(challengePath, { cache: 'no-store' });
+  if (!response.ok) {
+      throw new Error(`HTTP error! status: ${response.status}`);
+  }
+  const { challenge, difficulty } = await response.json();
+  const encoder = new TextEncoder();
   let nonce = 0;
   let hash;
-  const targetPrefix = '0'.repeat(difficulty);
   do {
       nonce++;
-      const data = `nonce:${nonce}`;
-      const messageData = new TextEncoder().encode(data);
-      hash = await crypto.subtle.digest('SHA-256', messageData);
-      const hexHash = Array.from(new Uint8Array(hash))
-          .map((b) => b.toString(16).padStart(2, "0"))
-          .join("");
-  } while (!hexHash.startsWith(targetPrefix));
-  return { nonce, hash: Array.from(new Uint8Array(hash)).map(b => b.toString(16).padStart(2, '0')).join('') };
+      hash = new Uint8Array(await crypto.subtle.digest('SHA-256', encoder.encode(`${challenge}:${nonce}`)));
+  } while (leadingZeroBits(hash) < difficulty);
+  return { challenge, nonce };
 }
 
 // Include the FingerprintJS library
@@ -0,0 +1,437 @@
+"""
+Judge vote tallies shared by the main app and the admin app.
+
+Functions here take an open cursor so callers decide how connections are
+obtained and how transactions are scoped.
+"""
+from psycopg2.extras import execute_values
+
+from geolocation_prefixes import create_geolocation_prefix_schema
+from jobs import ACTIVE_JOB_CONFLICT
+
+# A judge needs at least this many votes before leaving 'undecided'
+STATUS_MIN_VOTES = 5
+# Share of votes one side needs for the judge to get that status
+STATUS_RATIO_THRESHOLD = 0.8333
+
+# Arbitrary key for the advisory lock that keeps reconciliation single-flight
+RECONCILE_LOCK_ID = 4242001
+
+JUDGE_COLUMNS = ['id', 'name', 'job_position', 'ruling', 'link', 'x_link', 'displayed']
+
+# Read model of vote counts per judge. The scope is either 'global' or the
+# two-letter country code of the voters counted in the row. Every
+# transaction that writes rows gives them one new version from
+# judge_vote_tally_clock, so the clock moves whenever any judge's counts or
+# listing change.
+#
+# Writers lock the clock row before anything else (LOCK_TALLY_CLOCK_SQL)
+# and hold it until they commit, so versions become visible in the order
+# they were handed out: a reader that saw version N has seen every write up
+# to N, and `version > N` cannot skip a write that commits late. Taking the
+# clock first keeps its lock ordered before the tally, vote and rollup row
+# locks, so writers cannot deadlock on it.
+CREATE_TALLIES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS judge_vote_tallies (
+        judge_id INTEGER NOT NULL,
+        scope VARCHAR(8) NOT NULL,
+        corrupt_votes BIGINT NOT NULL DEFAULT 0,
+        not_corrupt_votes BIGINT NOT NULL DEFAULT 0,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (judge_id, scope)
+    );
+    CREATE TABLE IF NOT EXISTS judge_vote_tally_clock (
+        id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+        version BIGINT NOT NULL
+    );
+    -- One version per transaction, kept in a transaction-local setting
+    CREATE OR REPLACE FUNCTION next_tally_version() RETURNS BIGINT AS $$
+    DECLARE
+        assigned BIGINT := NULLIF(current_setting('jai.tally_version', true), '')::BIGINT;
+    BEGIN
+        IF assigned IS NULL THEN
+            UPDATE judge_vote_tally_clock SET version = version + 1 RETURNING version INTO assigned;
+            PERFORM set_config('jai.tally_version', assigned::TEXT, true);
+        END IF;
+        RETURN assigned;
+    END
+    $$ LANGUAGE plpgsql;
+    ALTER TABLE judge_vote_tallies ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
+    INSERT INTO judge_vote_tally_clock (version)
+    SELECT COALESCE(MAX(version), 0) FROM judge_vote_tallies
+    ON CONFLICT DO NOTHING;
+    ALTER TABLE judge_vote_tallies ALTER COLUMN version SET DEFAULT next_tally_version();
+    -- Versions used to come from a sequence, which hands them out in start order
+    DROP SEQUENCE IF EXISTS judge_vote_tallies_version_seq;
+    CREATE INDEX IF NOT EXISTS idx_judge_vote_tallies_version ON judge_vote_tallies (version);
+'''
+
+# Runs ahead of every statement that writes judge_vote_tallies, in the same
+# round trip and transaction
+LOCK_TALLY_CLOCK_SQL = '''
+    SELECT version FROM judge_vote_tally_clock FOR UPDATE;
+'''
+
+TOUCH_JUDGE_SQL = LOCK_TALLY_CLOCK_SQL + '''
+    INSERT INTO judge_vote_tallies (judge_id, scope)
+    VALUES (%s, 'global')
+    ON CONFLICT (judge_id, scope) DO UPDATE SET
+        version = next_tally_version(),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# One vote per IP, judge and day, enforced by the database. Vote times are
+# stored as UTC, whichever path wrote them, and vote_day is the UTC day.
+# Whitelisted IPs store a NULL vote_day, which never conflicts. Buffered
+# votes carry a vote_key so a journal segment replayed after its votes were
+# committed cannot insert them again, whitelisted or not. Votes carry the
+# voter's country, so country tallies and analytics never join the
+# geolocation tables; votes from IPs that were not located yet have a NULL
+# country until the geolocation job fills it in.
+VOTES_SCHEMA_SQL = '''
+    ALTER TABLE votes ADD COLUMN IF NOT EXISTS vote_day DATE;
+    ALTER TABLE votes ADD COLUMN IF NOT EXISTS country_code VARCHAR(2);
+    ALTER TABLE votes ADD COLUMN IF NOT EXISTS vote_key UUID;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_votes_ip_judge_day ON votes (ip_address, judge_id, vote_day);
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_votes_vote_key ON votes (vote_key) WHERE vote_key IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_votes_country ON votes (country_code);
+    CREATE INDEX IF NOT EXISTS idx_votes_unlocated ON votes (ip_address) WHERE country_code IS NULL;
+'''
+
+# Validates, inserts and tallies votes in one statement and one round trip:
+# votes for unknown or hidden judges are dropped, repeat votes on the same
+# day and replayed buffered votes are resolved by the unique indexes, and
+# only inserted votes are tallied. Each vote stores the country of its
+# voter's own geolocation row or, failing that, verified network prefix;
+# IPs with neither get a lookup job. The VALUES placeholder is filled by
+# execute_values, which lets the same statement take one vote or a batch.
+# Returns one row with the number of accepted and inserted votes.
+RECORD_VOTES_SQL = LOCK_TALLY_CLOCK_SQL + '''
+    WITH incoming (judge_id, ip_address, vote_type, browser_fingerprint, created_at, vote_key) AS (
+        VALUES %s
+    ), accepted AS (
+        SELECT
+            i.judge_id,
+            i.ip_address,
+            i.vote_type,
+            i.browser_fingerprint,
+            COALESCE(i.created_at, CURRENT_TIMESTAMP AT TIME ZONE 'UTC') AS created_at,
+            i.vote_key,
+            CASE
+                WHEN EXISTS (
+                    SELECT 1 FROM ip_whitelist w
+                    WHERE w.ip_address = i.ip_address AND w.expiry > CURRENT_TIMESTAMP
+                ) THEN NULL
+                ELSE COALESCE(i.created_at, CURRENT_TIMESTAMP AT TIME ZONE 'UTC')::date
+            END AS vote_day,
+            COALESCE(g.country_code2, p.country_code2) AS country_code
+        FROM incoming i
+        JOIN judges j ON j.id = i.judge_id AND j.displayed = 1
+        LEFT JOIN ip_geolocation g ON g.ip_address = i.ip_address
+        LEFT JOIN ip_geolocation_prefixes p
+            ON p.prefix = ip_geolocation_prefix(i.ip_address) AND p.verified
+    ), new_votes AS (
+        INSERT INTO votes (judge_id, ip_address, vote_type, browser_fingerprint, created_at, vote_day,
+                           country_code, vote_key)
+        SELECT judge_id, ip_address, vote_type, browser_fingerprint, created_at, vote_day, country_code, vote_key
+        FROM accepted
+        ON CONFLICT DO NOTHING
+        RETURNING judge_id, ip_address, vote_type, country_code
+    ), geolocate AS (
+        INSERT INTO jobs (kind, dedupe_key, payload)
+        SELECT 'geolocate', host(n.ip_address), jsonb_build_object('ip_address', host(n.ip_address))
+        FROM (SELECT DISTINCT ip_address FROM new_votes WHERE country_code IS NULL) n
+        -- Only addresses the lookup can handle; filled in by record_votes
+        WHERE family(n.ip_address) IN ({geolocate_families})
+          AND NOT EXISTS (SELECT 1 FROM ip_geolocation g WHERE g.ip_address = n.ip_address)
+          AND NOT EXISTS (
+              SELECT 1 FROM ip_geolocation_prefixes p
+              WHERE p.prefix = ip_geolocation_prefix(n.ip_address) AND p.verified
+          )
+        ON CONFLICT ''' + ACTIVE_JOB_CONFLICT + ''' DO NOTHING
+    ), scoped AS (
+        SELECT judge_id, vote_type, 'global' AS scope
+        FROM new_votes
+        UNION ALL
+        SELECT judge_id, vote_type, country_code
+        FROM new_votes
+        WHERE country_code IS NOT NULL
+    ), tallied AS (
+        INSERT INTO judge_vote_tallies AS t (judge_id, scope, corrupt_votes, not_corrupt_votes)
+        SELECT
+            judge_id,
+            scope,
+            COUNT(*) FILTER (WHERE vote_type = 'corrupt'),
+            COUNT(*) FILTER (WHERE vote_type = 'not_corrupt')
+        FROM scoped
+        GROUP BY judge_id, scope
+        ON CONFLICT (judge_id, scope) DO UPDATE SET
+            corrupt_votes = t.corrupt_votes + EXCLUDED.corrupt_votes,
+            not_corrupt_votes = t.not_corrupt_votes + EXCLUDED.not_corrupt_votes,
+            version = next_tally_version(),
+            updated_at = CURRENT_TIMESTAMP
+    )
+    SELECT (SELECT COUNT(*) FROM accepted), (SELECT COUNT(*) FROM new_votes)
+'''
+
+RECORD_VOTES_TEMPLATE = '(%s::integer, %s::inet, %s, %s, %s::timestamp, %s::uuid)'
+
+# Recounts votes per scope and keeps the difference for every drifted row.
+# Applying a delta instead of the recount itself keeps increments committed
+# by concurrent votes after this statement's snapshot. The recount scans
+# every vote, so it runs before the clock is locked.
+RECONCILE_DRIFT_SQL = '''
+    CREATE TEMP TABLE judge_vote_tally_drift ON COMMIT DROP AS
+    WITH expected AS (
+        SELECT
+            judge_id,
+            CASE WHEN GROUPING(country_code) = 1 THEN 'global' ELSE country_code END AS scope,
+            COUNT(*) FILTER (WHERE vote_type = 'corrupt') AS corrupt_votes,
+            COUNT(*) FILTER (WHERE vote_type = 'not_corrupt') AS not_corrupt_votes
+        FROM votes
+        GROUP BY GROUPING SETS ((judge_id), (judge_id, country_code))
+        HAVING GROUPING(country_code) = 1 OR country_code IS NOT NULL
+    ), drift AS (
+        SELECT
+            COALESCE(e.judge_id, t.judge_id) AS judge_id,
+            COALESCE(e.scope, t.scope) AS scope,
+            COALESCE(e.corrupt_votes, 0) - COALESCE(t.corrupt_votes, 0) AS corrupt_delta,
+            COALESCE(e.not_corrupt_votes, 0) - COALESCE(t.not_corrupt_votes, 0) AS not_corrupt_delta
+        FROM expected e
+        FULL OUTER JOIN judge_vote_tallies t ON t.judge_id = e.judge_id AND t.scope = e.scope
+    )
+    SELECT judge_id, scope, corrupt_delta, not_corrupt_delta
+    FROM drift
+    WHERE corrupt_delta <> 0 OR not_corrupt_delta <> 0
+'''
+
+APPLY_TALLY_DRIFT_SQL = LOCK_TALLY_CLOCK_SQL + '''
+    INSERT INTO judge_vote_tallies AS t (judge_id, scope, corrupt_votes, not_corrupt_votes)
+    SELECT judge_id, scope, corrupt_delta, not_corrupt_delta
+    FROM judge_vote_tally_drift
+    ON CONFLICT (judge_id, scope) DO UPDATE SET
+        corrupt_votes = t.corrupt_votes + EXCLUDED.corrupt_votes,
+        not_corrupt_votes = t.not_corrupt_votes + EXCLUDED.not_corrupt_votes,
+        version = next_tally_version(),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# Sets the country of votes from one address or prefix that were stored
+# without one, and adds them to that country's tallies
+LOCATE_VOTES_SQL = LOCK_TALLY_CLOCK_SQL + '''
+    WITH located AS (
+        UPDATE votes SET country_code = %(country_code)s
+        WHERE ip_address <<= %(network)s::inet AND country_code IS NULL
+        RETURNING judge_id, vote_type
+    )
+    INSERT INTO judge_vote_tallies AS t (judge_id, scope, corrupt_votes, not_corrupt_votes)
+    SELECT
+        judge_id,
+        %(country_code)s,
+        COUNT(*) FILTER (WHERE vote_type = 'corrupt'),
+        COUNT(*) FILTER (WHERE vote_type = 'not_corrupt')
+    FROM located
+    GROUP BY judge_id
+    ON CONFLICT (judge_id, scope) DO UPDATE SET
+        corrupt_votes = t.corrupt_votes + EXCLUDED.corrupt_votes,
+        not_corrupt_votes = t.not_corrupt_votes + EXCLUDED.not_corrupt_votes,
+        version = next_tally_version(),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# The same for every vote without a country whose IP has since been located.
+# Repeating country_code IS NULL in the outer WHERE makes a vote located
+# concurrently drop out instead of being counted twice.
+BACKFILL_VOTE_COUNTRIES_SQL = LOCK_TALLY_CLOCK_SQL + '''
+    WITH located AS (
+        UPDATE votes v SET country_code = l.country_code
+        FROM (
+            SELECT u.id, COALESCE(g.country_code2, p.country_code2) AS country_code
+            FROM votes u
+            LEFT JOIN ip_geolocation g ON g.ip_address = u.ip_address
+            LEFT JOIN ip_geolocation_prefixes p
+                ON p.prefix = ip_geolocation_prefix(u.ip_address) AND p.verified
+            WHERE u.country_code IS NULL AND COALESCE(g.country_code2, p.country_code2) IS NOT NULL
+        ) l
+        WHERE v.id = l.id AND v.country_code IS NULL
+        RETURNING v.judge_id, v.vote_type, v.country_code
+    )
+    INSERT INTO judge_vote_tallies AS t (judge_id, scope, corrupt_votes, not_corrupt_votes)
+    SELECT
+        judge_id,
+        country_code,
+        COUNT(*) FILTER (WHERE vote_type = 'corrupt'),
+        COUNT(*) FILTER (WHERE vote_type = 'not_corrupt')
+    FROM located
+    GROUP BY judge_id, country_code
+    ON CONFLICT (judge_id, scope) DO UPDATE SET
+        corrupt_votes = t.corrupt_votes + EXCLUDED.corrupt_votes,
+        not_corrupt_votes = t.not_corrupt_votes + EXCLUDED.not_corrupt_votes,
+        version = next_tally_version(),
+        updated_at = CURRENT_TIMESTAMP
+'''
+
+# Reads counts from the tally read model, so the cost depends on the number
+# of judges rather than the number of votes.
+JUDGE_TALLIES_QUERY = '''
+    SELECT
+        j.id, j.name, j.job_position, j.ruling, j.link, j.x_link, j.displayed,
+        COALESCE(g.corrupt_votes, 0) AS corrupt_votes,
+        COALESCE(g.not_corrupt_votes, 0) AS not_corrupt_votes,
+        COALESCE(us.corrupt_votes, 0) AS us_corrupt_votes,
+        COALESCE(us.not_corrupt_votes, 0) AS us_not_corrupt_votes
+    FROM judges j
+    LEFT JOIN judge_vote_tallies g ON g.judge_id = j.id AND g.scope = 'global'
+    LEFT JOIN judge_vote_tallies us ON us.judge_id = j.id AND us.scope = 'US'
+    WHERE j.displayed = 1
+    ORDER BY j.id
+'''
+
+# Same shape as JUDGE_TALLIES_QUERY, restricted to judges whose global or US
+# row moved past a version. Versions become visible in commit order, so a
+# cursor taken from current_tally_version never passes a write that is
+# still to commit. Hidden judges are included so callers can tell clients
+# to drop them.
+JUDGE_CHANGES_QUERY = '''
+    WITH changed AS (
+        SELECT DISTINCT judge_id
+        FROM judge_vote_tallies
+        WHERE version > %s AND scope IN ('global', 'US')
+    )
+    SELECT
+        j.id, j.name, j.job_position, j.ruling, j.link, j.x_link, j.displayed,
+        COALESCE(g.corrupt_votes, 0) AS corrupt_votes,
+        COALESCE(g.not_corrupt_votes, 0) AS not_corrupt_votes,
+        COALESCE(us.corrupt_votes, 0) AS us_corrupt_votes,
+        COALESCE(us.not_corrupt_votes, 0) AS us_not_corrupt_votes
+    FROM changed c
+    JOIN judges j ON j.id = c.judge_id
+    LEFT JOIN judge_vote_tallies g ON g.judge_id = j.id AND g.scope = 'global'
+    LEFT JOIN judge_vote_tallies us ON us.judge_id = j.id AND us.scope = 'US'
+    ORDER BY j.id
+'''
+
+
+def create_vote_schema(cur):
+    # Vote recording and reconciliation locate voters through prefixes too
+    create_geolocation_prefix_schema(cur)
+    cur.execute(CREATE_TALLIES_TABLE_SQL)
+    cur.execute(VOTES_SCHEMA_SQL)
+
+
+def record_votes(cur, votes, page_size=100, geolocate_families=(4,)):
+    """
+    Validate, insert and tally votes atomically.
+
+    Each vote is a (judge_id, ip_address, vote_type, browser_fingerprint,
+    created_at, vote_key) tuple; created_at is naive UTC, None meaning the
+    database's current time, and vote_key, which may be left off, makes
+    inserting the same vote twice a no-op. Votes are sent in multi-row
+    statements of up to page_size rows. Unlocated voters get a geolocation
+    job only if their address family is in geolocate_families (see
+    jobs.geolocation_families).
+
+    Returns (accepted, inserted): votes for a displayed judge, and those of
+    them that were not a repeat vote for the same judge on the same day.
+    """
+    votes = [tuple(vote) + (None,) * (6 - len(vote)) for vote in votes]
+    sql = RECORD_VOTES_SQL.format(geolocate_families=', '.join(str(int(family)) for family in geolocate_families))
+    pages = execute_values(cur, sql, votes, template=RECORD_VOTES_TEMPLATE,
+                           page_size=page_size, fetch=True)
+    return sum(page[0] for page in pages), sum(page[1] for page in pages)
+
+
+def locate_votes(cur, network, country_code):
+    """
+    Give votes from network (an address or a prefix) that have no country
+    yet country_code, and tally them under it.
+    """
+    cur.execute(LOCATE_VOTES_SQL, {'network': network, 'country_code': country_code})
+
+
+def backfill_vote_countries(cur):
+    """Locate every vote without a country whose IP is geolocated by now."""
+    cur.execute(BACKFILL_VOTE_COUNTRIES_SQL)
+
+
+def touch_judge(cur, judge_id):
+    """Give a judge a new version after its details or visibility changed."""
+    cur.execute(TOUCH_JUDGE_SQL, (judge_id,))
+
+
+def current_tally_version(cur):
+    """
+    Return the newest committed tally version, which identifies the /judges
+    payload. Every row with a version up to it is already visible.
+    """
+    cur.execute('SELECT version FROM judge_vote_tally_clock')
+    row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def reconcile_judge_vote_tallies(cur):
+    """
+    Repair tally rows that drifted from the votes table.
+
+    Must run inside a transaction. Returns the number of repaired rows, or
+    None when another process is already reconciling.
+    """
+    cur.execute('SELECT pg_try_advisory_xact_lock(%s)', (RECONCILE_LOCK_ID,))
+    if not cur.fetchone()[0]:
+        return None
+    cur.execute(RECONCILE_DRIFT_SQL)
+    cur.execute(APPLY_TALLY_DRIFT_SQL)
+    return cur.rowcount
+
+
+def calculate_status(corrupt_votes, not_corrupt_votes):
+    """Derive a judge's status from its vote counts."""
+    total_votes = corrupt_votes + not_corrupt_votes
+    if total_votes < STATUS_MIN_VOTES:
+        return 'undecided'
+    if corrupt_votes / total_votes >= STATUS_RATIO_THRESHOLD:
+        return 'corrupt'
+    if not_corrupt_votes / total_votes >= STATUS_RATIO_THRESHOLD:
+        return 'not_corrupt'
+    return 'undecided'
+
+
+def build_judge(row):
+    """Turn a tally row into the judge object served by /judges."""
+    corrupt_votes, not_corrupt_votes, us_corrupt_votes, us_not_corrupt_votes = row[len(JUDGE_COLUMNS):]
+    return {
+        **dict(zip(JUDGE_COLUMNS, row)),
+        'corrupt_votes': corrupt_votes,
+        'not_corrupt_votes': not_corrupt_votes,
+        'us_corrupt_votes': us_corrupt_votes,
+        'us_not_corrupt_votes': us_not_corrupt_votes,
+        'status': calculate_status(corrupt_votes, not_corrupt_votes)
+    }
+
+
+def fetch_judge_tallies(cur):
+    """Return every displayed judge with global and US vote counts and status."""
+    cur.execute(JUDGE_TALLIES_QUERY)
+    return [build_judge(row) for row in cur.fetchall()]
+
+
+def fetch_judge_changes(cur, since_version):
+    """
+    Return (changed, removed) for judges touched after since_version.
+
+    changed holds judge objects shaped like fetch_judge_tallies rows and
+    removed holds the ids of judges that are no longer displayed. Read the
+    cursor handed back to the client with current_tally_version before
+    calling this; changes committed in between are then sent again on the
+    next call rather than lost.
+    """
+    cur.execute(JUDGE_CHANGES_QUERY, (since_version,))
+    changed = []
+    removed = []
+    for row in cur.fetchall():
+        judge = build_judge(row)
+        if judge['displayed'] == 1:
+            changed.append(judge)
+        else:
+            removed.append(judge['id'])
+    return changed, removed
@@ -0,0 +1,129 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'admin_app'))
+
+from geoip_ranges import RangeDatabase, build_range_database
+
+HEADER_ROW = 'ip_start,ip_end,country_code,country_name,region,city,latitude,longitude\n'
+
+
+def build(tmp_path, rows):
+    csv_path = tmp_path / 'ranges.csv'
+    csv_path.write_text(HEADER_ROW + ''.join(row + '\n' for row in rows), encoding='utf-8')
+    output_path = str(tmp_path / 'ranges.bin')
+    build_range_database(str(csv_path), output_path)
+    return output_path
+
+
+@pytest.fixture
+def database(tmp_path):
+    return RangeDatabase(build(tmp_path, [
+        '1.0.0.0,1.0.0.255,AU,Australia,Queensland,Brisbane,-27.4679,153.0281',
+        '1.0.2.0,1.0.3.255,CN,China,Fujian,Fuzhou,26.0614,119.3061',
+        '2001:db8::,2001:db8::ffff,DE,Germany,Berlin,Berlin,52.5200,13.4050',
+        '2001:db8:0:2::,2001:db8:0:2:ffff:ffff:ffff:ffff,FR,France,,,48.8566,2.3522',
+    ]))
+
+
+def country(database, ip_address):
+    location = database.lookup(ip_address)
+    return location and location['country_code2']
+
+
+def test_ipv4_range_boundaries(database):
+    assert country(database, '1.0.0.0') == 'AU'
+    assert country(database, '1.0.0.255') == 'AU'
+    assert country(database, '1.0.2.0') == 'CN'
+    assert country(database, '1.0.3.255') == 'CN'
+
+
+def test_ipv4_gaps_and_edges(database):
+    assert country(database, '0.255.255.255') is None
+    assert country(database, '1.0.1.0') is None
+    assert country(database, '1.0.4.0') is None
+    assert country(database, '255.255.255.255') is None
+
+
+def test_ipv6_range_boundaries(database):
+    assert country(database, '2001:db8::') == 'DE'
+    assert country(database, '2001:db8::ffff') == 'DE'
+    assert country(database, '2001:db8:0:2::') == 'FR'
+    assert country(database, '2001:db8:0:2:ffff:ffff:ffff:ffff') == 'FR'
+
+
+def test_ipv6_gaps_and_edges(database):
+    assert country(database, '::') is None
+    assert country(database, '2001:db8::1:0') is None
+    assert country(database, '2001:db8:0:3::') is None
+    assert country(database, 'ffff:ffff:ffff:ffff:ffff:ffff:ffff:ffff') is None
+
+
+def test_ipv4_and_ipv6_are_looked_up_separately(database):
+    # 1.0.0.1 as an integer is ::100:1, which no IPv6 range covers
+    assert country(database, '::100:1') is None
+
+
+def test_location_fields(database):
+    assert database.lookup('1.0.0.1') == {
+        'country_code2': 'AU',
+        'country_name': 'Australia',
+        'state_prov': 'Queensland',
+        'city': 'Brisbane',
+        'latitude': '-27.4679',
+        'longitude': '153.0281'
+    }
+    assert database.lookup('2001:db8:0:2::1')['city'] is None
+
+
+def test_invalid_address(database):
+    assert database.lookup('not an ip') is None
+
+
+def test_integer_addresses(tmp_path):
+    database = RangeDatabase(build(tmp_path, ['16777216,16777471,AU,,,,,']))
+    assert country(database, '1.0.0.0') == 'AU'
+    assert country(database, '1.0.0.255') == 'AU'
+    assert country(database, '1.0.1.0') is None
+
+
+def test_empty_database(tmp_path):
+    database = RangeDatabase(build(tmp_path, []))
+    assert database.range_count == 0
+    assert database.lookup('1.0.0.1') is None
+    assert database.lookup('2001:db8::1') is None
+
+
+def test_overlapping_ranges_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        build(tmp_path, ['1.0.0.0,1.0.0.255,AU,,,,,', '1.0.0.255,1.0.1.255,CN,,,,,'])
+
+
+def test_reversed_and_mixed_ranges_are_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        build(tmp_path, ['1.0.0.255,1.0.0.0,AU,,,,,'])
+    with pytest.raises(ValueError):
+        build(tmp_path, ['1.0.0.0,2001:db8::,AU,,,,,'])
+
+
+@pytest.mark.parametrize('size', [0, 4, 31, 100])
+def test_truncated_file_is_rejected(tmp_path, size):
+    path = build(tmp_path, [
+        '1.0.0.0,1.0.0.255,AU,Australia,Queensland,Brisbane,-27.4679,153.0281',
+        '2001:db8::,2001:db8::ffff,DE,Germany,Berlin,Berlin,52.5200,13.4050',
+    ])
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:size])
+    with pytest.raises(ValueError):
+        RangeDatabase(path)
+
+
+def test_wrong_magic_is_rejected(tmp_path):
+    path = tmp_path / 'ranges.bin'
+    path.write_bytes(b'NOTGEO01' + b'\0' * 32)
+    with pytest.raises(ValueError):
+        RangeDatabase(str(path))
@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+
+from jobs import JobRunner, PRUNE_FAILED_JOBS_SQL, geolocation_families
+
+
+class Cursor:
+    """Records executed statements."""
+
+    def __init__(self):
+        self.executed = []
+        self.rowcount = 0
+
+    def execute(self, sql, params=None):
+        self.executed.append((sql, params))
+
+
+def runner(cur, **kwargs):
+    @contextmanager
+    def get_cursor():
+        yield cur
+    return JobRunner({}, get_cursor, **kwargs)
+
+
+def test_ipv6_is_only_geolocated_by_prefix():
+    assert geolocation_families('ip') == (4,)
+    assert geolocation_families('prefix') == (4, 6)
+
+
+def test_prune_deletes_failed_jobs_past_retention():
+    cur = Cursor()
+    runner(cur, failed_retention=3600).prune()
+    assert cur.executed == [(PRUNE_FAILED_JOBS_SQL, (3600,))]
+
+
+def test_prune_runs_once_per_interval():
+    cur = Cursor()
+    jobs = runner(cur, failed_retention=3600, prune_interval=3600)
+    jobs.prune()
+    jobs.prune()
+    assert len(cur.executed) == 1
+
+
+def test_zero_retention_keeps_failed_jobs():
+    cur = Cursor()
+    runner(cur, failed_retention=0).prune()
+    assert cur.executed == []
@@ -0,0 +1,69 @@
+import hashlib
+import itertools
+
+import pytest
+
+from proof_of_work import (ChallengeIssuer, DifficultyController, DifficultyPolicy, SeenChallenges,
+                           leading_zero_bits)
+
+
+def solve(challenge, difficulty):
+    for nonce in itertools.count():
+        digest = hashlib.sha256(f'{challenge}:{nonce}'.encode('utf-8')).digest()
+        if leading_zero_bits(digest) >= difficulty:
+            return str(nonce)
+
+
+@pytest.fixture
+def issuer(tmp_path):
+    return ChallengeIssuer('secret', SeenChallenges(str(tmp_path / 'seen'), bits=1 << 16))
+
+
+def test_solution_is_accepted_once(issuer):
+    challenge = issuer.issue('vote:12', '1.2.3.4', 4)
+    nonce = solve(challenge, 4)
+    assert issuer.verify(challenge, nonce, 'vote:12', '1.2.3.4') is None
+    assert issuer.verify(challenge, nonce, 'vote:12', '1.2.3.4') == 'Proof of work already used'
+
+
+def test_challenge_is_bound_to_scope_and_ip(issuer):
+    challenge = issuer.issue('vote:12', '1.2.3.4', 4)
+    nonce = solve(challenge, 4)
+    assert issuer.verify(challenge, nonce, 'vote:13', '1.2.3.4') == 'Invalid proof of work'
+    assert issuer.verify(challenge, nonce, 'vote:12', '5.6.7.8') == 'Invalid proof of work'
+    # Failed attempts do not use the challenge up
+    assert issuer.verify(challenge, nonce, 'vote:12', '1.2.3.4') is None
+
+
+def test_tampered_or_foreign_challenge_is_rejected(issuer, tmp_path):
+    challenge = issuer.issue('vote:12', '1.2.3.4', 8)
+    tampered = challenge.replace('.8.', '.0.', 1)
+    assert issuer.verify(tampered, '0', 'vote:12', '1.2.3.4') == 'Invalid proof of work'
+
+    other = ChallengeIssuer('other secret', SeenChallenges(str(tmp_path / 'other'), bits=1 << 16))
+    forged = other.issue('vote:12', '1.2.3.4', 0)
+    assert issuer.verify(forged, '0', 'vote:12', '1.2.3.4') == 'Invalid proof of work'
+
+
+def test_difficulty_below_floor_is_rejected(issuer):
+    challenge = issuer.issue('vote:12', '1.2.3.4', 2)
+    nonce = solve(challenge, 2)
+    assert issuer.verify(challenge, nonce, 'vote:12', '1.2.3.4', min_difficulty=4) == 'Invalid proof of work'
+    assert issuer.verify(challenge, nonce, 'vote:12', '1.2.3.4', min_difficulty=2) is None
+
+
+def test_insufficient_work_is_rejected(issuer):
+    challenge = issuer.issue('vote:12', '1.2.3.4', 12)
+    nonce = next(str(nonce) for nonce in itertools.count()
+                 if leading_zero_bits(hashlib.sha256(f'{challenge}:{nonce}'.encode('utf-8')).digest()) < 12)
+    assert issuer.verify(challenge, nonce, 'vote:12', '1.2.3.4') == 'Invalid proof of work'
+
+
+def test_floor_allows_slack_but_not_below_base():
+    controller = DifficultyController({'vote': DifficultyPolicy(4, 20, target_rate=1000)},
+                                      strikes=lambda ip_address: 5 if ip_address == '6.6.6.6' else 0)
+    assert controller.difficulty('vote', '1.2.3.4') == 4
+    assert controller.floor('vote', '1.2.3.4') == 4
+    assert controller.difficulty('vote', '6.6.6.6') == 9
+    assert controller.floor('vote', '6.6.6.6') == 7
+    assert controller.floor('vote', '6.6.6.6', slack=10) == 4
@@ -0,0 +1,94 @@
+import pytest
+
+import rate_limit
+from rate_limit import RateLimitPolicy, RateLimiter
+
+
+class FakeClock:
+    """Stands in for the time module so windows can be stepped through."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # On a window boundary
+    clock = FakeClock(100 * 10 ** 5)
+    monkeypatch.setattr(rate_limit, 'time', clock)
+    return clock
+
+
+def make_limiter(tmp_path, *policies):
+    return RateLimiter(policies, str(tmp_path / 'limits'), slots=64)
+
+
+def test_fixed_window_resets_at_boundary(tmp_path, clock):
+    limiter = make_limiter(tmp_path, RateLimitPolicy('votes', 'ip', 2, 100, sliding=False))
+    assert limiter.hit('votes', ip='1.2.3.4')
+    assert limiter.hit('votes', ip='1.2.3.4')
+    assert not limiter.hit('votes', ip='1.2.3.4')
+    assert limiter.hit('votes', ip='5.6.7.8')
+
+    clock.now += 99
+    assert not limiter.allowed('votes', ip='1.2.3.4')
+    clock.now += 1
+    assert limiter.count('votes', ip='1.2.3.4') == 0
+    assert limiter.hit('votes', ip='1.2.3.4')
+
+
+def test_sliding_window_weighs_previous_window(tmp_path, clock):
+    limiter = make_limiter(tmp_path, RateLimitPolicy('votes', 'ip', 4, 100))
+    for _ in range(4):
+        assert limiter.hit('votes', ip='1.2.3.4')
+    assert not limiter.hit('votes', ip='1.2.3.4')
+
+    # Halfway into the next window half of the previous one still counts
+    clock.now += 150
+    assert limiter.count('votes', ip='1.2.3.4') == pytest.approx(2)
+    assert limiter.hit('votes', ip='1.2.3.4')
+    assert limiter.hit('votes', ip='1.2.3.4')
+    assert not limiter.hit('votes', ip='1.2.3.4')
+
+    # Two windows on nothing is left
+    clock.now += 200
+    assert limiter.count('votes', ip='1.2.3.4') == 0
+
+
+def test_rejected_hits_are_not_counted(tmp_path, clock):
+    limiter = make_limiter(tmp_path, RateLimitPolicy('votes', 'ip', 1, 100, sliding=False))
+    assert limiter.hit('votes', ip='1.2.3.4')
+    for _ in range(3):
+        assert not limiter.hit('votes', ip='1.2.3.4')
+    assert limiter.count('votes', ip='1.2.3.4') == 1
+
+
+def test_missing_key_is_not_limited(tmp_path, clock):
+    limiter = make_limiter(tmp_path, RateLimitPolicy('fingerprints', 'fingerprint', 1, 100))
+    for _ in range(3):
+        assert limiter.hit('fingerprints', fingerprint=None)
+
+
+def test_state_survives_a_new_table(tmp_path, clock):
+    policy = RateLimitPolicy('votes', 'ip', 2, 100, sliding=False)
+    persist_path = str(tmp_path / 'limits.state')
+    limiter = RateLimiter([policy], str(tmp_path / 'limits'), persist_path=persist_path,
+                          persist_interval=0, slots=64)
+    assert limiter.hit('votes', ip='1.2.3.4')
+    assert limiter.hit('votes', ip='1.2.3.4')
+
+    # A fresh shared-memory file, as after a reboot, loads the state file
+    restored = RateLimiter([policy], str(tmp_path / 'restored'), persist_path=persist_path, slots=64)
+    assert not restored.hit('votes', ip='1.2.3.4')
+
+
+def test_daily_window_starts_at_midnight_utc(tmp_path, clock):
+    limiter = make_limiter(tmp_path, RateLimitPolicy('vote_judge', 'ip_judge', 1, 86400, sliding=False))
+    clock.now = 1714607999  # 2024-05-01 23:59:59 UTC
+    assert limiter.hit('vote_judge', ip='1.2.3.4', judge_id=7)
+    assert not limiter.hit('vote_judge', ip='1.2.3.4', judge_id=7)
+    clock.now += 1
+    assert limiter.hit('vote_judge', ip='1.2.3.4', judge_id=7)
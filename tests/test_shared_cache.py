@@ -0,0 +1,83 @@
+import threading
+import time
+
+import pytest
+
+import shared_cache
+from shared_cache import SharedMemoryCache
+
+
+class FakeClock:
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock(1000.0)
+    monkeypatch.setattr(shared_cache, 'time', clock)
+    return clock
+
+
+def test_least_recently_used_entry_is_evicted(tmp_path, clock):
+    cache = SharedMemoryCache(str(tmp_path / 'cache'), threshold=2)
+    cache.set('a', 1)
+    clock.now += 2
+    cache.set('b', 2)
+    clock.now += 2
+    assert cache.get('a') == 1
+
+    clock.now += 2
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+
+
+def test_size_limit_evicts_oldest(tmp_path, clock):
+    cache = SharedMemoryCache(str(tmp_path / 'cache'), max_bytes=250, threshold=100)
+    cache.set('a', b'x' * 100)
+    clock.now += 2
+    cache.set('b', b'x' * 100)
+    clock.now += 2
+    cache.set('c', b'x' * 100)
+    assert cache.get('a') is None
+    assert cache.get('b') is not None
+    assert cache.get('c') is not None
+    assert not cache.set('huge', b'x' * 1000)
+
+
+def test_entries_expire(tmp_path, clock):
+    cache = SharedMemoryCache(str(tmp_path / 'cache'))
+    cache.set('a', 1, timeout=10)
+    cache.set('b', 2, timeout=0)
+    clock.now += 11
+    assert cache.get('a') is None
+    assert not cache.has('a')
+    assert cache.get('b') == 2
+    assert cache.add('a', 3)
+    assert not cache.add('a', 4)
+    assert cache.get('a') == 3
+
+
+def test_get_or_compute_computes_once(tmp_path):
+    cache = SharedMemoryCache(str(tmp_path / 'cache'))
+    calls = []
+    results = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'value'
+
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_compute('key', compute)))
+               for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == ['value'] * 5
@@ -0,0 +1,64 @@
+import queue
+
+import pytest
+
+from vote_anomalies import AnomalyDetector
+
+
+@pytest.fixture
+def detector(tmp_path):
+    return AnomalyDetector(lambda events: None, str(tmp_path / 'sketch'), window=3600,
+                           thresholds={'ip': 5, 'fingerprint': 5}, width=1024)
+
+
+def queued(detector):
+    events = []
+    try:
+        while True:
+            events.append(detector._events.get_nowait())
+    except queue.Empty:
+        return events
+
+
+def test_flags_at_threshold_and_each_doubling(detector):
+    for _ in range(25):
+        detector.observe(7, '1.2.3.4', None)
+    events = queued(detector)
+    assert [(kind, judge_id, subject, count) for kind, judge_id, subject, count, _ in events] == [
+        ('ip', 7, '1.2.3.4', 5),
+        ('ip', 7, '1.2.3.4', 10),
+        ('ip', 7, '1.2.3.4', 20),
+    ]
+    assert detector.estimate('ip', 7, '1.2.3.4') == 25
+
+
+def test_below_threshold_is_not_flagged(detector):
+    for _ in range(4):
+        detector.observe(7, '1.2.3.4', 'fingerprint')
+    for judge_id in range(8, 20):
+        detector.observe(judge_id, '1.2.3.4', 'fingerprint')
+    assert queued(detector) == []
+
+
+def test_keys_are_counted_separately(detector):
+    for _ in range(5):
+        detector.observe(7, '1.2.3.4', 'abc')
+    for _ in range(5):
+        detector.observe(7, '5.6.7.8', 'abc')
+    events = queued(detector)
+    assert [(kind, subject, count) for kind, _, subject, count, _ in events] == [
+        ('ip', '1.2.3.4', 5),
+        ('fingerprint', 'abc', 5),
+        ('ip', '5.6.7.8', 5),
+        ('fingerprint', 'abc', 10),
+    ]
+
+
+def test_counts_are_shared_through_the_file(detector, tmp_path):
+    for _ in range(3):
+        detector.observe(7, '1.2.3.4', None)
+    other = AnomalyDetector(lambda events: None, str(tmp_path / 'sketch'), window=3600,
+                            thresholds={'ip': 5, 'fingerprint': 5}, width=1024)
+    for _ in range(2):
+        other.observe(7, '1.2.3.4', None)
+    assert [count for _, _, _, count, _ in queued(other)] == [5]
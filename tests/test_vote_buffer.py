@@ -0,0 +1,120 @@
+import glob
+import json
+import os
+from datetime import datetime
+
+import pytest
+
+from vote_buffer import VoteBuffer
+
+
+class PoisonVote(Exception):
+    pass
+
+
+class Database:
+    """Records written votes; fails a batch holding a poison vote or while down."""
+
+    def __init__(self):
+        self.votes = []
+        self.down = False
+
+    def write(self, votes):
+        if self.down:
+            raise ConnectionError('database unavailable')
+        if any(vote[2] == 'poison' for vote in votes):
+            raise PoisonVote('bad vote')
+        self.votes.extend(votes)
+
+
+def vote(judge_id, vote_type='corrupt'):
+    return (judge_id, '1.2.3.4', vote_type, 'fingerprint', datetime(2024, 5, 1, 12, 0), 'key-%d' % judge_id)
+
+
+def make_buffer(journal_dir, database):
+    os.makedirs(journal_dir, exist_ok=True)
+    return VoteBuffer(database.write, journal_dir, fsync=False, dead_letter_errors=(PoisonVote,))
+
+
+def journals(journal_dir):
+    return glob.glob(os.path.join(journal_dir, 'votes-*.journal'))
+
+
+@pytest.fixture
+def journal_dir(tmp_path):
+    return str(tmp_path / 'journal')
+
+
+def test_flush_writes_and_removes_journal(journal_dir):
+    database = Database()
+    buffer = make_buffer(journal_dir, database)
+    assert buffer.submit(vote(1))
+    assert buffer.submit(vote(2))
+    assert buffer.flush() == 2
+    assert database.votes == [vote(1), vote(2)]
+    assert journals(journal_dir) == []
+    assert buffer.stats()['buffered'] == 0
+
+
+def test_crashed_segments_are_replayed(journal_dir):
+    database = Database()
+    crashed = make_buffer(journal_dir, database)
+    crashed.submit(vote(1))
+    crashed.submit(vote(2))
+
+    # Segments of a live buffer stay locked and are left alone
+    recovered = make_buffer(journal_dir, database)
+    recovered._recover()
+    assert recovered.stats()['buffered'] == 0
+
+    # The process dies: its journal file is closed and the lock released,
+    # after a torn write of an unacknowledged vote
+    crashed._active.file.write('[3, "1.2.3.4", "cor')
+    crashed._active.file.close()
+    recovered = make_buffer(journal_dir, database)
+    recovered._recover()
+    assert recovered.stats()['buffered'] == 2
+    assert recovered.flush() == 2
+    assert database.votes == [vote(1), vote(2)]
+    assert journals(journal_dir) == []
+
+
+def test_database_errors_keep_votes_buffered(journal_dir):
+    database = Database()
+    buffer = make_buffer(journal_dir, database)
+    buffer.submit(vote(1))
+    database.down = True
+    with pytest.raises(ConnectionError):
+        buffer.flush()
+    assert buffer.stats()['buffered'] == 1
+    assert len(journals(journal_dir)) == 1
+
+    database.down = False
+    assert buffer.flush() == 1
+    assert database.votes == [vote(1)]
+    assert not os.path.exists(buffer.dead_letter_path)
+
+
+def test_poison_vote_is_dead_lettered(journal_dir):
+    database = Database()
+    buffer = make_buffer(journal_dir, database)
+    buffer.submit(vote(1))
+    buffer.submit(vote(2, 'poison'))
+    buffer.submit(vote(3))
+    assert buffer.flush() == 3
+    assert database.votes == [vote(1), vote(3)]
+    assert journals(journal_dir) == []
+
+    with open(buffer.dead_letter_path) as f:
+        entries = [json.loads(line) for line in f]
+    assert len(entries) == 1
+    assert entries[0]['vote'][:3] == [2, '1.2.3.4', 'poison']
+    assert entries[0]['error'] == 'bad vote'
+
+
+def test_full_buffer_rejects_votes(journal_dir):
+    database = Database()
+    buffer = make_buffer(journal_dir, database)
+    buffer.max_size = 1
+    assert buffer.submit(vote(1))
+    assert not buffer.submit(vote(2))
@@ -0,0 +1,212 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import vote_clusters
+from vote_clusters import FIRST_VOTE_ID_SQL, MISSED_VOTES_SQL, NEW_VOTES_SQL, VoteClusterer, _Forest
+
+# Middle of the current hour, so test votes share a one-hour window
+NOW = datetime.now(timezone.utc).replace(tzinfo=None, minute=30, second=0, microsecond=0)
+
+
+class Database:
+    """Committed votes as (id, judge_id, vote_type, ip, fingerprint, network, created_at) rows."""
+
+    def __init__(self):
+        self.votes = {}
+
+    def commit(self, vote_id, judge_id=1, vote_type='corrupt', ip='192.0.2.1', fingerprint=None,
+               network=None, created_at=NOW):
+        self.votes[vote_id] = (vote_id, judge_id, vote_type, ip, fingerprint, network, created_at)
+
+    @contextmanager
+    def transaction(self):
+        yield Cursor(self)
+
+
+class Cursor:
+    def __init__(self, database):
+        self.database = database
+        self.rows = []
+
+    def execute(self, sql, params=None):
+        votes = self.database.votes
+        if sql == FIRST_VOTE_ID_SQL:
+            self.rows = [(min(votes) - 1 if votes else None,)]
+        elif sql == NEW_VOTES_SQL:
+            last_id, limit = params
+            self.rows = [votes[i] for i in sorted(votes) if i > last_id][:limit]
+        elif sql == MISSED_VOTES_SQL:
+            self.rows = [votes[i] for i in params[0] if i in votes]
+        elif sql.startswith('SELECT COALESCE(MAX(id), 0)'):
+            self.rows = [(max(votes, default=0),)]
+        else:
+            self.rows = []
+
+    def fetchone(self):
+        return self.rows[0]
+
+    def fetchall(self):
+        return self.rows
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def database():
+    return Database()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(vote_clusters.time, 'monotonic', clock)
+    return clock
+
+
+@pytest.fixture
+def published(monkeypatch):
+    rows = []
+    monkeypatch.setattr(vote_clusters, 'execute_values', lambda cur, sql, values: rows.extend(values))
+    return rows
+
+
+def clusterer(database, **kwargs):
+    return VoteClusterer(database.transaction, None, **dict({'min_votes': 1}, **kwargs))
+
+
+def cluster_votes(clusterer):
+    return sorted(cluster.votes for forest in clusterer._forests.values()
+                  for cluster in forest.clusters.values())
+
+
+def test_union_keeps_the_larger_tree_as_root():
+    forest = _Forest()
+    a, b, c = forest.node('ip', 'a'), forest.node('ip', 'b'), forest.node('ip', 'c')
+    root = forest.union(a, b)
+    assert forest.union(c, a) == root
+    assert forest.size[root] == 3
+    assert forest.find(c) == forest.find(b) == root
+    assert list(forest.clusters) == [root]
+    assert forest.clusters[root].members == {'ip': 3}
+
+
+def test_union_of_one_tree_is_a_no_op():
+    forest = _Forest()
+    a, b = forest.node('ip', 'a'), forest.node('fingerprint', 'f')
+    root = forest.union(a, b)
+    assert forest.union(b, a) == root
+    assert forest.size[root] == 2
+
+
+def test_shared_ip_or_fingerprint_links_votes(database):
+    votes = clusterer(database)
+    # A rotates IPs but keeps its fingerprint; the second IP is then reused
+    votes.add_vote(1, 'corrupt', '192.0.2.1', 'fp-a', None, NOW)
+    votes.add_vote(1, 'corrupt', '192.0.2.2', 'fp-a', None, NOW)
+    votes.add_vote(1, 'corrupt', '192.0.2.2', 'fp-b', None, NOW)
+    votes.add_vote(2, 'not_corrupt', '198.51.100.1', 'fp-c', None, NOW)
+    assert cluster_votes(votes) == [1, 3]
+    rows = sorted(votes.clusters(), key=lambda row: row[2])
+    assert rows[1][2:10] == (3, 2, 2, 0, 1, 1, 'corrupt', 1.0)
+
+
+def test_network_links_votes_from_different_ips(database):
+    votes = clusterer(database)
+    votes.add_vote(1, 'corrupt', '192.0.2.1', None, '192.0.2.0/24', NOW)
+    votes.add_vote(2, 'not_corrupt', '192.0.2.2', None, '192.0.2.0/24', NOW)
+    assert cluster_votes(votes) == [2]
+    (row,) = votes.clusters()
+    assert row[2:10] == (2, 2, 0, 1, 2, 1, 'corrupt', 0.5)
+
+
+def test_windows_are_clustered_separately(database):
+    votes = clusterer(database)
+    votes.add_vote(1, 'corrupt', '192.0.2.1', None, None, NOW)
+    votes.add_vote(1, 'corrupt', '192.0.2.1', None, None, NOW - timedelta(hours=1))
+    assert cluster_votes(votes) == [1, 1]
+
+
+def test_votes_older_than_the_retention_are_skipped(database):
+    votes = clusterer(database, retention=3600)
+    votes.add_vote(1, 'corrupt', '192.0.2.1', None, None, NOW - timedelta(hours=3))
+    assert cluster_votes(votes) == []
+
+
+def test_min_votes(database):
+    votes = clusterer(database, min_votes=2)
+    votes.add_vote(1, 'corrupt', '192.0.2.1', None, None, NOW)
+    assert votes.clusters() == []
+    votes.add_vote(1, 'corrupt', '192.0.2.1', None, None, NOW)
+    assert len(votes.clusters()) == 1
+
+
+def test_late_commits_are_picked_up(database, clock, published):
+    votes = clusterer(database)
+    database.commit(1)
+    assert votes.run_once() == 1
+    # Vote 2 is still being written when vote 3 commits
+    database.commit(3)
+    assert votes.run_once() == 1
+    assert list(votes._pending) == [2]
+    database.commit(2)
+    assert votes.run_once() == 1
+    assert votes._pending == {}
+    assert cluster_votes(votes) == [3]
+    assert [row[2] for row in published][-1] == 3
+
+
+def test_gaps_before_the_first_pass_are_not_tracked(database, clock, published):
+    votes = clusterer(database)
+    database.commit(1)
+    database.commit(4)
+    assert votes.run_once() == 2
+    assert votes._pending == {}
+
+
+def test_pending_ids_expire(database, clock, published):
+    votes = clusterer(database, pending_timeout=600)
+    database.commit(1)
+    votes.run_once()
+    database.commit(3)
+    votes.run_once()
+    assert list(votes._pending) == [2]
+    clock.now += 599
+    votes.run_once()
+    assert list(votes._pending) == [2]
+    clock.now += 2
+    votes.run_once()
+    assert votes._pending == {}
+    # A vote committing after its id expired is not counted
+    database.commit(2)
+    assert votes.run_once() == 0
+
+
+def test_pending_ids_are_capped(database, clock, published):
+    votes = clusterer(database, max_pending=3)
+    database.commit(1)
+    votes.run_once()
+    database.commit(10)
+    assert votes.run_once() == 1
+    assert sorted(votes._pending) == [2, 3, 4]
+
+
+def test_pending_ids_are_read_in_batches(database, clock, published):
+    votes = clusterer(database, batch_size=2)
+    database.commit(1)
+    votes.run_once()
+    database.commit(6)
+    votes.run_once()
+    assert sorted(votes._pending) == [2, 3, 4, 5]
+    for vote_id in (2, 3, 4, 5):
+        database.commit(vote_id)
+    assert votes.run_once() == 4
+    assert votes._pending == {}
+    assert cluster_votes(votes) == [6]
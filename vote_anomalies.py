@@ -0,0 +1,269 @@
+"""
+Streaming detection of vote bursts.
+
+submit_vote feeds every vote it accepts to an AnomalyDetector, which counts
+votes per judge and IP and per judge and fingerprint over a sliding window.
+The counts live in count-min sketches, one per sub-window, in a
+memory-mapped file on /dev/shm: memory is fixed by the sketch size however
+many keys there are, and every worker process on the host adds to the same
+counters. An estimate covers the current sub-window and the ones before it
+back to at least `window` seconds ago. A count-min estimate never falls
+below the true count, so no burst is missed; hash collisions can only
+inflate it, and conservative updates keep that small.
+
+When a key's estimate reaches its threshold, and again each time it
+doubles, a flagged event is queued. A background thread upserts the events
+into vote_anomalies, one row per judge and IP or fingerprint, which the
+admin app reads instead of scanning votes.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import queue
+import struct
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_batch
+
+MAGIC = b'JAIAN001'
+HEADER = struct.Struct('<8sIIII')  # magic, depth, width, sub-windows, sub-window seconds
+SUB_WINDOW = struct.Struct('<Q')  # index of the sub-window the counters belong to
+
+# Each vote is counted under its judge and IP and its judge and fingerprint
+KINDS = ('ip', 'fingerprint')
+
+CREATE_VOTE_ANOMALIES_SQL = '''
+    CREATE TABLE IF NOT EXISTS vote_anomalies (
+        id SERIAL PRIMARY KEY,
+        kind VARCHAR(20) NOT NULL,
+        judge_id INTEGER NOT NULL,
+        subject TEXT NOT NULL,
+        vote_count INTEGER NOT NULL,
+        first_flagged_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        last_flagged_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        UNIQUE (kind, judge_id, subject)
+    );
+    CREATE INDEX IF NOT EXISTS idx_vote_anomalies_last_flagged ON vote_anomalies (last_flagged_at);
+'''
+
+# A flag for a key whose last flag is older than the window starts a new
+# burst; otherwise the burst keeps the highest estimate seen
+RECORD_VOTE_ANOMALIES_SQL = '''
+    INSERT INTO vote_anomalies AS a (kind, judge_id, subject, vote_count, first_flagged_at, last_flagged_at)
+    VALUES (%(kind)s, %(judge_id)s, %(subject)s, %(vote_count)s, %(flagged_at)s, %(flagged_at)s)
+    ON CONFLICT (kind, judge_id, subject) DO UPDATE SET
+        vote_count = CASE
+            WHEN a.last_flagged_at < EXCLUDED.last_flagged_at - make_interval(secs => %(window)s)
+                THEN EXCLUDED.vote_count
+            ELSE GREATEST(a.vote_count, EXCLUDED.vote_count)
+        END,
+        first_flagged_at = CASE
+            WHEN a.last_flagged_at < EXCLUDED.last_flagged_at - make_interval(secs => %(window)s)
+                THEN EXCLUDED.first_flagged_at
+            ELSE a.first_flagged_at
+        END,
+        last_flagged_at = GREATEST(a.last_flagged_at, EXCLUDED.last_flagged_at)
+'''
+
+PRUNE_VOTE_ANOMALIES_SQL = '''
+    DELETE FROM vote_anomalies WHERE last_flagged_at < (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)
+'''
+
+
+def create_vote_anomalies_table(cur):
+    cur.execute(CREATE_VOTE_ANOMALIES_SQL)
+
+
+def record_vote_anomalies(cur, events, window):
+    """Upsert flagged events, (kind, judge_id, subject, vote_count, flagged_at) tuples."""
+    execute_batch(cur, RECORD_VOTE_ANOMALIES_SQL, [{
+        'kind': kind, 'judge_id': judge_id, 'subject': subject, 'vote_count': vote_count,
+        'flagged_at': flagged_at, 'window': window
+    } for kind, judge_id, subject, vote_count, flagged_at in events])
+
+
+def prune_vote_anomalies(cur, retention):
+    cur.execute(PRUNE_VOTE_ANOMALIES_SQL, (retention,))
+    return cur.rowcount
+
+
+def default_sketch_path(name):
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, f'{name}.anomalies')
+
+
+class AnomalyDetector:
+    def __init__(self, write_events, path, window=3600, thresholds=None, sub_windows=12,
+                 depth=4, width=16384, max_queued=10000, flush_interval=1.0, flagged_size=10000):
+        """
+        write_events is called from the writer thread with a list of
+        (kind, judge_id, subject, vote_count, flagged_at) tuples.
+        thresholds maps each kind to the votes per window that raise a flag.
+        """
+        self.write_events = write_events
+        self.path = path
+        self.window = window
+        self.thresholds = thresholds or {kind: 5 for kind in KINDS}
+        self.sub_windows = sub_windows
+        self.sub_window_seconds = max(1, math.ceil(window / sub_windows))
+        self.depth = depth
+        self.width = width
+        self.flush_interval = flush_interval
+        self.flagged_size = flagged_size
+        # One ring slot more than the window spans, so an estimate always
+        # covers a full window however far into the current sub-window it is
+        self._slots = sub_windows + 1
+        self._slot_size = SUB_WINDOW.size + 4 * depth * width
+        self._size = HEADER.size + self._slot_size * self._slots
+        self._events = queue.Queue(max_queued)
+        self._thread_lock = threading.Lock()
+        self._pid = None
+        self._lock_file = None
+        self._mm = None
+        self._counters = None
+        # Highest flag level reported per key, so a burst is reported once
+        # per doubling rather than on every vote
+        self._flagged = OrderedDict()
+        self._dropped = 0
+
+    def start(self):
+        threading.Thread(target=self._run, name='vote-anomaly-writer', daemon=True).start()
+
+    def observe(self, judge_id, ip_address, fingerprint):
+        """Count one vote and queue a flag for each key whose burst just grew past a level."""
+        subjects = {'ip': ip_address, 'fingerprint': fingerprint}
+        keys = [(kind, judge_id, str(subjects[kind])) for kind in KINDS
+                if subjects[kind] and kind in self.thresholds]
+        if not keys:
+            return
+        now = time.time()
+        current = int(now // self.sub_window_seconds)
+        with self._locked() as counters:
+            estimates = [self._add(counters, self._indexes(key), current) for key in keys]
+            flags = [(key, estimate) for key, estimate in zip(keys, estimates) if self._should_flag(key, estimate, now)]
+        # UTC, like the database clock the prune and burst windows compare to
+        flagged_at = datetime.fromtimestamp(now, timezone.utc).replace(tzinfo=None)
+        for (kind, judge_id, subject), estimate in flags:
+            try:
+                self._events.put_nowait((kind, judge_id, subject, estimate, flagged_at))
+            except queue.Full:
+                # The database is behind; later flags for the key carry a higher count
+                with self._thread_lock:
+                    self._dropped += 1
+
+    def estimate(self, kind, judge_id, subject):
+        """Return the estimated votes for a key within the window."""
+        current = int(time.time() // self.sub_window_seconds)
+        with self._locked() as counters:
+            return self._estimate(counters, self._indexes((kind, judge_id, str(subject))), current)
+
+    def _indexes(self, key):
+        data = '\0'.join(str(part) for part in key).encode('utf-8')
+        digest = hashlib.blake2b(data, digest_size=4 * self.depth).digest()
+        return [row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+                for row in range(self.depth)]
+
+    def _add(self, counters, indexes, current):
+        slot = current % self._slots
+        base = self._slot_base(slot)
+        offset = HEADER.size + slot * self._slot_size
+        if SUB_WINDOW.unpack_from(self._mm, offset)[0] != current:
+            # The slot last held a sub-window that has left the ring
+            start = base * 4
+            self._mm[start:start + 4 * self.depth * self.width] = bytes(4 * self.depth * self.width)
+            SUB_WINDOW.pack_into(self._mm, offset, current)
+        # Conservative update: raise only the counters at the key's minimum,
+        # which still never undercounts
+        value = min(counters[base + index] for index in indexes) + 1
+        for index in indexes:
+            if counters[base + index] < value:
+                counters[base + index] = value
+        return self._estimate(counters, indexes, current)
+
+    def _estimate(self, counters, indexes, current):
+        live = []
+        for slot in range(self._slots):
+            stored = SUB_WINDOW.unpack_from(self._mm, HEADER.size + slot * self._slot_size)[0]
+            if current - self._slots < stored <= current:
+                live.append(self._slot_base(slot))
+        return min(sum(counters[base + index] for base in live) for index in indexes)
+
+    def _slot_base(self, slot):
+        # Counter index of the slot's first counter
+        return (HEADER.size + slot * self._slot_size + SUB_WINDOW.size) // 4
+
+    def _should_flag(self, key, estimate, now):
+        threshold = self.thresholds[key[0]]
+        if estimate < threshold:
+            return False
+        level = int(math.log2(estimate / threshold))
+        previous = self._flagged.get(key)
+        if previous is not None and previous[1] > now and previous[0] >= level:
+            return False
+        self._flagged[key] = (level, now + self.window)
+        self._flagged.move_to_end(key)
+        while len(self._flagged) > self.flagged_size:
+            self._flagged.popitem(last=False)
+        return True
+
+    @contextmanager
+    def _locked(self):
+        """Hold the thread and file locks and yield the counters."""
+        with self._thread_lock:
+            if self._pid != os.getpid():
+                self._open()
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+            try:
+                yield self._counters
+            finally:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+
+    def _open(self):
+        # Reopen after a fork, like the rate limiter
+        if self._lock_file is not None:
+            self._lock_file.close()
+        self._lock_file = open(self.path + '.lock', 'a')
+        fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+            try:
+                header = HEADER.pack(MAGIC, self.depth, self.width, self._slots, self.sub_window_seconds)
+                if os.fstat(fd).st_size != self._size or os.pread(fd, HEADER.size, 0) != header:
+                    # New file or one laid out for other settings: start empty
+                    os.ftruncate(fd, 0)
+                    os.ftruncate(fd, self._size)
+                    os.pwrite(fd, header, 0)
+                self._mm = mmap.mmap(fd, self._size)
+            finally:
+                os.close(fd)
+        finally:
+            fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        # The header is padded to a multiple of 4, so counters are aligned
+        self._counters = memoryview(self._mm).cast('I')
+        self._flagged.clear()
+        self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            events = [self._events.get()]
+            time.sleep(self.flush_interval)
+            try:
+                while True:
+                    events.append(self._events.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                self.write_events(events)
+            except Exception as e:
+                print(f"Error recording {len(events)} vote anomalies: {e}")
+            with self._thread_lock:
+                dropped, self._dropped = self._dropped, 0
+            if dropped:
+                print(f"Dropped {dropped} vote anomaly flags while the writer was behind")
@@ -0,0 +1,213 @@
+"""
+Write-behind buffer for vote ingestion.
+
+Accepted votes are appended to an on-disk journal and to a bounded
+in-memory buffer, then written to the database in multi-row batches by a
+background flusher. Journal segments are deleted only after their votes
+have been committed, and segments left behind by a crashed process are
+replayed on the next start.
+
+A batch that fails with one of the dead_letter_errors is written again
+vote by vote, and votes that still fail are appended to a dead-letter file
+in the journal directory, so one bad vote cannot hold up the rest. Any
+other error leaves the batch buffered to be retried.
+"""
+import fcntl
+import glob
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+
+class _Segment:
+    """One journal file and the votes written to it."""
+
+    def __init__(self, path, file, votes=None):
+        self.path = path
+        self.file = file
+        self.votes = votes if votes is not None else []
+
+    def remove(self):
+        os.remove(self.path)
+        self.file.close()
+
+
+class VoteBuffer:
+    def __init__(self, flush_votes, journal_dir, max_size=10000, batch_size=500,
+                 flush_interval=1.0, fsync=True, dead_letter_errors=()):
+        """
+        flush_votes is called from the flusher thread with a list of vote
+        tuples and must write all of them in a single transaction. Writing
+        votes that were written before must be harmless, since a batch can
+        be replayed after a crash. dead_letter_errors are the exception
+        types that mean a vote itself is bad rather than the database
+        unavailable.
+        """
+        self.flush_votes = flush_votes
+        self.journal_dir = journal_dir
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.dead_letter_errors = tuple(dead_letter_errors)
+        self.dead_letter_path = os.path.join(journal_dir, 'dead-letter.jsonl')
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._active = None  # Segment receiving new votes
+        self._sealed = []  # Segments waiting to be written, oldest first
+        self._size = 0
+        self._sequence = 0
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        os.makedirs(self.journal_dir, exist_ok=True)
+        self._recover()
+        self._thread = threading.Thread(target=self._run, name='vote-buffer-flusher', daemon=True)
+        self._thread.start()
+
+    def submit(self, vote):
+        """
+        Journal and buffer a vote.
+
+        Returns False without accepting the vote when the buffer is full, so
+        callers can push back on the client.
+        """
+        line = json.dumps([_encode(value) for value in vote]) + '\n'
+        with self._cond:
+            if self._stopped or self._size >= self.max_size:
+                return False
+            if self._active is None:
+                self._active = self._open_segment()
+            self._active.file.write(line)
+            self._active.file.flush()
+            if self.fsync:
+                os.fsync(self._active.file.fileno())
+            self._active.votes.append(vote)
+            self._size += 1
+            if len(self._active.votes) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def flush(self):
+        """Write every buffered vote now. Returns the number of votes written."""
+        with self._flush_lock:
+            with self._cond:
+                if self._active is not None:
+                    self._sealed.append(self._active)
+                    self._active = None
+                segments = list(self._sealed)
+            if not segments:
+                return 0
+
+            votes = [vote for segment in segments for vote in segment.votes]
+            try:
+                self.flush_votes(votes)
+            except self.dead_letter_errors as e:
+                print(f"Error writing {len(votes)} buffered votes, retrying one by one: {e}")
+                self._flush_one_by_one(votes)
+
+            with self._cond:
+                for segment in segments:
+                    self._sealed.remove(segment)
+                self._size -= len(votes)
+            for segment in segments:
+                segment.remove()
+            return len(votes)
+
+    def _flush_one_by_one(self, votes):
+        # Errors other than dead_letter_errors propagate and the whole batch
+        # is retried later; the votes written here are then written again,
+        # which flush_votes must tolerate
+        for vote in votes:
+            try:
+                self.flush_votes([vote])
+            except self.dead_letter_errors as e:
+                self._dead_letter(vote, e)
+
+    def _dead_letter(self, vote, error):
+        print(f"Moving buffered vote to {self.dead_letter_path}: {error}")
+        line = json.dumps({'vote': [_encode(value) for value in vote], 'error': str(error)}, default=str)
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+
+    def stop(self):
+        """Stop accepting votes and write whatever is still buffered."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"Error flushing vote buffer on shutdown, votes stay journaled: {e}")
+
+    def stats(self):
+        with self._cond:
+            return {'buffered': self._size, 'max_size': self.max_size, 'segments': len(self._sealed)}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                active = len(self._active.votes) if self._active is not None else 0
+                if active < self.batch_size and not self._sealed:
+                    self._cond.wait(self.flush_interval)
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                # Votes stay journaled and buffered; retry after the next interval
+                print(f"Error flushing vote buffer: {e}")
+                time.sleep(self.flush_interval)
+
+    def _open_segment(self):
+        self._sequence += 1
+        path = os.path.join(self.journal_dir, 'votes-%d-%d-%d.journal'
+                            % (os.getpid(), int(time.time()), self._sequence))
+        file = open(path, 'a', encoding='utf-8')
+        fcntl.flock(file, fcntl.LOCK_EX)
+        return _Segment(path, file)
+
+    def _recover(self):
+        """Adopt journal segments whose owning process is gone."""
+        for path in sorted(glob.glob(os.path.join(self.journal_dir, 'votes-*.journal'))):
+            file = open(path, 'r+', encoding='utf-8')
+            try:
+                # Segments of live workers stay locked by their owner
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                continue
+            votes = []
+            for line in file:
+                try:
+                    votes.append(tuple(_decode(value) for value in json.loads(line)))
+                except ValueError:
+                    # A torn final line means the vote was never acknowledged
+                    break
+            if votes:
+                self._sealed.append(_Segment(path, file, votes))
+                self._size += len(votes)
+            else:
+                _Segment(path, file).remove()
+        if self._sealed:
+            print(f"Recovered {self._size} journaled votes from {len(self._sealed)} segments")
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'datetime': value.isoformat()}
+    return value
+
+
+def _decode(value):
+    if isinstance(value, dict) and 'datetime' in value:
+        return datetime.fromisoformat(value['datetime'])
+    return value
@@ -0,0 +1,365 @@
+"""
+Clusters of votes linked by a shared IP address, browser fingerprint or
+network (the /24 or /48 geolocation prefix) within the same time window.
+
+Votes fall into fixed windows of `window` seconds. Within a window each
+vote joins the nodes for its IP, fingerprint and network in a union-find
+forest, so a cluster is a connected component: a botnet that rotates IPs
+but reuses fingerprints, or the reverse, ends up in one cluster. Clusters
+carry their vote count, member counts and per judge and vote type tallies,
+merged smaller into larger on union.
+
+VoteClusterer reads votes in id order from where the previous pass
+stopped, so each pass only costs the new votes, and union by size with
+path halving keeps it near-linear. Ids are taken when a vote is inserted
+but become visible when it commits, so a pass can read past an id that
+commits later, for example a buffered batch still being written. Ids
+skipped over are kept and looked up again on each pass until they turn
+up or pending_timeout passes; ids burnt by conflicting or rolled back
+inserts never turn up and just expire.
+
+Windows older than `retention` are dropped from memory. After a pass
+that saw new votes or dropped a window, clusters with at least min_votes
+votes replace the contents of vote_clusters, which the admin app reads.
+Every admin worker starts a clusterer, but only the one holding a
+session advisory lock runs passes; the others stand by and take over
+when its connection goes away.
+
+vote_skew is the share of a cluster's votes cast for its most common
+judge and vote type: 1.0 when every vote was the same vote for the same
+judge, lower for organic groups such as a campus network. Times are UTC,
+like the database clock that stamps votes.created_at.
+"""
+import threading
+import time
+from datetime import datetime, timezone
+
+from psycopg2.extras import execute_values
+
+# Arbitrary key for the advisory lock held by the one clusterer that runs
+CLUSTER_LOCK_ID = 4242004
+
+# Member values kept per cluster and kind, for the admin page
+SAMPLE_SIZE = 5
+
+CREATE_VOTE_CLUSTERS_SQL = '''
+    CREATE TABLE IF NOT EXISTS vote_clusters (
+        window_start TIMESTAMP NOT NULL,
+        cluster_id INTEGER NOT NULL,
+        votes INTEGER NOT NULL,
+        ip_addresses INTEGER NOT NULL,
+        fingerprints INTEGER NOT NULL,
+        networks INTEGER NOT NULL,
+        judges INTEGER NOT NULL,
+        top_judge_id INTEGER,
+        top_vote_type VARCHAR(20),
+        vote_skew REAL NOT NULL,
+        first_vote_at TIMESTAMP,
+        last_vote_at TIMESTAMP,
+        sample_ips TEXT[] NOT NULL DEFAULT '{}',
+        sample_fingerprints TEXT[] NOT NULL DEFAULT '{}',
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (window_start, cluster_id)
+    );
+'''
+
+# First vote inside the retention period, found through the created_at index
+FIRST_VOTE_ID_SQL = '''
+    SELECT MIN(id) - 1 FROM votes WHERE created_at > (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %s)
+'''
+
+VOTE_COLUMNS = '''
+    id, judge_id, vote_type, host(ip_address), browser_fingerprint,
+    ip_geolocation_prefix(ip_address)::text, created_at
+'''
+
+NEW_VOTES_SQL = '''
+    SELECT ''' + VOTE_COLUMNS + '''
+    FROM votes
+    WHERE id > %s
+    ORDER BY id
+    LIMIT %s
+'''
+
+# Votes whose ids were skipped by an earlier pass
+MISSED_VOTES_SQL = '''
+    SELECT ''' + VOTE_COLUMNS + '''
+    FROM votes
+    WHERE id = ANY(%s)
+'''
+
+INSERT_VOTE_CLUSTERS_SQL = '''
+    INSERT INTO vote_clusters (window_start, cluster_id, votes, ip_addresses, fingerprints, networks,
+                               judges, top_judge_id, top_vote_type, vote_skew, first_vote_at,
+                               last_vote_at, sample_ips, sample_fingerprints)
+    VALUES %s
+'''
+
+
+def create_vote_clusters_table(cur):
+    cur.execute(CREATE_VOTE_CLUSTERS_SQL)
+
+
+class _Cluster:
+    __slots__ = ('votes', 'members', 'tallies', 'first_vote_at', 'last_vote_at', 'samples')
+
+    def __init__(self, kind, value):
+        self.votes = 0
+        self.members = {kind: 1}
+        self.tallies = {}
+        self.first_vote_at = None
+        self.last_vote_at = None
+        self.samples = {kind: [value]} if kind != 'network' else {}
+
+    def add_vote(self, judge_id, vote_type, created_at):
+        self.votes += 1
+        key = (judge_id, vote_type)
+        self.tallies[key] = self.tallies.get(key, 0) + 1
+        if self.first_vote_at is None or created_at < self.first_vote_at:
+            self.first_vote_at = created_at
+        if self.last_vote_at is None or created_at > self.last_vote_at:
+            self.last_vote_at = created_at
+
+    def absorb(self, other):
+        self.votes += other.votes
+        for kind, count in other.members.items():
+            self.members[kind] = self.members.get(kind, 0) + count
+        # Smaller into larger, so a tally moves O(log n) times at most
+        if len(other.tallies) > len(self.tallies):
+            self.tallies, other.tallies = other.tallies, self.tallies
+        for key, count in other.tallies.items():
+            self.tallies[key] = self.tallies.get(key, 0) + count
+        if other.first_vote_at is not None:
+            if self.first_vote_at is None or other.first_vote_at < self.first_vote_at:
+                self.first_vote_at = other.first_vote_at
+            if self.last_vote_at is None or other.last_vote_at > self.last_vote_at:
+                self.last_vote_at = other.last_vote_at
+        for kind, values in other.samples.items():
+            samples = self.samples.setdefault(kind, [])
+            samples.extend(values[:SAMPLE_SIZE - len(samples)])
+
+    def skew(self):
+        """Return (top judge, top vote type, share of votes they got)."""
+        if not self.votes:
+            return None, None, 0.0
+        (judge_id, vote_type), count = max(self.tallies.items(), key=lambda item: item[1])
+        return judge_id, vote_type, count / self.votes
+
+
+class _Forest:
+    """Union-find over the IP, fingerprint and network nodes of one window."""
+
+    def __init__(self):
+        self.nodes = {}
+        self.parent = []
+        self.size = []
+        self.clusters = {}  # Root node -> _Cluster
+
+    def node(self, kind, value):
+        key = (kind, value)
+        index = self.nodes.get(key)
+        if index is None:
+            index = self.nodes[key] = len(self.parent)
+            self.parent.append(index)
+            self.size.append(1)
+            self.clusters[index] = _Cluster(kind, value)
+        return index
+
+    def find(self, index):
+        parent = self.parent
+        while parent[index] != index:
+            # Path halving
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a == b:
+            return a
+        if self.size[a] < self.size[b]:
+            a, b = b, a
+        self.parent[b] = a
+        self.size[a] += self.size[b]
+        self.clusters[a].absorb(self.clusters.pop(b))
+        return a
+
+
+class VoteClusterer:
+    def __init__(self, transaction, connection, window=3600, retention=86400, min_votes=5, interval=60.0,
+                 batch_size=10000, pending_timeout=600, max_pending=100000):
+        """
+        transaction is a context manager factory yielding a cursor in a
+        transaction, connection one yielding an autocommit connection, which
+        holds the advisory lock while this clusterer runs.
+        """
+        self.transaction = transaction
+        self.connection = connection
+        self.window = window
+        self.retention = retention
+        self.min_votes = min_votes
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pending_timeout = pending_timeout
+        self.max_pending = max_pending
+        self._forests = {}  # Window index -> _Forest
+        self._last_id = None
+        self._pending = {}  # Skipped id -> when it was first skipped
+        self._published_oldest = None  # Oldest window kept when last published
+        self._lock = threading.Lock()
+
+    def start(self):
+        threading.Thread(target=self._run, name='vote-clusterer', daemon=True).start()
+
+    def add_vote(self, judge_id, vote_type, ip_address, fingerprint, network, created_at):
+        """Link one vote into its window's forest; votes older than the retention are skipped."""
+        # created_at is a naive UTC timestamp from the database
+        window = int(created_at.replace(tzinfo=timezone.utc).timestamp() // self.window)
+        if window < int((time.time() - self.retention) // self.window):
+            return
+        forest = self._forests.get(window)
+        if forest is None:
+            forest = self._forests[window] = _Forest()
+        root = forest.node('ip', ip_address)
+        if network:
+            root = forest.union(root, forest.node('network', network))
+        if fingerprint:
+            root = forest.union(root, forest.node('fingerprint', fingerprint))
+        forest.clusters[root].add_vote(judge_id, vote_type, created_at)
+
+    def clusters(self):
+        """Return published rows for every cluster with at least min_votes votes."""
+        rows = []
+        for window, forest in self._forests.items():
+            window_start = datetime.fromtimestamp(window * self.window, timezone.utc).replace(tzinfo=None)
+            for root, cluster in forest.clusters.items():
+                if cluster.votes < self.min_votes:
+                    continue
+                judge_id, vote_type, skew = cluster.skew()
+                rows.append((
+                    window_start, root, cluster.votes, cluster.members.get('ip', 0),
+                    cluster.members.get('fingerprint', 0), cluster.members.get('network', 0),
+                    len({judge for judge, _ in cluster.tallies}), judge_id, vote_type, round(skew, 4),
+                    cluster.first_vote_at, cluster.last_vote_at,
+                    cluster.samples.get('ip', []), cluster.samples.get('fingerprint', [])
+                ))
+        return rows
+
+    def run_once(self):
+        """Cluster the votes stored since the last pass and publish. Returns the votes read."""
+        with self._lock:
+            oldest = int((time.time() - self.retention) // self.window)
+            for window in [window for window in self._forests if window < oldest]:
+                del self._forests[window]
+
+            read = 0
+            with self.transaction() as cur:
+                # Gaps in the votes already committed when the first pass
+                # starts are settled, so only later passes track them
+                track_gaps = self._last_id is not None
+                if self._last_id is None:
+                    cur.execute(FIRST_VOTE_ID_SQL, (self.retention,))
+                    self._last_id = cur.fetchone()[0]
+                    if self._last_id is None:
+                        # No recent votes; later votes have higher ids
+                        cur.execute('SELECT COALESCE(MAX(id), 0) FROM votes')
+                        self._last_id = cur.fetchone()[0]
+                read += self._read_missed(cur)
+                while True:
+                    cur.execute(NEW_VOTES_SQL, (self._last_id, self.batch_size))
+                    votes = cur.fetchall()
+                    if track_gaps:
+                        self._track_gaps(votes)
+                    self._add_votes(votes)
+                    read += len(votes)
+                    if votes:
+                        self._last_id = votes[-1][0]
+                    if len(votes) < self.batch_size:
+                        break
+
+            # Publish when votes were added or old windows dropped
+            if read or oldest != self._published_oldest:
+                self.publish()
+                self._published_oldest = oldest
+            return read
+
+    def _add_votes(self, votes):
+        for vote_id, judge_id, vote_type, ip_address, fingerprint, network, created_at in votes:
+            self.add_vote(judge_id, vote_type, ip_address, fingerprint, network, created_at)
+
+    def _track_gaps(self, votes):
+        now = time.monotonic()
+        previous = self._last_id
+        for vote in votes:
+            for missing in range(previous + 1, vote[0]):
+                if len(self._pending) >= self.max_pending:
+                    return
+                self._pending[missing] = now
+            previous = vote[0]
+
+    def _read_missed(self, cur):
+        """Add skipped votes that have committed since. Returns how many."""
+        expired_before = time.monotonic() - self.pending_timeout
+        for vote_id in [vote_id for vote_id, skipped_at in self._pending.items() if skipped_at < expired_before]:
+            del self._pending[vote_id]
+        pending = list(self._pending)
+        read = 0
+        for start in range(0, len(pending), self.batch_size):
+            cur.execute(MISSED_VOTES_SQL, (pending[start:start + self.batch_size],))
+            votes = cur.fetchall()
+            for vote in votes:
+                del self._pending[vote[0]]
+            self._add_votes(votes)
+            read += len(votes)
+        return read
+
+    def publish(self):
+        rows = self.clusters()
+        with self.transaction() as cur:
+            cur.execute('DELETE FROM vote_clusters')
+            if rows:
+                execute_values(cur, INSERT_VOTE_CLUSTERS_SQL, rows)
+
+    def _run(self):
+        while True:
+            try:
+                with self.connection() as conn, conn.cursor() as cur:
+                    cur.execute('SELECT pg_try_advisory_lock(%s)', (CLUSTER_LOCK_ID,))
+                    if cur.fetchone()[0]:
+                        try:
+                            self._lead(cur)
+                        finally:
+                            try:
+                                cur.execute('SELECT pg_advisory_unlock(%s)', (CLUSTER_LOCK_ID,))
+                            except Exception:
+                                pass  # A broken connection released the lock already
+            except Exception as e:
+                print(f"Error holding the vote clusterer lock: {e}")
+            time.sleep(self.interval)
+
+    def _lead(self, lock_cur):
+        """Run passes for as long as the session holding the lock is alive."""
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error clustering votes: {e}")
+            time.sleep(self.interval)
+            lock_cur.execute('SELECT 1')
+
+
+# Clusters with the most votes for one judge and vote type first
+VOTE_CLUSTERS_SQL = '''
+    SELECT c.*, j.name AS top_judge_name
+    FROM vote_clusters c
+    LEFT JOIN judges j ON j.id = c.top_judge_id
+    WHERE c.vote_skew >= %s
+    ORDER BY c.votes * c.vote_skew DESC, c.last_vote_at DESC
+    LIMIT %s
+'''
+
+
+def fetch_vote_clusters(cur, limit=50, min_skew=0.0):
+    """Return published clusters as dicts. Needs a dict cursor."""
+    cur.execute(VOTE_CLUSTERS_SQL, (min_skew, limit))
+    return [dict(row) for row in cur.fetchall()]
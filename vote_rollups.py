@@ -0,0 +1,208 @@
+"""
+Hourly vote counts for the admin analytics pages.
+
+vote_rollups_hourly holds one row per hour, judge, vote type and voter
+country (an empty string when the country is not known yet). Statement
+triggers on votes keep it current: inserts and deletes add and remove
+counts, and updates, such as the geolocation job filling in a country,
+move them between rows. Analytics read these rows instead of scanning
+votes, so their cost grows with the number of hours and judges rather than
+with the number of votes. The ratio-shift detector, which compares every
+judge's share of corrupt votes now and a window ago, reads only the
+rollups inside its window and takes totals from judge_vote_tallies.
+
+Buckets are hours of UTC vote time. The rollups are filled from votes
+only on request, since the recount keeps votes from being written:
+
+    python vote_rollups.py --rebuild
+"""
+import sys
+
+# Arbitrary key for the advisory lock that keeps rollup creation single-flight
+ROLLUP_LOCK_ID = 4242003
+
+CREATE_VOTE_ROLLUPS_SQL = '''
+    CREATE TABLE IF NOT EXISTS vote_rollups_hourly (
+        bucket TIMESTAMP NOT NULL,
+        judge_id INTEGER NOT NULL,
+        vote_type VARCHAR(20) NOT NULL,
+        country_code VARCHAR(2) NOT NULL DEFAULT '',
+        votes BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (bucket, judge_id, vote_type, country_code)
+    );
+    CREATE INDEX IF NOT EXISTS idx_vote_rollups_judge ON vote_rollups_hourly (judge_id, bucket);
+    CREATE INDEX IF NOT EXISTS idx_votes_created_at ON votes (created_at);
+    CREATE OR REPLACE FUNCTION roll_up_votes() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            INSERT INTO vote_rollups_hourly AS r (bucket, judge_id, vote_type, country_code, votes)
+            SELECT date_trunc('hour', created_at), judge_id, vote_type, COALESCE(country_code, ''), -COUNT(*)
+            FROM removed_votes
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (bucket, judge_id, vote_type, country_code) DO UPDATE SET
+                votes = r.votes + EXCLUDED.votes;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO vote_rollups_hourly AS r (bucket, judge_id, vote_type, country_code, votes)
+            SELECT date_trunc('hour', created_at), judge_id, vote_type, COALESCE(country_code, ''), COUNT(*)
+            FROM added_votes
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (bucket, judge_id, vote_type, country_code) DO UPDATE SET
+                votes = r.votes + EXCLUDED.votes;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    -- Triggers are only created when missing: CREATE OR REPLACE TRIGGER needs
+    -- PostgreSQL 14, and dropping them would lock votes on every startup
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'votes'::regclass AND tgname = 'votes_rollup_insert') THEN
+            CREATE TRIGGER votes_rollup_insert
+                AFTER INSERT ON votes REFERENCING NEW TABLE AS added_votes
+                FOR EACH STATEMENT EXECUTE FUNCTION roll_up_votes();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'votes'::regclass AND tgname = 'votes_rollup_update') THEN
+            CREATE TRIGGER votes_rollup_update
+                AFTER UPDATE ON votes REFERENCING OLD TABLE AS removed_votes NEW TABLE AS added_votes
+                FOR EACH STATEMENT EXECUTE FUNCTION roll_up_votes();
+        END IF;
+        IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgrelid = 'votes'::regclass AND tgname = 'votes_rollup_delete') THEN
+            CREATE TRIGGER votes_rollup_delete
+                AFTER DELETE ON votes REFERENCING OLD TABLE AS removed_votes
+                FOR EACH STATEMENT EXECUTE FUNCTION roll_up_votes();
+        END IF;
+    END
+    $$;
+'''
+
+# Recounts every bucket from votes. The lock keeps votes from being written
+# between the recount and the end of the transaction, when the triggers
+# take over again.
+REBUILD_VOTE_ROLLUPS_SQL = '''
+    LOCK TABLE votes IN SHARE ROW EXCLUSIVE MODE;
+    TRUNCATE vote_rollups_hourly;
+    INSERT INTO vote_rollups_hourly (bucket, judge_id, vote_type, country_code, votes)
+    SELECT date_trunc('hour', created_at), judge_id, vote_type, COALESCE(country_code, ''), COUNT(*)
+    FROM votes
+    GROUP BY 1, 2, 3, 4;
+'''
+
+
+def create_vote_rollups(cur):
+    """
+    Create the rollup table and its triggers. Returns True when the table is
+    new, in which case it only counts votes from now on until
+    rebuild_vote_rollups runs. Must run inside a transaction.
+    """
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (ROLLUP_LOCK_ID,))
+    cur.execute("SELECT to_regclass('vote_rollups_hourly') IS NULL")
+    is_new = cur.fetchone()[0]
+    cur.execute(CREATE_VOTE_ROLLUPS_SQL)
+    return is_new
+
+
+def rebuild_vote_rollups(cur):
+    """
+    Recount all rollups from votes. Must run inside a transaction; votes
+    cannot be written until it commits.
+    """
+    cur.execute('SELECT pg_advisory_xact_lock(%s)', (ROLLUP_LOCK_ID,))
+    cur.execute(CREATE_VOTE_ROLLUPS_SQL)
+    cur.execute(REBUILD_VOTE_ROLLUPS_SQL)
+
+
+# Windows the ratio-shift detector compares against, in seconds
+RATIO_SHIFT_WINDOWS = {'15m': 900, '1h': 3600, '6h': 21600}
+
+# Votes per judge in total and within the last %(window)s seconds, in one
+# pass. Totals come from the judges' global tally rows. Whole hours of the
+# window come from the rollups, read by range on the leading bucket column
+# of their primary key; only the votes in the hour the window starts in are
+# read from votes, through its created_at index. The cost depends on the
+# window and the number of judges, not on the number of votes or on how
+# much history there is.
+RATIO_SHIFT_COUNTS_SQL = '''
+    WITH bounds AS (
+        SELECT
+            (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %(window)s) AS since,
+            date_trunc('hour', (NOW() AT TIME ZONE 'UTC') - make_interval(secs => %(window)s)) + INTERVAL '1 hour'
+                AS first_full_hour
+    ), rolled_up AS (
+        SELECT
+            r.judge_id,
+            SUM(r.votes) FILTER (WHERE r.vote_type = 'corrupt') AS recent_corrupt,
+            SUM(r.votes) FILTER (WHERE r.vote_type = 'not_corrupt') AS recent_not_corrupt
+        FROM vote_rollups_hourly r, bounds b
+        WHERE r.bucket >= b.first_full_hour
+        GROUP BY r.judge_id
+    ), partial_hour AS (
+        SELECT
+            v.judge_id,
+            COUNT(*) FILTER (WHERE v.vote_type = 'corrupt') AS recent_corrupt,
+            COUNT(*) FILTER (WHERE v.vote_type = 'not_corrupt') AS recent_not_corrupt
+        FROM votes v, bounds b
+        WHERE v.created_at > b.since AND v.created_at < b.first_full_hour
+        GROUP BY v.judge_id
+    )
+    SELECT
+        j.id,
+        j.name,
+        COALESCE(t.corrupt_votes, 0)::bigint,
+        COALESCE(t.not_corrupt_votes, 0)::bigint,
+        (COALESCE(r.recent_corrupt, 0) + COALESCE(p.recent_corrupt, 0))::bigint,
+        (COALESCE(r.recent_not_corrupt, 0) + COALESCE(p.recent_not_corrupt, 0))::bigint
+    FROM judges j
+    LEFT JOIN judge_vote_tallies t ON t.judge_id = j.id AND t.scope = 'global'
+    LEFT JOIN rolled_up r ON r.judge_id = j.id
+    LEFT JOIN partial_hour p ON p.judge_id = j.id
+    WHERE j.displayed = 1
+'''
+
+
+def fetch_ratio_shifts(cur, window, threshold=0.15, min_votes=10):
+    """
+    Return judges whose share of corrupt votes moved by at least threshold
+    over the last window seconds, largest shift first. Judges with fewer
+    than min_votes votes before or after are skipped.
+    """
+    cur.execute(RATIO_SHIFT_COUNTS_SQL, {'window': window})
+    shifts = []
+    for judge_id, judge_name, corrupt_now, not_corrupt_now, recent_corrupt, recent_not_corrupt in cur.fetchall():
+        corrupt_before = corrupt_now - recent_corrupt
+        total_before = corrupt_before + not_corrupt_now - recent_not_corrupt
+        total_now = corrupt_now + not_corrupt_now
+        if total_before < min_votes or total_now < min_votes:
+            continue
+        corrupt_ratio_before = corrupt_before / total_before
+        corrupt_ratio_now = corrupt_now / total_now
+        ratio_change = abs(corrupt_ratio_now - corrupt_ratio_before)
+        if ratio_change >= threshold:
+            shifts.append({
+                'judge_id': judge_id,
+                'judge_name': judge_name,
+                'corrupt_ratio_before': round(corrupt_ratio_before * 100, 1),
+                'corrupt_ratio_now': round(corrupt_ratio_now * 100, 1),
+                'ratio_change': round(ratio_change * 100, 1),
+                'votes_before': total_before,
+                'votes_now': total_now,
+                'new_votes': total_now - total_before
+            })
+    shifts.sort(key=lambda shift: shift['ratio_change'], reverse=True)
+    return shifts
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] != ['--rebuild']:
+        print(f"Usage: {sys.argv[0]} --rebuild")
+        sys.exit(1)
+    from dotenv import load_dotenv
+    load_dotenv('.env.local')
+    from db import transaction
+    try:
+        with transaction() as cur:
+            rebuild_vote_rollups(cur)
+    except Exception as e:
+        print(f"Error rebuilding vote rollups: {e}")
+        sys.exit(1)
+    print("Rebuilt vote_rollups_hourly from votes")